@@ -0,0 +1,100 @@
+"""Wall time and peak memory of histogram matching
+
+Run with asv, e.g. `asv run --python=same` for the working tree, or
+`asv continuous master HEAD` to compare commits. Sizes up to 16384 pixels
+square need several GB of memory; select parameters with
+`asv run -b 'Worker' --python=same` and asv's --bench options, or limit
+the sizes with the RIO_HIST_BENCH_SIZES environment variable, e.g.
+RIO_HIST_BENCH_SIZES=1024,4096.
+"""
+import os
+import shutil
+import tempfile
+
+from rio_hist.histogram import histogram_match, value_counts
+from rio_hist.match import hist_match_worker
+from rio_hist.utils import cs_backward, cs_forward
+
+from .rasters import synthetic_array, synthetic_raster
+
+SIZES = [int(size) for size in os.environ.get(
+    'RIO_HIST_BENCH_SIZES', '1024,4096,16384').split(',')]
+DTYPES = ['uint8', 'uint16']
+NODATA_FRACTIONS = [0.0, 0.6]
+COLOR_SPACES = ['RGB', 'LCH', 'LAB', 'LUV', 'XYZ']
+
+
+class HistogramMatch(object):
+    """histogram_match of the first band in a color space"""
+    params = (SIZES, DTYPES, NODATA_FRACTIONS, COLOR_SPACES)
+    param_names = ['size', 'dtype', 'nodata_fraction', 'color_space']
+    timeout = 1800
+
+    def setup(self, size, dtype, nodata_fraction, color_space):
+        src = synthetic_array(size, dtype, nodata_fraction, seed=0)
+        ref = synthetic_array(size, dtype, nodata_fraction, seed=1)
+        self.valid = src[0] > 0
+        ref_valid = ref[0] > 0
+        self.source = cs_forward(src, color_space)[0]
+        reference = cs_forward(ref, color_space)[0]
+        self.reference = value_counts(reference[ref_valid])
+
+    def time_histogram_match(self, size, dtype, nodata_fraction, color_space):
+        histogram_match(self.source, self.reference, valid=self.valid)
+
+    def peakmem_histogram_match(self, size, dtype, nodata_fraction,
+                                color_space):
+        histogram_match(self.source, self.reference, valid=self.valid)
+
+
+class ColorSpaceConversion(object):
+    """cs_forward and cs_backward of a 3 band array"""
+    params = (SIZES, DTYPES, COLOR_SPACES)
+    param_names = ['size', 'dtype', 'color_space']
+    timeout = 1800
+
+    def setup(self, size, dtype, color_space):
+        self.rgb = synthetic_array(size, dtype)
+        self.arr = cs_forward(self.rgb, color_space)
+
+    def time_cs_forward(self, size, dtype, color_space):
+        cs_forward(self.rgb, color_space)
+
+    def peakmem_cs_forward(self, size, dtype, color_space):
+        cs_forward(self.rgb, color_space)
+
+    def time_cs_backward(self, size, dtype, color_space):
+        cs_backward(self.arr, color_space)
+
+    def peakmem_cs_backward(self, size, dtype, color_space):
+        cs_backward(self.arr, color_space)
+
+
+class Worker(object):
+    """hist_match_worker from and to GeoTIFF files"""
+    params = (SIZES, DTYPES, NODATA_FRACTIONS, COLOR_SPACES, [False, True])
+    param_names = ['size', 'dtype', 'nodata_fraction', 'color_space',
+                   'windowed']
+    timeout = 3600
+
+    def setup(self, size, dtype, nodata_fraction, color_space, windowed):
+        self.src_path = synthetic_raster(size, dtype, nodata_fraction, seed=0)
+        self.ref_path = synthetic_raster(size, dtype, nodata_fraction, seed=1)
+        self.tmpdir = tempfile.mkdtemp()
+        self.dst_path = os.path.join(self.tmpdir, 'dst.tif')
+
+    def teardown(self, size, dtype, nodata_fraction, color_space, windowed):
+        shutil.rmtree(self.tmpdir)
+
+    def _match(self, color_space, windowed):
+        hist_match_worker(
+            self.src_path, self.ref_path, self.dst_path, 1.0, {}, '1,2,3',
+            color_space, False, windowed=windowed)
+
+    def time_hist_match_worker(self, size, dtype, nodata_fraction,
+                               color_space, windowed):
+        self._match(color_space, windowed)
+
+    def peakmem_hist_match_worker(self, size, dtype, nodata_fraction,
+                                  color_space, windowed):
+        self._match(color_space, windowed)
@@ -0,0 +1,57 @@
+"""Synthetic rasters for the benchmarks
+
+Rasters are smooth, image-like RGB gradients with noise, optionally with
+a fraction of nodata pixels, cached in a temporary directory for the
+duration of a benchmark process and removed when it exits.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+from affine import Affine
+import numpy as np
+import rasterio
+
+_cache_dir = None
+
+
+def synthetic_array(size, dtype='uint8', nodata_fraction=0.0, seed=0):
+    """(3, size, size) array; nodata pixels, a block of columns on the
+    left, are 0 and all other pixels are positive
+    """
+    maxval = np.iinfo(dtype).max
+    rng = np.random.RandomState(seed)
+    ramp = np.linspace(0.05, 0.8, size, dtype='float32')
+    arr = np.empty((3, size, size), dtype=dtype)
+    for i, k in enumerate((1, 2, 3)):
+        band = ramp[:, np.newaxis] + ramp[np.newaxis, :] * (k / 4.0)
+        band += rng.uniform(0, 0.15, (size, size)).astype('float32')
+        np.clip(band, 0, 1, out=band)
+        band *= maxval
+        arr[i] = np.maximum(band, 1)
+    arr[:, :, :int(round(size * nodata_fraction))] = 0
+    return arr
+
+
+def synthetic_raster(size, dtype='uint8', nodata_fraction=0.0, seed=0):
+    """Path of a tiled GeoTIFF of synthetic_array, with nodata 0 when
+    nodata_fraction is not 0
+    """
+    global _cache_dir
+    if _cache_dir is None:
+        _cache_dir = tempfile.mkdtemp(prefix='rio-hist-bench-')
+        atexit.register(shutil.rmtree, _cache_dir, ignore_errors=True)
+    path = os.path.join(_cache_dir, '{}_{}_{}_{}.tif'.format(
+        size, dtype, nodata_fraction, seed))
+    if not os.path.exists(path):
+        arr = synthetic_array(size, dtype, nodata_fraction, seed)
+        profile = {
+            'driver': 'GTiff', 'dtype': dtype, 'count': 3,
+            'width': size, 'height': size, 'crs': 'EPSG:3857',
+            'transform': Affine(10.0, 0.0, 0.0, 0.0, -10.0, 0.0),
+            'tiled': True, 'blockxsize': 512, 'blockysize': 512,
+            'nodata': 0 if nodata_fraction else None}
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(arr)
+    return path
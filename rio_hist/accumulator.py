@@ -0,0 +1,202 @@
+"""Incrementally updated reference histograms
+
+A HistogramAccumulator holds the summed histograms of any number of
+reference rasters, so that a reference profile can be updated as
+rasters are added or removed by reading only those rasters.
+
+In the RGB and RAW color spaces, integer rasters are counted exactly on
+their values. In the other color spaces, values are counted in a fixed
+number of equal bins over fixed bounds (FLOAT_RANGES), so that counts
+of different rasters add up and subtract exactly.
+
+Saved accumulators are reference profiles (see rio_hist.reference)
+with a few more arrays, and can be used by rio hist --ref-profile.
+"""
+from __future__ import division, absolute_import
+import logging
+
+import numpy as np
+import rasterio
+
+from .histogram import (
+    FLOAT_RANGES, _bin_quantization, _levels, merge_histograms)
+from .reference import load_profile, save_profile
+from .utils import cs_forward, parse_bands
+from .windowed import _window_mask, windowed_histograms
+
+logger = logging.getLogger(__name__)
+
+# color spaces counted exactly
+EXACT_SPACES = ('rgb', 'raw')
+
+
+class HistogramAccumulator(object):
+    """Summed histograms of the bands of reference rasters
+
+    Parameters:
+    -----------
+        color_spaces: sequence of str
+        bands: str
+            comma-separated list of bands, as for rio hist
+        bins: int
+            number of bins of the float color spaces
+    """
+
+    def __init__(self, color_spaces=('RGB',), bands='1,2,3', bins=65536):
+        self.color_spaces = tuple(cs.lower() for cs in color_spaces)
+        self.bands = bands
+        # RAW bands are checked against the band count of each raster
+        self.bixs = parse_bands(
+            bands, None if 'raw' in self.color_spaces else 3)
+        self.bins = bins
+        # (cs, b) -> (values, counts) histogram in EXACT_SPACES,
+        # dense int64 bin counts otherwise
+        self._counts = {}
+        for cs in self.color_spaces:
+            for b in self.bixs:
+                if cs in EXACT_SPACES:
+                    self._counts[(cs, b)] = (
+                        np.zeros(0, dtype='float64'),
+                        np.zeros(0, dtype='int64'))
+                else:
+                    self._counts[(cs, b)] = np.zeros(bins, dtype='int64')
+
+    def _quantization(self, cs, b):
+        lo, hi = FLOAT_RANGES[cs][b]
+        return _bin_quantization(lo, hi, self.bins)
+
+    def _bin(self, cs, b, values, counts=None):
+        """Dense bin counts of values, weighted by counts if given"""
+        origin, divisor = self._quantization(cs, b)
+        levels = _levels(values, origin, divisor, self.bins)
+        if counts is None:
+            return np.bincount(levels, minlength=self.bins)
+        binned = np.bincount(levels, weights=counts, minlength=self.bins)
+        return np.rint(binned).astype('int64')
+
+    def _update(self, profile, sign):
+        """Add or subtract (sign 1 or -1) the histograms of a profile
+
+        Float color space histograms with values of None are bin counts.
+        """
+        for (cs, b), current in self._counts.items():
+            try:
+                values, counts = profile[cs][b]
+            except KeyError:
+                raise ValueError(
+                    "Histograms have no band {} in {} color space".format(
+                        b + 1, cs))
+            if cs in EXACT_SPACES:
+                values, counts = merge_histograms(
+                    [current, (values, sign * np.asarray(counts))])
+                keep = counts != 0
+                updated = values[keep], counts[keep]
+                negative = (updated[1] < 0).any()
+            else:
+                if values is not None:
+                    counts = self._bin(cs, b, values, counts)
+                updated = current + sign * counts
+                negative = (updated < 0).any()
+            if negative:
+                raise ValueError(
+                    "Removing counts that were not added, band {} in {} "
+                    "color space".format(b + 1, cs))
+            self._counts[(cs, b)] = updated
+
+    def add_histograms(self, profile):
+        """Add the histograms of a reference profile (see
+        rio_hist.reference), which must have the accumulator's color
+        spaces and bands"""
+        self._update(profile, 1)
+        return self
+
+    def remove_histograms(self, profile):
+        """Subtract the histograms of a reference profile added before"""
+        self._update(profile, -1)
+        return self
+
+    def raster_histograms(self, path):
+        """Histograms of a raster, binned as the accumulator's
+
+        The raster is read block by block: once in each of EXACT_SPACES,
+        once for all the float color spaces.
+        """
+        profile = {}
+        with rasterio.open(path) as src:
+            if 'raw' in self.color_spaces:
+                parse_bands(self.bands, src.count)
+            for cs in EXACT_SPACES:
+                if cs in self.color_spaces:
+                    hists, _ = windowed_histograms(src, cs, self.bixs)
+                    profile[cs] = hists
+            float_spaces = [cs for cs in self.color_spaces
+                            if cs not in EXACT_SPACES]
+            counts = dict(((cs, b), np.zeros(self.bins, dtype='int64'))
+                          for cs in float_spaces for b in self.bixs)
+            windows = src.block_windows(1) if float_spaces else []
+            for _, window in windows:
+                arr = src.read(window=window)
+                valid = _window_mask(src, window)
+                for cs in float_spaces:
+                    csarr = cs_forward(arr, cs)
+                    for b in self.bixs:
+                        counts[(cs, b)] += self._bin(cs, b, csarr[b][valid])
+            for (cs, b), binned in counts.items():
+                profile.setdefault(cs, {})[b] = (None, binned)
+        return profile
+
+    def add_raster(self, path):
+        """Add the histograms of a raster"""
+        logger.debug("Adding histograms of {}".format(path))
+        return self.add_histograms(self.raster_histograms(path))
+
+    def remove_raster(self, path):
+        """Subtract the histograms of a raster added before"""
+        logger.debug("Removing histograms of {}".format(path))
+        return self.remove_histograms(self.raster_histograms(path))
+
+    def merge(self, other):
+        """Add the counts of another accumulator of the same color
+        spaces, bands and bins"""
+        if (other.color_spaces, other.bixs, other.bins) != \
+                (self.color_spaces, self.bixs, self.bins):
+            raise ValueError("Accumulators of different histograms")
+        profile = {}
+        for (cs, b), counts in other._counts.items():
+            profile.setdefault(cs, {})[b] = (
+                counts if cs in EXACT_SPACES else (None, counts))
+        return self.add_histograms(profile)
+
+    def profile(self):
+        """The accumulated histograms as a reference profile"""
+        profile = {}
+        for (cs, b), counts in self._counts.items():
+            if cs in EXACT_SPACES:
+                hist = counts
+            else:
+                origin, divisor = self._quantization(cs, b)
+                nonzero = np.flatnonzero(counts)
+                hist = (origin + nonzero) / divisor, counts[nonzero]
+            profile.setdefault(cs, {})[b] = hist
+        return profile
+
+    def save(self, path):
+        """Write the accumulator to a .npz reference profile"""
+        save_profile(path, self.profile(), {
+            'accumulator_color_spaces': np.array(self.color_spaces),
+            'accumulator_bands': np.array(self.bands),
+            'accumulator_bins': np.array(self.bins)})
+
+    @classmethod
+    def load(cls, path):
+        """Read an accumulator written by save"""
+        with np.load(path) as data:
+            try:
+                meta = dict((key, data['accumulator_' + key][()])
+                            for key in ('color_spaces', 'bands', 'bins'))
+            except KeyError:
+                raise ValueError(
+                    "{} is not an accumulator profile".format(path))
+        acc = cls(list(meta['color_spaces']), str(meta['bands']),
+                  int(meta['bins']))
+        return acc.add_histograms(load_profile(path))
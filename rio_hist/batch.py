@@ -0,0 +1,209 @@
+"""Match many sources to one reference
+
+The reference histograms are computed once and shared with a pool of
+worker processes, each of which matches whole source rasters.
+
+For mosaics, the reference can instead be the merged histograms of the
+sources themselves (see mosaic_profile), so that every scene is matched
+to the same global target.
+"""
+from __future__ import division, absolute_import
+import logging
+import multiprocessing
+import os
+
+import rasterio
+
+from .histogram import _MERGE_EVERY, merge_histograms
+from .match import _band_count, _cached_reference, hist_match_worker
+from .reader import basename, gdal_options
+from .reference import load_profile, reference_profile
+from .utils import parse_bands
+
+logger = logging.getLogger(__name__)
+
+# set in each worker process by _init_worker
+_worker_args = None
+
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args
+
+
+def _match_one(paths):
+    """Match a single source, returning the error message on failure"""
+    src_path, dst_path = paths
+    kwargs = _worker_args.copy()
+    try:
+        hist_match_worker(src_path, None, dst_path, plot=False, **kwargs)
+    except Exception as exc:
+        logger.exception("Failed to match {}".format(src_path))
+        return src_path, dst_path, "{}: {}".format(type(exc).__name__, exc)
+    return src_path, dst_path, None
+
+
+def _profile_one(path):
+    """Compute the profile of a single raster, None on failure"""
+    try:
+        return path, reference_profile(path, **_worker_args)
+    except Exception:
+        logger.exception("Failed to compute histograms of {}".format(path))
+        return path, None
+
+
+def mosaic_profile(paths, color_spaces=('RGB',), bands='1,2,3',
+                   method='auto', weights=None, jobs=1):
+    """Merge the histograms of many rasters into one reference profile
+
+    The histograms of each raster are computed in a pool of `jobs`
+    processes (see rio_hist.reference.reference_profile) and merged as
+    they come in, so that memory depends on the number of distinct
+    values, not on the number of rasters.
+
+    weights, a dict of path -> weight, scales the counts of rasters;
+    rasters with a weight of 0 are left out and those not in weights
+    have a weight of 1. Rasters whose histograms can't be computed are
+    logged and left out.
+
+    Returns the profile.
+    """
+    weights = dict((os.path.normpath(p), w)
+                   for p, w in (weights or {}).items())
+    paths = [p for p in paths if weights.get(os.path.normpath(p), 1) != 0]
+    if not paths:
+        raise ValueError("no rasters to merge")
+
+    worker_args = dict(
+        color_spaces=color_spaces, bands=bands, method=method)
+    if jobs == 1:
+        _init_worker(worker_args)
+        pool = None
+        profiles = map(_profile_one, paths)
+    else:
+        pool = multiprocessing.Pool(
+            jobs, initializer=_init_worker, initargs=(worker_args,))
+        profiles = pool.imap_unordered(_profile_one, paths)
+
+    partial = {}
+    try:
+        for path, profile in profiles:
+            if profile is None:
+                continue
+            weight = weights.get(os.path.normpath(path), 1)
+            logger.debug("Merging histograms of {} with weight {}".format(
+                path, weight))
+            for cs, hists in profile.items():
+                for b, (values, counts) in hists.items():
+                    if weight != 1:
+                        counts = counts * float(weight)
+                    merged = partial.setdefault((cs, b), [])
+                    merged.append((values, counts))
+                    if len(merged) >= _MERGE_EVERY:
+                        partial[(cs, b)] = [merge_histograms(merged)]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if not partial:
+        raise ValueError("no histograms could be computed")
+    merged = {}
+    for (cs, b), hists in partial.items():
+        merged.setdefault(cs, {})[b] = merge_histograms(hists)
+    return merged
+
+
+def output_paths(src_paths, dst_dir):
+    """(src_path, dst_path) pairs of sources and their outputs in
+    dst_dir, with the basenames of the sources
+
+    Raises ValueError if two sources have the same basename or if an
+    output would overwrite its source.
+    """
+    tasks = []
+    sources = {}
+    for src_path in src_paths:
+        dst_path = os.path.join(dst_dir, basename(src_path))
+        if dst_path in sources:
+            raise ValueError("sources {} and {} have the same basename".format(
+                sources[dst_path], src_path))
+        sources[dst_path] = src_path
+        if os.path.exists(src_path) and os.path.exists(dst_path) and \
+                os.path.samefile(src_path, dst_path):
+            raise ValueError("the output of {} is the source itself".format(
+                src_path))
+        tasks.append((src_path, dst_path))
+    return tasks
+
+
+def hist_match_batch(src_paths, ref_path, dst_dir, match_proportion,
+                     creation_options, bands, color_space, jobs=1,
+                     windowed=False, method='auto', ref_profile=None,
+                     cog=False, mosaic=False, weights=None, read_threads=1,
+                     gdal_cache=None, cache=None):
+    """Match the histograms of many sources to one reference
+
+    Each source is written to dst_dir with its own basename (see
+    output_paths), which must differ from those of other sources and
+    not be the source itself. Sources
+    are matched in a pool of `jobs` processes; a failed source does not
+    stop the batch. Sources and reference may be remote, see
+    hist_match_worker for read_threads and gdal_cache.
+
+    cache, a rio_hist.cache.ResultCache, is shared by the workers (see
+    hist_match_worker); unchanged sources matched to an unchanged
+    reference are then copied from it.
+
+    With mosaic=True, the reference is the merged histograms of the
+    sources, weighted by weights (see mosaic_profile), and ref_path and
+    ref_profile are ignored.
+
+    Returns a list of (src_path, dst_path, error) tuples, in the order
+    of src_paths, where error is None on success or a message.
+    """
+    # fail before the batch starts; RAW bands are checked against the
+    # band count of each raster as it is read
+    parse_bands(bands, None if color_space.lower() == 'raw' else 3)
+    tasks = output_paths(src_paths, dst_dir)
+    if mosaic:
+        logger.info("Merging histograms of {} sources".format(
+            len(src_paths)))
+        with rasterio.Env.from_defaults(
+                **gdal_options(src_paths, gdal_cache)):
+            ref_profile = mosaic_profile(
+                src_paths, (color_space,), bands, method, weights, jobs)
+    elif isinstance(ref_profile, str):
+        ref_profile = load_profile(ref_profile)
+    elif ref_profile is None:
+        logger.info("Computing reference histograms of {}".format(ref_path))
+        with rasterio.Env.from_defaults(
+                **gdal_options([ref_path], gdal_cache)):
+            if cache is None:
+                ref_profile = reference_profile(
+                    ref_path, (color_space,), bands, method)
+            else:
+                bixs = parse_bands(bands, _band_count(ref_path, color_space))
+                ref_profile = {color_space.lower(): _cached_reference(
+                    cache, ref_path, color_space, bixs, bands, method=method,
+                    work_dtype='float64', conversion='exact',
+                    sample_resolution=None, max_samples=None, windowed=True)}
+
+    worker_args = dict(
+        match_proportion=match_proportion,
+        creation_options=creation_options, bands=bands,
+        color_space=color_space, windowed=windowed, method=method,
+        ref_profile=ref_profile, cog=cog, read_threads=read_threads,
+        gdal_cache=gdal_cache, cache=cache)
+
+    if jobs == 1:
+        _init_worker(worker_args)
+        return [_match_one(task) for task in tasks]
+
+    pool = multiprocessing.Pool(
+        jobs, initializer=_init_worker, initargs=(worker_args,))
+    try:
+        return pool.map(_match_one, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,261 @@
+"""On-disk cache of matched outputs and reference histograms
+
+Reprocessing runs match the same sources to the same references with
+the same parameters over and over. A ResultCache keys each job on a
+fingerprint of its inputs (the size and modification time of local
+files, or a checksum of their content) and of every parameter that
+changes the output, so that hist_match_worker can copy, or hard link, a
+cached output instead of matching again. Reference histograms are
+cached the same way, so that a reference is read once for many
+sources.
+
+Entries are files in the results and histograms subdirectories of the
+cache directory, written then renamed so that concurrent jobs never see
+partial files. When the entries grow beyond the size of the cache, the
+least recently used ones (by modification time, updated on each hit)
+are removed.
+"""
+from __future__ import division, absolute_import
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from . import __version__
+
+logger = logging.getLogger(__name__)
+
+# default size of a ResultCache, in bytes
+DEFAULT_MAX_BYTES = 10 * 2 ** 30
+
+# bytes read at a time when computing checksums
+_CHECKSUM_CHUNK = 2 ** 20
+
+_SUBDIRS = ('results', 'histograms')
+
+
+def cache_dir():
+    """Directory of cached tables, or None if caching on disk is disabled
+
+    Set RIO_HIST_CACHE_DIR to an empty string to disable it.
+    """
+    path = os.environ.get('RIO_HIST_CACHE_DIR')
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'rio-hist')
+    return path or None
+
+
+def _profile_digest(profile, digest):
+    """Update digest with the histograms of a reference profile"""
+    for cs in sorted(profile):
+        for b in sorted(profile[cs]):
+            values, counts = profile[cs][b]
+            digest.update("{}_{}".format(cs, b).encode('utf-8'))
+            for arr in (values, counts):
+                digest.update(str(arr.dtype).encode('utf-8'))
+                digest.update(arr.tobytes())
+
+
+def fingerprint(source, checksum=False):
+    """
+    Fingerprint of an input of a job
+
+    Parameters:
+    -----------
+        source: str or dict
+            path of a local file, or a reference profile
+        checksum: bool
+            True to fingerprint files by a SHA-256 checksum of their
+            content rather than by their size and modification time
+
+    Returns:
+    -----------
+        fingerprint: str, or None if source is a remote path, which
+            can't be fingerprinted without reading it
+    """
+    from .reader import is_remote
+
+    if isinstance(source, dict):
+        digest = hashlib.sha256()
+        _profile_digest(source, digest)
+        return 'profile:' + digest.hexdigest()
+    if is_remote(source):
+        return None
+
+    path = os.path.abspath(source)
+    if not checksum:
+        st = os.stat(path)
+        return '{}:{}:{}'.format(path, st.st_size, st.st_mtime_ns)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHECKSUM_CHUNK), b''):
+            digest.update(chunk)
+    return 'sha256:' + digest.hexdigest()
+
+
+def _replace_with(src, dst, link):
+    """Replace dst by a hard link to src, or a copy of it, through a
+    temporary file next to dst"""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        # already linked; os.replace would leave tmp behind
+        return
+    tmp = "{}.{}.tmp".format(dst, os.getpid())
+    if link:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            # across file systems, for instance
+            logger.debug("Could not link {}, copying it".format(src))
+            link = False
+    if not link:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ResultCache(object):
+    """
+    Cache of matched outputs and reference histograms
+
+    Parameters:
+    -----------
+        directory: str, optional
+            cache directory; by default that of cache_dir()
+        max_bytes: int
+            size of the entries above which the least recently used
+            are removed
+        checksum: bool
+            fingerprint files by their content (see fingerprint)
+        link: bool
+            hard link cached outputs to the destination, and outputs to
+            the cache, instead of copying them. Linked entries, and so
+            the outputs linked to them, are made read-only so that
+            they are not modified in place. Outputs written again are
+            replaced, as GDAL deletes existing files before creating
+            them, which leaves their entries unchanged.
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES,
+                 checksum=False, link=False):
+        if directory is None:
+            directory = cache_dir()
+        if directory is None:
+            raise ValueError("caching on disk is disabled")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.checksum = checksum
+        self.link = link
+
+    def key(self, sources, params):
+        """Key of a job, from its input files or profiles and a dict of
+        the parameters that change its result; None if an input can't
+        be fingerprinted"""
+        prints = [fingerprint(s, self.checksum) for s in sources]
+        if any(p is None for p in prints):
+            return None
+        text = json.dumps([__version__, prints, params], sort_keys=True,
+                          default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, key)
+
+    def _hit(self, path):
+        """True if path is an entry, marking it as recently used"""
+        try:
+            os.utime(path, None)
+        except OSError:
+            return False
+        return True
+
+    def get_output(self, key, dst_path):
+        """Write the cached output of key to dst_path, returning False
+        if there is none"""
+        path = self._path('results', key)
+        if not self._hit(path):
+            return False
+        logger.info("Using cached output {}".format(path))
+        _replace_with(path, dst_path, self.link)
+        return True
+
+    def put_output(self, key, dst_path):
+        """Cache dst_path as the output of key"""
+        path = self._path('results', key)
+
+        def write(tmp):
+            _replace_with(dst_path, tmp, self.link)
+            if self.link:
+                os.chmod(tmp, 0o444)
+
+        self._store(path, write)
+
+    def get_histograms(self, key, color_space, bixs):
+        """Cached histograms of key, as by profile_histograms, or None"""
+        from .reference import load_profile, profile_histograms
+
+        path = self._path('histograms', key)
+        if not self._hit(path):
+            return None
+        logger.debug("Using cached histograms {}".format(path))
+        try:
+            return profile_histograms(load_profile(path), color_space, bixs)
+        except (IOError, ValueError):
+            logger.warning("Ignoring unreadable histograms {}".format(path))
+            return None
+
+    def put_histograms(self, key, color_space, hists):
+        """Cache the histograms of key, a dict of band index ->
+        (values, counts)"""
+        from .reference import save_profile
+
+        path = self._path('histograms', key)
+        self._store(
+            path, lambda tmp: save_profile(tmp, {color_space.lower(): hists}))
+
+    def _store(self, path, write):
+        """Write an entry through write(tmp_path), then evict"""
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            write(tmp)
+            os.replace(tmp, path)
+        except (IOError, OSError):
+            logger.warning("Could not cache {}".format(path))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.evict()
+
+    def entries(self):
+        """(mtime, size, path) of the entries, least recently used first"""
+        entries = []
+        for kind in _SUBDIRS:
+            directory = os.path.join(self.directory, kind)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove the least recently used entries until they fit in
+        max_bytes"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            logger.debug("Evicting {}".format(path))
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
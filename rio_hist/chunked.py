@@ -0,0 +1,115 @@
+"""Histogram matching of chunked arrays
+
+histogram_match needs whole arrays. Here matching is split in two
+steps that work on chunks:
+
+1. compute_cdf reduces the value counts of chunks to one histogram.
+   Partial histograms (value_counts of a chunk) are merged with
+   merge_histograms, which is associative, so they may be computed on
+   any number of workers and merged in any grouping.
+2. build_mapping turns the source and reference histograms into a
+   mapping from source values to matched values, which apply_mapping
+   applies to each chunk independently (both are defined in
+   rio_hist.histogram, where histogram_match uses them too).
+
+dask_histogram_match runs these steps over dask arrays (or the dask
+arrays of xarray DataArrays, DataArray.data) as a single graph.
+"""
+from __future__ import division, absolute_import
+import logging
+
+from .histogram import (
+    _MERGE_EVERY, apply_mapping, build_mapping, merge_histograms,
+    value_counts)
+
+logger = logging.getLogger(__name__)
+
+
+def compute_cdf(chunks, method='auto', bins=65536):
+    """
+    Histogram of the unmasked values of chunks of an array, from which
+    the array's cumulative distribution function is computed
+
+    Parameters:
+    -----------
+        chunks: iterable of np.ndarray
+            chunks of the array, in any order; masked arrays are
+            counted on their unmasked values
+        method: str, 'unique', 'bincount' or 'auto'
+            see histogram_match
+        bins: int
+            number of bins for the quantized 'bincount' method
+
+    Returns:
+    -----------
+        values, counts: np.ndarray
+            sorted unique values and their counts, see value_counts
+    """
+    partial = []
+    for chunk in chunks:
+        partial.append(value_counts(chunk, method, bins))
+        if len(partial) >= _MERGE_EVERY:
+            partial = [merge_histograms(partial)]
+    if not partial:
+        raise ValueError("no chunks to count")
+    return merge_histograms(partial)
+
+
+def _tree_merge(histograms, delayed):
+    """Merge delayed histograms in a tree of merge_histograms tasks"""
+    merge = delayed(merge_histograms)
+    while len(histograms) > 1:
+        histograms = [merge(histograms[i:i + _MERGE_EVERY])
+                      for i in range(0, len(histograms), _MERGE_EVERY)]
+    return histograms[0]
+
+
+def _dask_histogram(arr, method, bins):
+    """Delayed histogram of a dask array, or of a np.ndarray"""
+    from dask import delayed
+    from dask.array import Array
+
+    if not isinstance(arr, Array):
+        return value_counts(arr, method, bins)
+    count = delayed(value_counts)
+    return _tree_merge(
+        [count(block, method, bins) for block in arr.to_delayed().ravel()],
+        delayed)
+
+
+def dask_histogram_match(source, reference, match_proportion=1.0,
+                         method='auto', bins=65536):
+    """
+    Lazily adjust the values of a dask array so that its histogram
+    matches that of a reference
+
+    The histograms of the blocks are counted and merged in a tree of
+    tasks, and the blocks are matched independently, in the same graph.
+    Requires dask.
+
+    Parameters:
+    -----------
+        source: dask.array.Array
+        reference: dask.array.Array, np.ndarray or (values, counts) tuple
+            the reference array or its histogram, see value_counts
+        match_proportion: float, range 0..1
+        method: str, 'unique', 'bincount' or 'auto'
+            see histogram_match
+        bins: int
+            number of bins for the quantized 'bincount' method
+
+    Returns:
+    -----------
+        target: dask.array.Array
+            float64 array of the shape and chunks of source
+    """
+    from dask import delayed
+
+    if method not in ('unique', 'bincount', 'auto'):
+        raise ValueError("Unknown histogram method: {}".format(method))
+
+    if not isinstance(reference, tuple):
+        reference = _dask_histogram(reference, method, bins)
+    mapping = delayed(build_mapping)(
+        _dask_histogram(source, method, bins), reference, match_proportion)
+    return source.map_blocks(apply_mapping, mapping, dtype='float64')
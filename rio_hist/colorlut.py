@@ -0,0 +1,197 @@
+"""Color space conversion through precomputed lookup tables
+
+The forward table holds the color space coordinates of every 8-bit RGB
+color, so converting 8-bit input is a table lookup, exact up to the
+float32 storage of the table.
+
+The backward table holds the 8-bit RGB color of each node of a regular
+grid spanning the color space coordinates of the RGB cube; values are
+converted to the color of their nearest node. Nearest node lookup is
+several times faster than convert_arr where trilinear interpolation of
+float tables, in numpy, is not.
+
+Tables are cached in memory and, unless disabled, in the directory named
+by the RIO_HIST_CACHE_DIR environment variable (default
+~/.cache/rio-hist) so that they are built once per machine.
+"""
+from __future__ import division, absolute_import
+import logging
+import os
+
+import numpy as np
+from rio_color.colorspace import convert_arr, ColorSpace
+
+from .cache import cache_dir
+from .utils import _COLOR_SPACES
+
+logger = logging.getLogger(__name__)
+
+# nodes per axis of the backward table
+BACKWARD_SIZE = 256
+
+# nodes per axis of the RGB cube sampled for the backward table's extent
+_EXTENT_SIZE = 65
+
+# pixels per chunk when building and applying tables
+_CHUNK_PIXELS = 2 ** 18
+
+# color spaces linear in light, whose backward table nodes are spaced
+# evenly in the cube root of the coordinates so that dark colors are
+# sampled as finely as light ones
+_CUBE_ROOT = ('xyz', )
+
+_tables = {}
+
+
+def _cached(name, build):
+    """Get a table from memory, the disk cache or by building it"""
+    if name in _tables:
+        return _tables[name]
+
+    directory = cache_dir()
+    path = os.path.join(directory, name + '.npy') if directory else None
+    table = None
+    if path and os.path.exists(path):
+        logger.debug("Loading {}".format(path))
+        try:
+            table = np.load(path, mmap_mode='r')
+        except (IOError, ValueError):
+            logger.warning("Ignoring unreadable table {}".format(path))
+
+    if table is None:
+        logger.info("Building color conversion table {}".format(name))
+        table = build()
+        if path:
+            try:
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                # write then rename so that readers never see partial files
+                tmp = "{}.{}.tmp".format(path, os.getpid())
+                with open(tmp, 'wb') as f:
+                    np.save(f, table)
+                os.rename(tmp, path)
+            except (IOError, OSError):
+                logger.warning("Could not cache table to {}".format(path))
+
+    _tables[name] = table
+    return table
+
+
+def _convert(arr, src, dst, out):
+    """convert_arr of a (n, 3) array, in chunks, into a (n, 3) out"""
+    for start in range(0, arr.shape[0], _CHUNK_PIXELS):
+        chunk = arr[start:start + _CHUNK_PIXELS]
+        chunk = np.ascontiguousarray(chunk.T, dtype='float64')[:, np.newaxis]
+        out[start:start + _CHUNK_PIXELS] = convert_arr(chunk, src, dst)[:, 0].T
+    return out
+
+
+def _grid(axes):
+    """(n, 3) array of the nodes of a grid, the last axis varying fastest"""
+    mesh = np.meshgrid(*axes, indexing='ij')
+    return np.stack([m.ravel() for m in mesh], axis=1)
+
+
+def forward_table(cs):
+    """(256 ** 3, 3) float32 color space coordinates of the 8-bit RGB
+    colors, indexed by r * 65536 + g * 256 + b
+    """
+    cs = cs.lower()
+
+    def build():
+        levels = np.arange(256, dtype='float64') / 255
+        out = np.empty((256 ** 3, 3), dtype='float32')
+        return _convert(_grid([levels] * 3), ColorSpace.rgb,
+                        _COLOR_SPACES[cs], out)
+
+    return _cached('forward_{}'.format(cs), build)
+
+
+def backward_extent(cs):
+    """(2, 3) lower and upper bounds of the color space coordinates
+    of the RGB cube
+    """
+    cs = cs.lower()
+
+    def build():
+        levels = np.linspace(0, 1, _EXTENT_SIZE)
+        coords = _convert(_grid([levels] * 3), ColorSpace.rgb,
+                          _COLOR_SPACES[cs],
+                          np.empty((_EXTENT_SIZE ** 3, 3), dtype='float64'))
+        # black has no hue, its coordinates may be nan
+        return np.array([np.nanmin(coords, axis=0),
+                         np.nanmax(coords, axis=0)])
+
+    return _cached('extent_{}'.format(cs), build)
+
+
+def _grid_extent(cs):
+    """Bounds of the backward table's grid, see _CUBE_ROOT"""
+    lo, hi = backward_extent(cs)
+    if cs in _CUBE_ROOT:
+        return np.cbrt(lo), np.cbrt(hi)
+    return lo, hi
+
+
+def backward_table(cs, size=BACKWARD_SIZE):
+    """(size ** 3, 3) uint8 RGB colors of the nodes of a regular grid
+    spanning backward_extent(cs)
+    """
+    cs = cs.lower()
+
+    def build():
+        lo, hi = _grid_extent(cs)
+        axes = [np.linspace(lo[i], hi[i], size) for i in range(3)]
+        if cs in _CUBE_ROOT:
+            axes = [a ** 3 for a in axes]
+        rgb = _convert(_grid(axes), _COLOR_SPACES[cs], ColorSpace.rgb,
+                       np.empty((size ** 3, 3), dtype='float64'))
+        # as cs_backward does
+        rgb *= 255
+        return rgb.astype('uint8')
+
+    return _cached('backward_{}_{}'.format(cs, size), build)
+
+
+def lut_forward(arr, cs, dtype='float64'):
+    """8-bit (3, rows, cols) RGB to the color space cs, as dtype"""
+    if arr.dtype != np.uint8:
+        raise ValueError("lookup tables require 8-bit input")
+    table = forward_table(cs)
+    flat = arr.reshape(3, -1)
+    out = np.empty(arr.shape, dtype=dtype)
+    flat_out = out.reshape(3, -1)
+    for start in range(0, flat.shape[1], _CHUNK_PIXELS):
+        chunk = flat[:, start:start + _CHUNK_PIXELS].astype(np.intp)
+        index = (chunk[0] << 16) | (chunk[1] << 8) | chunk[2]
+        flat_out[:, start:start + _CHUNK_PIXELS] = table[index].T
+    return out
+
+
+def lut_backward(arr, cs, size=BACKWARD_SIZE):
+    """(3, rows, cols) color space coordinates to 8-bit RGB
+
+    Coordinates outside the extent of the table are clipped to it.
+    """
+    cs = cs.lower()
+    table = backward_table(cs, size)
+    lo, hi = _grid_extent(cs)
+    scale = ((size - 1) / (hi - lo))[:, np.newaxis]
+    offset = 0.5 - lo[:, np.newaxis] * scale
+    flat = arr.reshape(3, -1)
+    out = np.empty(arr.shape, dtype='uint8')
+    flat_out = out.reshape(3, -1)
+    for start in range(0, flat.shape[1], _CHUNK_PIXELS):
+        # index of the nearest node along each axis
+        coords = flat[:, start:start + _CHUNK_PIXELS]
+        if cs in _CUBE_ROOT:
+            coords = np.cbrt(coords)
+        coords = coords * scale + offset
+        # hue is nan for black in some color spaces; any node of its
+        # lightness will do
+        np.nan_to_num(coords, copy=False, nan=0)
+        np.clip(coords, 0, size - 1, out=coords)
+        nodes = coords.astype(np.intp)
+        index = (nodes[0] * size + nodes[1]) * size + nodes[2]
+        flat_out[:, start:start + _CHUNK_PIXELS] = table[index].T
+    return out
@@ -0,0 +1,593 @@
+"""Histograms and histogram matching of arrays
+
+value_counts counts the values of an array, exactly or in equal bins
+(see histogram_match for the methods), and merge_histograms merges the
+histograms of parts of an array. build_mapping turns a source and a
+reference histogram into a mapping of source values to matched values,
+which apply_mapping applies to any number of arrays or blocks;
+histogram_match does both for a whole array.
+
+_BandHistogram accumulates the histogram of a band block by block in
+bounded memory, for the windowed engine (rio_hist.windowed) as for
+arrays in memory (rio_hist.match).
+"""
+from __future__ import division, absolute_import
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# number of per-window histograms to hold before collapsing them
+_MERGE_EVERY = 64
+
+# largest number of distinct values of the exact histograms accumulated
+# block by block with the 'auto' method; beyond it, they are binned
+_MAX_EXACT_VALUES = 2 ** 18
+
+# elements per chunk of integer counting and lookups; numpy makes an
+# intp copy of integer indices, so these are done in chunks
+_INDEX_CHUNK = 2 ** 16
+
+
+def histogram_match(source, reference, match_proportion=1.0,
+                    method='auto', bins=65536, valid=None, dtype='float64'):
+    """
+    Adjust the values of a source array
+    so that its histogram matches that of a reference array
+
+    Parameters:
+    -----------
+        source: np.ndarray
+        reference: np.ndarray or (values, counts) tuple
+            the reference array or its histogram, see value_counts
+        match_proportion: float, range 0..1
+        method: str, 'unique', 'bincount' or 'auto'
+            'unique' sorts the arrays to find their exact histograms.
+            'bincount' counts values on integer levels in linear time.
+            Integer arrays and float arrays of 8 or 16-bit levels
+            (multiples of 1/255 or 1/65535, as made by cs_forward in
+            the RGB color space) are counted exactly and give the same
+            result as 'unique'. Other float arrays are quantized into
+            `bins` equal-width bins over their range, which moves each
+            value by at most half a bin width before matching.
+            'auto' uses 'bincount' when it is exact and 'unique' otherwise.
+        bins: int
+            number of bins for the quantized 'bincount' method
+        valid: np.ndarray of bool, optional
+            True where source pixels are valid, an alternative to a
+            masked source without the overhead of masked arrays. Only
+            valid pixels are counted and matched; the others are
+            returned unchanged.
+        dtype: str or np.dtype
+            float dtype of the target, for instance the work dtype of
+            the color space arrays; values are matched in float64
+
+    Returns:
+    -----------
+        target: np.ndarray
+            The output array with the same shape as source
+            but adjusted so that its histogram matches the reference
+    """
+    if method not in ('unique', 'bincount', 'auto'):
+        raise ValueError("Unknown histogram method: {}".format(method))
+
+    if valid is not None:
+        # matched values are floats, whatever the dtype of source
+        target = np.array(source, dtype=dtype)
+        target[valid] = histogram_match(
+            source[valid], reference, match_proportion, method, bins,
+            dtype=dtype)
+        return target
+
+    orig_shape = source.shape
+    source = source.ravel()
+
+    if isinstance(reference, tuple):
+        logger.debug("ref is a histogram")
+        r_values, r_counts = reference
+    else:
+        r_values, r_counts = value_counts(reference, method, bins)
+
+    if method != 'unique':
+        if np.ma.is_masked(source):
+            s_valid = source.compressed()
+        else:
+            s_valid = np.ma.getdata(source)
+        s_quant = _quantization(s_valid, bins)
+        if method == 'auto':
+            method = 'bincount' if s_quant[-1] else 'unique'
+        logger.debug("Using {} histogram method".format(method))
+
+    if method == 'bincount':
+        target = _bincount_match(
+            source, s_valid, s_quant, r_values, r_counts,
+            match_proportion).astype(dtype, copy=False)
+    else:
+        target = _unique_match(
+            source, r_values, r_counts, match_proportion, dtype)
+
+    if np.ma.is_masked(source):
+        logger.debug("source is masked, remask those pixels")
+        mask = np.ma.getmaskarray(source)
+        np.copyto(target, source.fill_value, where=mask)
+        target = np.ma.masked_where(mask, target)
+        target.fill_value = source.fill_value
+
+    return target.reshape(orig_shape)
+
+
+def value_counts(arr, method='auto', bins=65536):
+    """
+    Histogram of the unmasked values of an array
+
+    Parameters:
+    -----------
+        arr: np.ndarray
+        method: str, 'unique', 'bincount' or 'auto'
+            see histogram_match
+        bins: int
+            number of bins for the quantized 'bincount' method
+
+    Returns:
+    -----------
+        values: np.ndarray
+            sorted unique values
+        counts: np.ndarray
+            number of occurrences of each value
+    """
+    if np.ma.is_masked(arr):
+        logger.debug("array is masked, compressing")
+        arr = arr.compressed()
+    else:
+        logger.debug("array is unmasked, raveling")
+        arr = np.ma.getdata(arr).ravel()
+
+    if method != 'unique':
+        origin, divisor, nlevels, exact = _quantization(arr, bins)
+        if method == 'bincount' or exact:
+            counts = np.bincount(
+                _levels(arr, origin, divisor, nlevels), minlength=nlevels)
+            values = (origin + np.arange(nlevels)) / divisor
+            nonzero = counts > 0
+            return values[nonzero], counts[nonzero]
+
+    return np.unique(arr, return_counts=True)
+
+
+def _unique_match(source, r_values, r_counts, match_proportion,
+                  dtype='float64'):
+    """Exact histogram matching by sorting the source array
+
+    The sorting permutation scatters the matched values back to the
+    pixels, which is faster than looking up each pixel in a mapping of
+    many values and needs no inverse index array.
+    """
+    masked = np.ma.is_masked(source)
+    data = source.compressed() if masked else np.ma.getdata(source)
+
+    logger.debug("Get unique pixel values")
+    order, s_values, s_counts = _sorted_counts(data)
+    mapped = build_mapping(
+        (s_values, s_counts), (r_values, r_counts), match_proportion)[1]
+
+    logger.debug("create target array from the sorted order")
+    matched = np.empty(data.size, dtype=dtype)
+    # scattered chunk by chunk of the sorted order rather than from a
+    # full size np.repeat of the mapped values
+    ends = np.cumsum(s_counts)
+    for start in range(0, data.size, _INDEX_CHUNK):
+        stop = min(start + _INDEX_CHUNK, data.size)
+        first = np.searchsorted(ends, start, side='right')
+        last = np.searchsorted(ends, stop - 1, side='right') + 1
+        repeats = (np.minimum(ends[first:last], stop) -
+                   np.maximum(ends[first:last] - s_counts[first:last], start))
+        matched[order[start:stop]] = np.repeat(mapped[first:last], repeats)
+    if not masked:
+        return matched
+    # masked pixels are filled by histogram_match
+    target = np.empty(source.size, dtype=matched.dtype)
+    target[~np.ma.getmaskarray(source)] = matched
+    return target
+
+
+def _sorted_counts(arr):
+    """Sorting permutation of a 1D array, and its sorted unique values
+    and their counts as given by np.unique (NaNs are one value)"""
+    order = np.argsort(arr)
+    ordered = arr[order]
+    first = np.empty(ordered.size, dtype=bool)
+    first[:1] = True
+    np.not_equal(ordered[1:], ordered[:-1], out=first[1:])
+    if ordered.dtype.kind == 'f' and ordered.size and np.isnan(ordered[-1]):
+        # NaNs are sorted last
+        first[np.searchsorted(ordered, np.nan) + 1:] = False
+    starts = np.flatnonzero(first)
+    values = ordered[starts]
+    del ordered, first
+    return order, values, np.diff(np.append(starts, arr.size))
+
+
+# integer levels that float arrays are tested against, see cs_forward
+_FLOAT_LEVELS = (255.0, 65535.0)
+
+# largest number of levels counted exactly
+_MAX_LEVELS = 2 ** 24
+
+
+def _quantization(arr, bins):
+    """Integer levels on which to count the values of a 1D array
+
+    Returns (origin, divisor, nlevels, exact): the levels of arr are
+    rint(arr * divisor - origin) and level j stands for the value
+    (origin + j) / divisor. exact is True if every value of arr is
+    exactly the value of its level.
+    """
+    if arr.size == 0:
+        return 0.0, 1.0, 1, True
+    lo, hi = np.nanmin(arr), np.nanmax(arr)
+    if np.issubdtype(arr.dtype, np.integer):
+        if int(hi) - int(lo) < _MAX_LEVELS:
+            return float(lo), 1.0, int(hi) - int(lo) + 1, True
+    else:
+        for divisor in _FLOAT_LEVELS:
+            # test a small sample first to fail fast
+            sample = arr[:1024]
+            if not _on_levels(sample, divisor):
+                continue
+            origin = np.rint(lo * divisor)
+            nlevels = int(np.rint(hi * divisor) - origin) + 1
+            # floats with a wide range (RAW values) are not counted on levels
+            if nlevels <= _MAX_LEVELS and _on_levels(arr, divisor):
+                return origin, divisor, nlevels, True
+    if hi == lo:
+        return float(lo), 1.0, 1, True
+    divisor = (bins - 1) / (float(hi) - float(lo))
+    return float(lo) * divisor, divisor, bins, False
+
+
+# bounds of each band of the float color spaces: those of the
+# coordinates of the RGB cube (see rio_hist.colorlut.backward_extent),
+# rounded out. Values beyond them are counted in the first or last bin.
+FLOAT_RANGES = {
+    'lch': ((0.0, 100.0), (0.0, 135.0), (-np.pi, np.pi)),
+    'lab': ((0.0, 100.0), (-90.0, 100.0), (-110.0, 100.0)),
+    'luv': ((0.0, 100.0), (-80.0, 195.0), (-135.0, 110.0)),
+    'xyz': ((0.0, 1.0), (0.0, 1.0), (0.0, 1.0))}
+
+
+def _bin_quantization(lo, hi, bins):
+    """(origin, divisor) of bins equal bins over lo..hi, see
+    _quantization; levels stand for the bin centers"""
+    divisor = bins / (hi - lo)
+    return lo * divisor + 0.5, divisor
+
+
+def _on_levels(arr, divisor):
+    """True if every value of arr is a multiple of 1 / divisor"""
+    scaled = arr * divisor
+    np.rint(scaled, out=scaled)
+    scaled /= divisor
+    return np.array_equal(scaled, arr)
+
+
+def _levels(arr, origin, divisor, nlevels):
+    """Level index of each value of arr, clipped to the valid levels
+
+    NaNs are counted in the highest level, as np.unique sorts them last.
+    """
+    levels = arr * divisor
+    levels -= origin
+    np.rint(levels, out=levels)
+    np.clip(levels, 0, nlevels - 1, out=levels)
+    levels[np.isnan(levels)] = nlevels - 1
+    return levels.astype(np.intp)
+
+
+def _bincount_match(source, s_valid, s_quant, r_values, r_counts,
+                    match_proportion):
+    """Histogram matching by counting source values on integer levels"""
+    s_origin, s_divisor, s_nlevels, exact = s_quant
+
+    logger.debug("Count pixel values by level")
+    s_counts = np.bincount(
+        _levels(s_valid, s_origin, s_divisor, s_nlevels), minlength=s_nlevels)
+    s_values = (s_origin + np.arange(s_nlevels)) / s_divisor
+
+    # empty source levels don't move the cdf. The values of exact levels
+    # are the source values, so match_proportion can be applied to the
+    # table; quantized values are moved from their own value below.
+    lut = build_mapping((s_values, s_counts), (r_values, r_counts),
+                        match_proportion if exact else 1.0)[1]
+
+    logger.debug("create target array from lookup table")
+    data = np.ma.getdata(source)
+    target = np.empty(data.shape, dtype=lut.dtype)
+    for start in range(0, data.size, _INDEX_CHUNK):
+        chunk = slice(start, start + _INDEX_CHUNK)
+        np.take(lut, _levels(data[chunk], s_origin, s_divisor, s_nlevels),
+                out=target[chunk])
+    if not exact and match_proportion is not None and match_proportion != 1:
+        # target = data - (data - target) * match_proportion, in place
+        np.subtract(data, target, out=target)
+        target *= match_proportion
+        np.subtract(data, target, out=target)
+    return target
+
+
+def cdf_match_values(s_values, s_counts, r_values, r_counts):
+    """
+    Find the reference values at the quantiles of the source values
+
+    Parameters:
+    -----------
+        s_values, s_counts: np.ndarray
+            sorted unique source values and their counts
+        r_values, r_counts: np.ndarray
+            sorted unique reference values and their counts
+
+    Returns:
+    -----------
+        interp_r_values: np.ndarray
+            matched value for each of s_values, the values themselves
+            if the source histogram is empty
+    """
+    if not np.any(s_counts):
+        # an entirely masked source has nothing to match
+        return np.array(s_values, dtype=np.float64)
+
+    # take the cumsum of the counts; empirical cumulative distribution
+    logger.debug("calculate cumulative distribution")
+    s_quantiles = np.cumsum(s_counts, dtype=np.float64)
+    s_quantiles /= np.sum(s_counts)
+    r_quantiles = np.cumsum(r_counts, dtype=np.float64)
+    r_quantiles /= np.sum(r_counts)
+
+    # find values in the reference corresponding to the quantiles in the source
+    logger.debug("interpolate values from source to reference by cdf")
+    return np.interp(s_quantiles, r_quantiles, r_values)
+
+
+def build_mapping(source_hist, reference_hist, match_proportion=1.0):
+    """
+    Mapping of source values to values matched to a reference
+
+    The mapping is computed once from the histograms and applied to any
+    number of arrays or blocks with apply_mapping.
+
+    Parameters:
+    -----------
+        source_hist, reference_hist: (np.ndarray, np.ndarray)
+            (values, counts) histograms, see value_counts
+        match_proportion: float, range 0..1
+
+    Returns:
+    -----------
+        values, mapped: np.ndarray
+            sorted source values and their matched values
+    """
+    s_values, s_counts = source_hist
+    r_values, r_counts = reference_hist
+    mapped = cdf_match_values(s_values, s_counts, r_values, r_counts)
+    # interpolation b/t target and source
+    # 1.0 = full histogram match
+    # 0.0 = no change
+    if match_proportion is not None and match_proportion != 1:
+        diff = s_values - mapped
+        mapped = s_values - (diff * match_proportion)
+    return s_values, mapped
+
+
+def apply_mapping(arr, mapping, valid=None, out=None, interpolate=None):
+    """
+    Replace the values of an array through a mapping
+
+    Values are looked up with np.searchsorted, or in a lookup table
+    indexed by value if arr and the values of the mapping are integers,
+    in chunks, so that the only temporary arrays are of the size of a
+    chunk.
+
+    Parameters:
+    -----------
+        arr: np.ndarray
+        mapping: (np.ndarray, np.ndarray)
+            (values, mapped) mapping, see build_mapping
+        valid: np.ndarray of bool, optional
+            True where arr is valid; the others are copied unchanged
+        out: np.ndarray, optional
+            C-contiguous array of the shape of arr, which may be arr
+            itself, to write the result to
+        interpolate: bool or None
+            True interpolates every value linearly between the values
+            of the mapping. False looks values up, which must be in the
+            mapping. None (default) looks values up and interpolates
+            those chunks with values that are not in the mapping, such
+            as values counted with the quantized 'bincount' method.
+
+    Returns:
+    -----------
+        target: np.ndarray
+            out, or a new array of the dtype of mapped
+    """
+    values, mapped = mapping
+    if out is None:
+        out = np.empty(np.shape(arr), dtype=mapped.dtype)
+    elif out.shape != np.shape(arr) or not out.flags.c_contiguous:
+        raise ValueError("out must be C-contiguous, of the shape of arr")
+
+    if values.size == 0:
+        # the mapping of an entirely masked source, with nothing to map
+        if out is not arr:
+            np.copyto(out, arr, casting='unsafe')
+        return out
+
+    if valid is not None:
+        if out is not arr:
+            np.copyto(out, arr, casting='unsafe')
+        out[valid] = apply_mapping(arr[valid], mapping,
+                                   interpolate=interpolate)
+        return out
+
+    flat, flat_out = np.ravel(arr), out.reshape(-1)
+    lut = _integer_lut(flat, values, mapped)
+    for start in range(0, flat.size, _INDEX_CHUNK):
+        chunk = flat[start:start + _INDEX_CHUNK]
+        if lut is not None:
+            offset, table = lut
+            idx = chunk.astype(np.intp)
+            idx -= offset
+            np.clip(idx, 0, table.size - 1, out=idx)
+            matched = table[idx]
+        elif interpolate:
+            matched = np.interp(chunk, values, mapped)
+        else:
+            idx = np.searchsorted(values, chunk)
+            np.clip(idx, 0, values.size - 1, out=idx)
+            if interpolate is None and not np.array_equal(values[idx], chunk):
+                logger.debug("values not in mapping, interpolating")
+                matched = np.interp(chunk, values, mapped)
+            else:
+                matched = mapped[idx]
+        flat_out[start:start + _INDEX_CHUNK] = matched
+    return out
+
+
+def _integer_lut(arr, values, mapped):
+    """(offset, table) lookup table of a mapping of integer values,
+    or None if arr or the values are not integers or span more levels
+    than arr has elements
+
+    Levels between values are interpolated, as are those of the
+    mapping by np.interp, so the table gives the same result as
+    apply_mapping with any interpolate.
+    """
+    if not (np.issubdtype(arr.dtype, np.integer) and
+            np.issubdtype(values.dtype, np.integer)) or values.size == 0:
+        return None
+    lo, hi = int(values[0]), int(values[-1])
+    if hi - lo >= min(_MAX_LEVELS, max(arr.size, _INDEX_CHUNK)):
+        return None
+    return lo, np.interp(np.arange(lo, hi + 1), values, mapped)
+
+
+def merge_histograms(histograms):
+    """
+    Merge (values, counts) histograms into a single sorted histogram
+
+    Parameters:
+    -----------
+        histograms: sequence of (np.ndarray, np.ndarray)
+            integer counts, or float (weighted) counts
+
+    Returns:
+    -----------
+        values, counts: np.ndarray
+            counts are int64 if all input counts are integers,
+            float64 otherwise
+    """
+    if len(histograms) == 1:
+        return histograms[0]
+    values = np.concatenate([v for v, _ in histograms])
+    counts = np.concatenate([c for _, c in histograms])
+    dtype = 'int64' if np.issubdtype(counts.dtype, np.integer) else 'float64'
+    values, idx = np.unique(values, return_inverse=True)
+    counts = np.bincount(idx.ravel(), weights=counts, minlength=values.size)
+    return values, counts.astype(dtype)
+
+
+class _BandHistogram(object):
+    """Histogram of a band accumulated block by block in bounded memory
+
+    With the 'bincount' method, values are counted in the bins of a
+    grid fixed for the whole band, grid(b) (see
+    rio_hist.windowed._band_grid), so that the histogram has at most
+    bins values whatever the number of blocks. With 'unique', the exact
+    histograms of blocks are merged. With 'auto', they are merged until
+    they have more than max_values distinct values, then binned as with
+    'bincount', so that memory does not grow with the size of the
+    raster.
+    """
+
+    def __init__(self, method, grid, b, bins=65536,
+                 max_values=_MAX_EXACT_VALUES):
+        self.method = method
+        self.bins = bins
+        self.max_values = max_values
+        self._grid = lambda: grid(b)
+        self._partial = []
+        self._size = 0
+        # (origin, divisor) and dense counts once values are binned
+        self._quant = self._counts = None
+
+    def add(self, band):
+        """Count the values of a 1D or 2D array"""
+        if self._counts is None and self.method == 'bincount' and \
+                not self._partial:
+            self._bin()
+        if self._counts is not None:
+            origin, divisor = self._quant
+            self._counts += np.bincount(
+                _levels(band.ravel(), origin, divisor, self.bins),
+                minlength=self.bins)
+            return
+        hist = value_counts(band, self.method)
+        self._partial.append(hist)
+        self._size += hist[0].size
+        if self._size > self.max_values or \
+                len(self._partial) >= _MERGE_EVERY:
+            merged = merge_histograms(self._partial)
+            self._partial, self._size = [merged], merged[0].size
+            if self.method != 'unique' and self._size > self.max_values:
+                logger.debug("Binning a histogram of {} values".format(
+                    self._size))
+                self._bin()
+
+    def _bin(self):
+        """Bin the values counted so far, and those counted from now
+        on, unless grid(b) is None"""
+        self._quant = self._grid()
+        if self._quant is None:
+            return
+        origin, divisor = self._quant
+        self._counts = np.zeros(self.bins, dtype='int64')
+        for values, counts in self._partial:
+            binned = np.bincount(_levels(values, origin, divisor, self.bins),
+                                 weights=counts, minlength=self.bins)
+            self._counts += np.rint(binned).astype('int64')
+        self._partial, self._size = [], 0
+
+    def histogram(self):
+        """(values, counts) histogram of the values counted"""
+        if self._counts is not None:
+            origin, divisor = self._quant
+            nonzero = np.flatnonzero(self._counts)
+            return (origin + nonzero) / divisor, self._counts[nonzero]
+        if not self._partial:
+            return np.zeros(0, dtype='float64'), np.zeros(0, dtype='int64')
+        return merge_histograms(self._partial)
+
+
+def _array_histogram(band, color_space, b, method, bins=65536):
+    """Histogram of the values of band b of an array in color_space
+
+    In the float color spaces, the 'auto' histogram is accumulated
+    chunk by chunk as those of rio_hist.windowed.windowed_histograms
+    are, exact up to _MAX_EXACT_VALUES distinct values and binned
+    beyond them, so that it does not hold a sorted copy of the band.
+    Others are counted by value_counts.
+    """
+    cs = color_space.lower()
+    if method != 'auto' or cs not in FLOAT_RANGES:
+        return value_counts(band, method)
+
+    def grid(b):
+        return _bin_quantization(FLOAT_RANGES[cs][b][0],
+                                 FLOAT_RANGES[cs][b][1], bins)
+
+    hist = _BandHistogram(method, grid, b, bins)
+    band = band.ravel()
+    # chunks of as many pixels as a histogram has exact values
+    for start in range(0, band.size, _MAX_EXACT_VALUES):
+        hist.add(band[start:start + _MAX_EXACT_VALUES])
+    return hist.histogram()
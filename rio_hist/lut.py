@@ -0,0 +1,130 @@
+"""Lookup table matching of 8 and 16-bit RGB rasters
+
+In the RGB color space, the bands of an unsigned integer raster have at
+most 65536 values each: their histograms are counted on their integer
+levels, and each band is matched by indexing a uint8 lookup table of
+its levels (rgb_lookup_table) with the band itself, which gives the
+same result as matching it in float and converting it back with
+cs_backward, without any float array.
+"""
+from __future__ import division, absolute_import
+
+import numpy as np
+from .histogram import _INDEX_CHUNK, cdf_match_values
+from .utils import cs_backward
+
+
+# unsigned integer dtypes matched through lookup tables in the RGB color space
+_LUT_DTYPES = ('uint8', 'uint16')
+
+
+def _lut_compatible(dataset, color_space):
+    """True if the dataset can be matched through lookup tables"""
+    return (color_space.lower() == 'rgb' and
+            all(dt in _LUT_DTYPES for dt in dataset.dtypes[0:3]) and
+            len(set(dataset.dtypes[0:3])) == 1)
+
+
+def _lut_array(arr, color_space):
+    """True if an RGB array can be matched through lookup tables"""
+    return color_space.lower() == 'rgb' and arr.dtype.name in _LUT_DTYPES
+
+
+def _rgb_counts(band, valid, maxval):
+    """Count of each integer level 0..maxval of the valid pixels of band"""
+    band = band[valid] if valid is not None else band.ravel()
+    counts = np.zeros(maxval + 1, dtype='int64')
+    for start in range(0, band.size, _INDEX_CHUNK):
+        counts += np.bincount(
+            band[start:start + _INDEX_CHUNK], minlength=maxval + 1)
+    return counts
+
+
+def _level_histogram(counts, maxval):
+    """(values, counts) histogram of integer level counts, with values
+    normalized to 0..1 as by cs_forward
+    """
+    nonzero = counts > 0
+    values = np.arange(maxval + 1, dtype='float64')[nonzero]
+    values /= maxval
+    return values, counts[nonzero]
+
+
+def _rgb_histograms(dataset, reads, bixs):
+    """rio_hist.windowed._accumulate_histograms of unsigned integer
+    bands in the RGB color space
+
+    Values are counted on their integer levels, in a fixed size array.
+    """
+    maxval = np.iinfo(dataset.dtypes[0]).max
+    counts = dict((b, np.zeros(maxval + 1, dtype='int64')) for b in bixs)
+    masked = False
+    for arr, valid in reads:
+        if valid.all():
+            valid = None
+        else:
+            masked = True
+        for b in bixs:
+            counts[b] += _rgb_counts(arr[b], valid, maxval)
+    return dict((b, _level_histogram(counts[b], maxval)) for b in bixs), masked
+
+
+def rgb_lookup_table(s_hist, r_hist, maxval, match_proportion=1.0):
+    """
+    8-bit output lookup table of an unsigned integer source band
+    in the RGB color space
+
+    Parameters:
+    -----------
+        s_hist: (values, counts) tuple
+            source histogram, with values normalized to 0..1
+        r_hist: (values, counts) tuple or None
+            reference histogram, None for an unmatched band
+        maxval: int
+            largest value of the source dtype
+        match_proportion: float, range 0..1
+
+    Returns:
+    -----------
+        lut: np.ndarray
+            uint8 array of maxval + 1 output values. Indexing it with
+            the source band gives the same result as histogram_match
+            on the normalized band followed by cs_backward.
+    """
+    levels = np.arange(maxval + 1, dtype='float64')
+    levels /= maxval
+    if r_hist is None:
+        target = levels
+    else:
+        s_values, s_counts = s_hist
+        counts = np.zeros(maxval + 1, dtype='int64')
+        counts[np.rint(s_values * maxval).astype(np.intp)] = s_counts
+        # empty source levels don't move the cdf
+        target = cdf_match_values(levels, counts, *r_hist)
+        if match_proportion is not None and match_proportion != 1:
+            diff = levels - target
+            target = levels - (diff * match_proportion)
+    return cs_backward(target.reshape(1, 1, -1), 'rgb')[0, 0]
+
+
+def _rgb_luts(src_hists, ref_hists, maxval, match_proportion):
+    """Lookup tables of the first three bands, see rgb_lookup_table"""
+    return [rgb_lookup_table(
+        src_hists.get(b), ref_hists.get(b), maxval, match_proportion)
+        for b in range(3)]
+
+
+def _apply_luts(arr, luts, valid=None, fill=0, out=None):
+    """Index the lookup tables with the first three bands of arr, into
+    out if given, writing fill where pixels are not valid
+    """
+    target = np.empty((3, ) + arr.shape[1:], dtype='uint8') \
+        if out is None else out
+    step = max(1, _INDEX_CHUNK // max(arr.shape[2], 1))
+    for i, lut in enumerate(luts):
+        for start in range(0, arr.shape[1], step):
+            rows = slice(start, start + step)
+            np.take(lut, arr[i, rows], out=target[i, rows])
+    if valid is not None:
+        np.copyto(target, fill, where=~valid)
+    return target
@@ -0,0 +1,81 @@
+"""Saved source-to-reference mappings
+
+Matching a source computes, for each band, a mapping of its values to
+values matched to the reference. Saving it lets other rasters, such as
+the neighboring tiles of the same acquisition, be matched the same way
+by reading, looking values up and writing, without computing any
+histograms (see rio_hist.match.hist_apply_worker and rio hist-apply).
+
+A mapping is a dict with the lowercase color space, the band indexes
+matched, the match proportion (folded into the mapped values), the
+dtype of the source and the work dtype and conversion of the color
+space arrays, and tables of band index -> table of one kind:
+
+    rgb_lut
+        uint8 lookup tables of the first three bands of 8 or 16-bit
+        rasters in the RGB color space, see rgb_lookup_table
+    raw_lut
+        lookup tables of 8 or 16-bit integer bands in the RAW color
+        space, see raw_lookup_table
+    values
+        (values, mapped) tables of color space values, see build_mapping
+"""
+from __future__ import division, absolute_import
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('rgb_lut', 'raw_lut', 'values')
+
+# metadata of a mapping, saved as 0-d arrays
+_META = ('color_space', 'kind', 'dtype', 'work_dtype', 'conversion')
+
+
+def save_mapping(path, mapping):
+    """Write a mapping to a compressed .npz file"""
+    arrays = dict((key, np.array(mapping[key])) for key in _META)
+    proportion = mapping['match_proportion']
+    arrays['match_proportion'] = np.array(
+        np.nan if proportion is None else proportion)
+    arrays['bands'] = np.array(mapping['bands'], dtype='int64')
+    for b, table in mapping['tables'].items():
+        if mapping['kind'] == 'values':
+            arrays["values_{}".format(b)], arrays["mapped_{}".format(b)] = \
+                table
+        else:
+            arrays["lut_{}".format(b)] = table
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def load_mapping(path):
+    """Read a mapping written by save_mapping
+
+    Raises ValueError if the file is not a mapping.
+    """
+    with np.load(path) as data:
+        missing = [key for key in _META + ('match_proportion', 'bands')
+                   if key not in data.files]
+        if missing:
+            raise ValueError("{} is not a mapping, it has no {}".format(
+                path, ', '.join(missing)))
+        mapping = dict((key, str(data[key])) for key in _META)
+        if mapping['kind'] not in KINDS:
+            raise ValueError("Unknown mapping kind {!r}".format(
+                mapping['kind']))
+        proportion = float(data['match_proportion'])
+        mapping['match_proportion'] = \
+            None if np.isnan(proportion) else proportion
+        mapping['bands'] = tuple(int(b) for b in data['bands'])
+
+        tables = {}
+        for key in data.files:
+            name, _, b = key.partition('_')
+            if name == 'lut':
+                tables[int(b)] = data[key]
+            elif name == 'values':
+                tables[int(b)] = (data[key], data["mapped_{}".format(b)])
+        mapping['tables'] = tables
+    return mapping
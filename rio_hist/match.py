@@ -1,88 +1,325 @@
+"""Histogram matching of rasters
+
+hist_match_worker matches the bands of a source raster to the
+histograms of a reference raster or profile and writes the output,
+either in memory (hist_match_array, for arrays and open datasets) or
+block by block with the windowed engine of rio_hist.windowed.
+hist_apply_worker applies a saved mapping instead. The matching of
+arrays is in rio_hist.histogram, that of 8 and 16-bit RGB rasters in
+rio_hist.lut and that of the RAW color space in rio_hist.raw.
+"""
 from __future__ import division, absolute_import
 import logging
 import os
 
 import numpy as np
 import rasterio
-from rasterio.transform import guard_transform
-from .utils import cs_forward, cs_backward
+from rasterio.enums import MaskFlags
+from rasterio.transform import Affine
+from .histogram import (
+    FLOAT_RANGES, _array_histogram, apply_mapping, build_mapping,
+    histogram_match)
+from .lut import (
+    _apply_luts, _level_histogram, _lut_array, _rgb_counts, _rgb_luts)
+from .mapping import load_mapping
+from .reader import _all_valid, basename, gdal_options, read_raster
+from .reference import load_profile, profile_histograms
+from .stages import NULL_STATS, StageStats
+from .utils import (
+    _check_rgb_dtype, _executor, cs_backward, cs_forward, parse_bands)
+from .windowed import (
+    _apply_windowed, _check_mapping, _hist_match_windowed, _nodata_fill,
+    _output_profile, _overlap_histograms, _windowed_reference)
 
 
 logger = logging.getLogger(__name__)
 
 
-def histogram_match(source, reference, match_proportion=1.0):
+def _read_rgb(dataset, stats=NULL_STATS, prefix='', read_threads=1):
+    """Read the first three bands of a dataset and its valid-data mask
+    (see _valid_mask)
+
+    With read_threads > 1, the bands are read block by block by a pool
+    of threads. The read is measured in stats as the prefixed 'read'
+    stage.
+    """
+    _check_rgb_dtype(dataset.dtypes[0:3])
+    with stats.stage(prefix + 'read') as stage:
+        if read_threads > 1:
+            arr, valid = read_raster(dataset.name, (1, 2, 3), read_threads)
+        else:
+            arr = dataset.read((1, 2, 3))
+            valid = _valid_mask(dataset)
+        stage.bytes_read += arr.nbytes
+    return arr, valid
+
+
+def _valid_mask(dataset):
+    """Boolean mask of the dataset, True where data is valid, or None
+    if all of it is
+
+    The mask is read once, and not at all if the dataset's mask flags
+    say that all data is valid.
+    """
+    if all(flags == [MaskFlags.all_valid]
+           for flags in dataset.mask_flag_enums):
+        return None
+    valid = dataset.dataset_mask() > 0
+    return None if valid.all() else valid
+
+
+def _read_reference(path, color_space, bixs, *, method, dtype, keep=False,
+                    conversion='exact', stats=NULL_STATS, read_threads=1):
+    """Read a reference raster and compute the histograms of bands bixs
+
+    Returns the histograms and, if keep is True, the raster in
+    color_space and its valid-data mask; otherwise None so that the
+    array can be freed.
+
+    Stages are measured in stats, prefixed with 'reference_'.
+    """
+    with rasterio.open(path) as ref:
+        arr, valid = _read_rgb(ref, stats, 'reference_', read_threads)
+    hists, ref = _rgb_array_histograms(
+        arr, valid, color_space, bixs, method=method, dtype=dtype,
+        conversion=conversion, stats=stats, prefix='reference_', keep=keep)
+    return hists, ((ref, valid) if keep else None)
+
+
+def _rgb_array_histograms(arr, valid, color_space, bixs, *, method, dtype,
+                          conversion, stats=NULL_STATS, prefix='',
+                          keep=False):
+    """Histograms of bands bixs of the valid pixels of an RGB array in
+    color_space
+
+    Unsigned integer arrays are counted on their levels in the RGB
+    color space, without float arrays, unless keep is True. Returns the
+    histograms and, if keep is True, the array in color_space,
+    otherwise None. The prefixed 'cs_forward' and 'histograms' stages
+    are measured in stats.
+    """
+    if not keep and _lut_array(arr, color_space):
+        maxval = np.iinfo(arr.dtype).max
+        with stats.stage(prefix + 'histograms'):
+            return dict(
+                (b, _level_histogram(_rgb_counts(arr[b], valid, maxval),
+                                     maxval))
+                for b in bixs), None
+
+    with stats.stage(prefix + 'cs_forward'):
+        arr = cs_forward(arr, color_space, dtype, conversion)
+    hists = {}
+    with stats.stage(prefix + 'histograms'):
+        for b in bixs:
+            band = arr[b]
+            if valid is not None:
+                band = band[valid]
+            hists[b] = _array_histogram(band, color_space, b, method)
+    return hists, (arr if keep else None)
+
+
+def _match_rgb(arr, valid, ref_hists, bixs, color_space, *, match_proportion,
+               method, fill, work_dtype='float64', conversion='exact',
+               threads=1, stats=NULL_STATS, keep=False, out=None):
+    """Match bands bixs of an RGB array to reference histograms
+
+    Unsigned integer arrays are matched through 8-bit lookup tables in
+    the RGB color space (see rio_hist.lut) unless keep is True;
+    other arrays are converted to color_space and their bands matched
+    concurrently in a pool of threads. The 'auto' histograms of the
+    float color spaces are those of _array_histogram, and their
+    mappings are applied in place.
+
+    Returns the 8-bit RGB target, written to out if given, with fill
+    where pixels are not valid, and, if keep is True, the source and
+    target arrays in color_space, otherwise None. Stages are measured
+    in stats.
+    """
+    if not keep and _lut_array(arr, color_space):
+        logger.debug("Matching through lookup tables")
+        maxval = np.iinfo(arr.dtype).max
+        src_hists, _ = _rgb_array_histograms(
+            arr, valid, color_space, bixs, method=method, dtype=work_dtype,
+            conversion=conversion, stats=stats)
+        with stats.stage('match'):
+            luts = _rgb_luts(src_hists, ref_hists, maxval, match_proportion)
+            return _apply_luts(arr, luts, valid, fill, out), None
+
+    with stats.stage('cs_forward'):
+        src = cs_forward(arr, color_space, work_dtype, conversion)
+
+    # bands are matched independently, so src can be overwritten
+    # unless it is kept
+    target = src.copy() if keep else src
+
+    def match_band(b):
+        logger.debug("Processing band {}".format(b))
+        src_band = src[b]
+        # only the valid pixels are matched
+        if valid is not None:
+            src_band = src_band[valid]
+        with stats.stage('match'):
+            if method == 'auto' and color_space.lower() in FLOAT_RANGES:
+                # mapped in place, as windowed blocks are
+                mapping = build_mapping(
+                    _array_histogram(src_band, color_space, b, method),
+                    ref_hists[b], match_proportion)
+                apply_mapping(src[b], mapping, valid, out=target[b])
+                return
+            target_band = histogram_match(
+                src_band, ref_hists[b], match_proportion, method=method,
+                dtype=target.dtype)
+        # written by each thread, so that no more than one matched
+        # band per thread is held at once
+        if valid is not None:
+            target[b][valid] = target_band
+        else:
+            target[b] = target_band
+
+    with _executor(threads) as executor:
+        list(executor.map(match_band, bixs))
+
+    with stats.stage('cs_backward'):
+        target_rgb = cs_backward(target, color_space, conversion)
+        # write the source's nodata value to the invalid pixels
+        if valid is not None:
+            logger.debug("apply valid to target_rgb")
+            np.copyto(target_rgb, fill, where=~valid)
+        if out is not None:
+            out[...] = target_rgb
+            target_rgb = out
+    return target_rgb, ((src, target) if keep else None)
+
+
+def _rgb_input(raster, valid=None):
+    """(arr, valid, profile) of the first three bands of a dataset, or
+    of a (bands, rows, cols) array of which masked pixels are not valid
+    """
+    if not isinstance(raster, np.ndarray):
+        if valid is not None:
+            raise ValueError("the valid-data mask of a dataset is its own")
+        arr, valid = _read_rgb(raster)
+        return arr, valid, raster.profile.copy()
+
+    if raster.ndim != 3 or raster.shape[0] < 3:
+        raise ValueError("expected a (bands, rows, cols) array of at least "
+                         "3 bands, got shape {}".format(raster.shape))
+    if np.ma.is_masked(raster):
+        unmasked = ~np.ma.getmaskarray(raster)[0:3].any(axis=0)
+        valid = unmasked if valid is None else valid & unmasked
+    arr = np.ma.getdata(raster)[0:3]
+    _check_rgb_dtype([arr.dtype])
+    if valid is not None and valid.all():
+        valid = None
+    profile = {
+        'driver': 'GTiff', 'count': raster.shape[0], 'dtype': arr.dtype.name,
+        'height': raster.shape[1], 'width': raster.shape[2], 'nodata': None,
+        'crs': None, 'transform': Affine.identity()}
+    return arr, valid, profile
+
+
+def _output_array(arr, valid):
+    """Empty 8-bit RGB output of the rows and columns of arr, with an
+    alpha band if valid is given"""
+    count = 3 if valid is None else 4
+    return np.empty((count, ) + arr.shape[1:], dtype='uint8')
+
+
+def _hist_match_array(arr, valid, profile, ref_hists, bixs, color_space, *,
+                      match_proportion, method, work_dtype, conversion,
+                      creation_options, threads, stats, keep=False):
+    """hist_match_array of an RGB array and reference histograms
+
+    Returns the output array, its profile and, if keep is True, the
+    source and target arrays in color_space, see _match_rgb.
+    """
+    out = _output_array(arr, valid)
+    _, kept = _match_rgb(
+        arr, valid, ref_hists, bixs, color_space,
+        match_proportion=match_proportion, method=method,
+        fill=_nodata_fill(profile.get('nodata')), work_dtype=work_dtype,
+        conversion=conversion, threads=threads, stats=stats, keep=keep,
+        out=out[0:3])
+    if valid is not None:
+        np.multiply(valid, 255, out=out[3], casting='unsafe')
+    return out, _output_profile(
+        profile, valid is not None, creation_options or {}), kept
+
+
+def hist_match_array(source, reference, match_proportion=1.0,
+                     bands='1,2,3', color_space='RGB', method='auto',
+                     source_valid=None, reference_valid=None, profile=None,
+                     creation_options=None, threads=1, work_dtype='float64',
+                     conversion='exact', stats=None):
     """
-    Adjust the values of a source array
-    so that its histogram matches that of a reference array
+    Match the histograms of an in-memory raster to a reference
+
+    The first three bands of the source are matched as by
+    hist_match_worker, without reading or writing files.
 
     Parameters:
     -----------
-        source: np.ndarray
-        reference: np.ndarray
+        source: np.ndarray or rasterio dataset
+            (bands, rows, cols) unsigned integer RGB array, or an open
+            dataset (a rasterio.MemoryFile dataset, for instance)
+        reference: np.ndarray, rasterio dataset or dict
+            array or dataset as for source, or a reference profile
+            (see rio_hist.reference)
         match_proportion: float, range 0..1
+        bands: str
+            comma-separated list of bands to match
+        color_space: str
+            'RGB', 'LCH', 'LAB', 'LUV' or 'XYZ'
+        method: str, 'unique', 'bincount' or 'auto'
+            see histogram_match
+        source_valid, reference_valid: np.ndarray of bool, optional
+            (rows, cols) arrays, True where the pixels of an array
+            source or reference are valid. The masks of masked arrays
+            and datasets are used too.
+        profile: dict, optional
+            profile of an array source, for its georeferencing; by
+            default that of a GeoTIFF with an identity transform
+        creation_options: dict, optional
+            options added to the output profile
+        threads, work_dtype, conversion:
+            see hist_match_worker
+        stats: rio_hist.stages.StageStats, optional
+            records the stages of the matching
 
     Returns:
     -----------
         target: np.ndarray
-            The output array with the same shape as source
-            but adjusted so that its histogram matches the reference
+            uint8 (3, rows, cols) matched RGB array, with a fourth
+            alpha band if the source has invalid pixels
+        profile: dict
+            profile of the target, to write it with rasterio
     """
-    orig_shape = source.shape
-    source = source.ravel()
-
-    if np.ma.is_masked(reference):
-        logger.debug("ref is masked, compressing")
-        reference = reference.compressed()
+    if color_space.lower() == 'raw':
+        raise ValueError(
+            "the RAW color space is matched block by block, "
+            "use hist_match_worker")
+    if conversion not in ('exact', 'lut'):
+        raise ValueError("Unknown conversion {!r}".format(conversion))
+    stats = NULL_STATS if stats is None else stats
+    bixs = parse_bands(bands, 3)
+
+    arr, valid, src_profile = _rgb_input(source, source_valid)
+    if profile is None:
+        profile = src_profile
+    if isinstance(reference, dict):
+        ref_hists = profile_histograms(reference, color_space, bixs)
     else:
-        logger.debug("ref is unmasked, raveling")
-        reference = reference.ravel()
-
-    # get the set of unique pixel values
-    # and their corresponding indices and counts
-    logger.debug("Get unique pixel values")
-    s_values, s_idx, s_counts = np.unique(
-        source, return_inverse=True, return_counts=True)
-    r_values, r_counts = np.unique(reference, return_counts=True)
-    s_size = source.size
-
-    if np.ma.is_masked(source):
-        logger.debug("source is masked; get mask_index and remove masked values")
-        mask_index = np.ma.where(s_values.mask)
-        s_size = np.ma.where(s_idx != mask_index[0])[0].size
-        s_values = s_values.compressed()
-        s_counts = np.delete(s_counts, mask_index)
-
-    # take the cumsum of the counts; empirical cumulative distribution
-    logger.debug("calculate cumulative distribution")
-    s_quantiles = np.cumsum(s_counts).astype(np.float64) / s_size
-    r_quantiles = np.cumsum(r_counts).astype(np.float64) / reference.size
-
-    # find values in the reference corresponding to the quantiles in the source
-    logger.debug("interpolate values from source to reference by cdf")
-    interp_r_values = np.interp(s_quantiles, r_quantiles, r_values)
-
-    if np.ma.is_masked(source):
-        logger.debug("source is masked, add fill_value back at mask_index")
-        interp_r_values = np.insert(interp_r_values, mask_index[0], source.fill_value)
-
-    # using the inverted source indicies, pull out the interpolated pixel values
-    logger.debug("create target array from interpolated values by index")
-    target = interp_r_values[s_idx]
-
-    # interpolation b/t target and source
-    # 1.0 = full histogram match
-    # 0.0 = no change
-    if match_proportion is not None and match_proportion != 1:
-        diff = source - target
-        target = source - (diff * match_proportion)
-
-    if np.ma.is_masked(source):
-        logger.debug("source is masked, remask those pixels by position index")
-        target = np.ma.masked_where(s_idx == mask_index[0], target)
-        target.fill_value = source.fill_value
-
-    return target.reshape(orig_shape)
+        ref_arr, ref_valid, _ = _rgb_input(reference, reference_valid)
+        ref_hists, _ = _rgb_array_histograms(
+            ref_arr, ref_valid, color_space, bixs, method=method,
+            dtype=work_dtype, conversion=conversion, stats=stats,
+            prefix='reference_')
+    target, profile, _ = _hist_match_array(
+        arr, valid, profile, ref_hists, bixs, color_space,
+        match_proportion=match_proportion, method=method,
+        work_dtype=work_dtype, conversion=conversion,
+        creation_options=creation_options, threads=threads, stats=stats)
+    return target, profile
 
 
 def calculate_mask(src, arr):
@@ -91,91 +328,322 @@ def calculate_mask(src, arr):
         mask = None
         fill = None
     else:
-        _gdal_mask = src.dataset_mask()
-        mask = np.invert((_gdal_mask / 255).astype('bool'))
+        mask = src.dataset_mask() == 0
         fill = arr.fill_value
     return mask, fill
 
 
 def hist_match_worker(src_path, ref_path, dst_path, match_proportion,
-                      creation_options, bands, color_space, plot):
+                      creation_options, bands, color_space, plot, *,
+                      windowed=False, method='auto', ref_profile=None,
+                      threads=1, work_dtype='float64', conversion='exact',
+                      sample_resolution=None, max_samples=None, cog=False,
+                      stats=None, read_threads=1, gdal_cache=None,
+                      overlap=False, resampling=None, mapping_path=None,
+                      cache=None):
     """Match histogram of src to ref, outputing to dst
     optionally output a plot to <dst>_plot.png
+
+    With windowed=True, histograms are accumulated and the output is
+    written block by block so that large rasters need not fit in memory.
+
+    ref_profile, a reference profile or the path of a saved one
+    (see rio_hist.reference), replaces reading the reference raster;
+    ref_path is then ignored.
+
+    With threads > 1, the reference is read while the source is read
+    and bands are matched concurrently in a pool of threads.
+
+    work_dtype is the float dtype of the color space arrays; 'float32'
+    halves their memory at the cost of precision.
+
+    conversion is 'exact' or 'lut' to convert between RGB and
+    color_space through cached lookup tables (see rio_hist.colorlut),
+    faster for 8-bit rasters at the cost of a few levels of precision.
+
+    With sample_resolution (in units of each raster's coordinate
+    reference system) or max_samples (a number of pixels), histograms
+    are built from a decimated or randomly sampled read of the rasters
+    (see rio_hist.windowed) and the source is matched block by block,
+    as with windowed=True.
+
+    With cog=True, dst is written block by block, as with windowed=True,
+    as a tiled, compressed GeoTIFF with overviews laid out as a cloud
+    optimized GeoTIFF.
+
+    With color_space 'RAW', the bands are matched on their own values,
+    without color space conversion, block by block as with
+    windowed=True. The output keeps all the bands of the source, its
+    dtype and its nodata value; integer bands are rounded.
+
+    src_path and ref_path may be URLs or GDAL virtual file system paths
+    (see rio_hist.reader). With read_threads > 1, rasters are read block
+    by block by a pool of threads, which hides the latency of remote
+    reads. gdal_cache is the size of GDAL's block cache in megabytes.
+
+    With overlap=True, the reference histograms are built from the area
+    of the reference that overlaps the source, read block by block (see
+    rio_hist.overlap), on the reference grid or, with resampling (a
+    name from rio_hist.overlap.RESAMPLING), resampled to the source
+    grid. The source histograms are of the whole source.
+
+    With mapping_path, the mapping of the source values to matched
+    values is saved there for hist_apply_worker (see rio_hist.mapping)
+    and the source is matched block by block, as with windowed=True.
+
+    cache, a rio_hist.cache.ResultCache, holds the outputs of previous
+    jobs, keyed on their inputs and the parameters that change the
+    output: an output cached for the same inputs and parameters is
+    copied (or linked) to dst instead of matching again, and the
+    reference histograms are read from the cache or stored in it. Jobs
+    with a plot or a mapping path, or remote inputs, are not cached.
+
+    The wall time, bytes read and written and peak memory growth of
+    each stage of the job are recorded in stats, a new
+    rio_hist.stages.StageStats if None, which is returned.
     """
+    if stats is None:
+        stats = StageStats()
+    key = None
+    if cache is not None and not plot and mapping_path is None:
+        with stats.stage('cache'):
+            key = cache.key(
+                [src_path, ref_path if ref_profile is None else ref_profile],
+                dict(_cache_params(color_space, bands, method=method,
+                                   work_dtype=work_dtype,
+                                   conversion=conversion,
+                                   sample_resolution=sample_resolution,
+                                   max_samples=max_samples,
+                                   windowed=windowed or cog),
+                     match_proportion=match_proportion,
+                     creation_options=creation_options, cog=cog,
+                     overlap=overlap, resampling=resampling))
+            if key is not None and cache.get_output(key, dst_path):
+                stats.finish()
+                return stats
+
+    # from_defaults keeps rasterio's defaults, which an Env would drop
+    with rasterio.Env.from_defaults(
+            **gdal_options([src_path, ref_path], gdal_cache)):
+        _hist_match(
+            src_path, ref_path, dst_path, match_proportion=match_proportion,
+            creation_options=creation_options, bands=bands,
+            color_space=color_space, plot=plot, windowed=windowed,
+            method=method, ref_profile=ref_profile, threads=threads,
+            work_dtype=work_dtype, conversion=conversion,
+            sample_resolution=sample_resolution, max_samples=max_samples,
+            cog=cog, stats=stats, read_threads=read_threads, overlap=overlap,
+            resampling=resampling, mapping_path=mapping_path, cache=cache)
+    if key is not None:
+        with stats.stage('cache'):
+            cache.put_output(key, dst_path)
+    stats.finish()
+    return stats
+
+
+def _cache_params(color_space, bands, *, method, work_dtype, conversion,
+                  sample_resolution, max_samples, windowed):
+    """Parameters that change the histograms of a raster, for the keys
+    of a ResultCache; windowed is True if the windowed engine, which
+    counts histograms block by block, is used whatever the others"""
+    raw = color_space.lower() == 'raw'
+    sampled = sample_resolution is not None or max_samples is not None
+    return dict(
+        color_space=color_space.lower(), bands=bands, method=method,
+        work_dtype=work_dtype, conversion=conversion,
+        sample_resolution=sample_resolution, max_samples=max_samples,
+        windowed=bool(windowed or raw or sampled))
+
+
+def _cached_reference(cache, ref_path, color_space, bixs, bands, *, method,
+                      work_dtype, conversion, sample_resolution, max_samples,
+                      windowed, stats=NULL_STATS, read_threads=1):
+    """Reference histograms from a ResultCache, or computed by the
+    engine (windowed or in memory) and stored in it"""
+    params = _cache_params(
+        color_space, bands, method=method, work_dtype=work_dtype,
+        conversion=conversion, sample_resolution=sample_resolution,
+        max_samples=max_samples, windowed=windowed)
+    with stats.stage('cache'):
+        key = cache.key([ref_path], dict(params, kind='reference'))
+        hists = None
+        if key is not None:
+            hists = cache.get_histograms(key, color_space, bixs)
+    if hists is not None:
+        return hists
+
+    if params['windowed']:
+        hists = _windowed_reference(
+            ref_path, color_space, bixs, method=method,
+            work_dtype=work_dtype, conversion=conversion,
+            sample_resolution=sample_resolution, max_samples=max_samples,
+            stats=stats, read_threads=read_threads)
+    else:
+        hists, _ = _read_reference(
+            ref_path, color_space, bixs, method=method, dtype=work_dtype,
+            conversion=conversion, stats=stats, read_threads=read_threads)
+    if key is not None:
+        with stats.stage('cache'):
+            cache.put_histograms(key, color_space, hists)
+    return hists
+
+
+def hist_apply_worker(src_path, mapping, dst_path, creation_options, *,
+                      cog=False, stats=None, read_threads=1, gdal_cache=None):
+    """Match src through a saved mapping, outputing to dst
+
+    mapping, a mapping or the path of a saved one (see
+    rio_hist.mapping), is applied block by block as by the windowed
+    engine, without computing histograms: applying the mapping of a
+    source to that source gives the output of hist_match_worker.
+    Values that are not in the mapping are interpolated between its
+    values. The output has an alpha band, or in the RAW color space a
+    dataset mask, if src has a mask.
+
+    Raises ValueError if the lookup tables of the mapping are not of
+    the dtype of src.
+
+    cog, read_threads and gdal_cache are as in hist_match_worker, and
+    the stages of the job are recorded in stats, which is returned.
+    """
+    if stats is None:
+        stats = StageStats()
+    if isinstance(mapping, str):
+        mapping = load_mapping(mapping)
+    logger.info("Matching {} through a mapping in {} color space".format(
+        basename(src_path), mapping['color_space']))
+    with rasterio.Env.from_defaults(**gdal_options([src_path], gdal_cache)), \
+            rasterio.open(src_path) as src:
+        _check_mapping(src, mapping)
+        _apply_windowed(src, src_path, dst_path, mapping, not _all_valid(src),
+                        creation_options, cog=cog, stats=stats,
+                        read_threads=read_threads)
+    stats.finish()
+    return stats
+
+
+def _band_count(path, color_space):
+    """Number of bands to match from: 3 in the color spaces converted
+    from RGB, the band count of the raster at path in RAW"""
+    if color_space.lower() != 'raw':
+        return 3
+    with rasterio.open(path) as src:
+        return src.count
+
+
+def _hist_match(src_path, ref_path, dst_path, *, match_proportion,
+                creation_options, bands, color_space, plot, windowed, method,
+                ref_profile, threads, work_dtype, conversion,
+                sample_resolution, max_samples, cog, stats, read_threads,
+                overlap, resampling, mapping_path, cache):
+    """hist_match_worker, recording its stages in stats"""
+    if ref_profile is not None:
+        ref_name = ref_profile if isinstance(ref_profile, str) else 'profile'
+    else:
+        ref_name = ref_path
     logger.info("Matching {} to histogram of {} using {} color space".format(
-        os.path.basename(src_path), os.path.basename(ref_path), color_space))
-
-    with rasterio.open(src_path) as src:
-        profile = src.profile.copy()
-        src_arr = src.read(masked=True)
-        src_mask, src_fill = calculate_mask(src, src_arr)
-        src_arr = src_arr.filled()
+        basename(src_path), basename(ref_name), color_space))
 
-    with rasterio.open(ref_path) as ref:
-        ref_arr = ref.read(masked=True)
-        ref_mask, ref_fill = calculate_mask(ref, ref_arr)
-        ref_arr = ref_arr.filled()
+    if conversion not in ('exact', 'lut'):
+        raise ValueError("Unknown conversion {!r}".format(conversion))
 
-    src = cs_forward(src_arr, color_space)
-    ref = cs_forward(ref_arr, color_space)
-
-    bixs = tuple([int(x) - 1 for x in bands.split(',')])
-    band_names = [color_space[x] for x in bixs]  # assume 1 letter per band
-
-    target = src.copy()
-    for i, b in enumerate(bixs):
-        logger.debug("Processing band {}".format(b))
-        src_band = src[b]
-        ref_band = ref[b]
-
-        # Re-apply 2D mask to each band
-        if src_mask is not None:
-            logger.debug("apply src_mask to band {}".format(b))
-            src_band = np.ma.asarray(src_band)
-            src_band.mask = src_mask
-            src_band.fill_value = src_fill
-
-        if ref_mask is not None:
-            logger.debug("apply ref_mask to band {}".format(b))
-            ref_band = np.ma.asarray(ref_band)
-            ref_band.mask = ref_mask
-            ref_band.fill_value = ref_fill
-
-        target[b] = histogram_match(src_band, ref_band, match_proportion)
-
-    target_rgb = cs_backward(target, color_space)
-
-    # re-apply src_mask to target_rgb and write ndv
-    if src_mask is not None:
-        logger.debug("apply src_mask to target_rgb")
-        if not np.ma.is_masked(target_rgb):
-            target_rgb = np.ma.asarray(target_rgb)
-        target_rgb.mask = np.array((src_mask, src_mask, src_mask))
-        target_rgb.fill_value = src_fill
-        profile['count'] = 4
-    else:
-        profile['count'] = 3
-
-    profile['dtype'] = 'uint8'
-    profile['nodata'] = None
-    profile['transform'] = guard_transform(profile['transform'])
-    profile.update(creation_options)
+    if plot:
+        # fail before matching if matplotlib is missing
+        from .plot import make_plot, require_matplotlib
+        require_matplotlib()
+
+    bixs = parse_bands(bands, _band_count(src_path, color_space))
+
+    ref_hists = None
+    if ref_profile is not None:
+        if plot:
+            raise ValueError("plot is not supported with a reference profile")
+        if isinstance(ref_profile, str):
+            ref_profile = load_profile(ref_profile)
+        ref_hists = profile_histograms(ref_profile, color_space, bixs)
+
+    sampled = sample_resolution is not None or max_samples is not None
+    if sample_resolution is not None and max_samples is not None:
+        raise ValueError(
+            "sample_resolution and max_samples are mutually exclusive")
+
+    if resampling is not None and not overlap:
+        raise ValueError("resampling requires overlap")
+    if overlap:
+        if ref_profile is not None:
+            raise ValueError(
+                "overlap is not supported with a reference profile")
+        if plot:
+            raise ValueError("plot is not supported with overlap")
+        ref_hists = _overlap_histograms(
+            src_path, ref_path, color_space, bixs, method=method,
+            dtype=work_dtype, conversion=conversion, resampling=resampling,
+            sample_resolution=sample_resolution, max_samples=max_samples,
+            stats=stats, read_threads=read_threads)
+
+    raw = color_space.lower() == 'raw'
+    windowed = windowed or sampled or cog or raw or mapping_path is not None
+    if ref_hists is None and cache is not None and not plot:
+        # the reference is read before the source on a cache miss
+        ref_hists = _cached_reference(
+            cache, ref_path, color_space, bixs, bands, method=method,
+            work_dtype=work_dtype, conversion=conversion,
+            sample_resolution=sample_resolution, max_samples=max_samples,
+            windowed=windowed, stats=stats, read_threads=read_threads)
+
+    if windowed:
+        if plot:
+            raise ValueError(
+                "plot is not supported in windowed, sampled, cog or RAW "
+                "mode or with a mapping path")
+        _hist_match_windowed(
+            src_path, ref_path, dst_path, match_proportion=match_proportion,
+            creation_options=creation_options, bixs=bixs,
+            color_space=color_space, method=method, ref_hists=ref_hists,
+            threads=threads, work_dtype=work_dtype, conversion=conversion,
+            sample_resolution=sample_resolution, max_samples=max_samples,
+            cog=cog, stats=stats, read_threads=read_threads,
+            mapping_path=mapping_path)
+        return
+
+    with _executor(threads) as executor:
+        if ref_hists is None:
+            # read the reference while the source is read
+            ref_future = executor.submit(
+                _read_reference, ref_path, color_space, bixs, method=method,
+                dtype=work_dtype, keep=plot, conversion=conversion,
+                stats=stats, read_threads=read_threads)
+        with rasterio.open(src_path) as src:
+            profile = src.profile.copy()
+            arr, src_valid = _read_rgb(src, stats, read_threads=read_threads)
+        if ref_hists is None:
+            ref_hists, kept = ref_future.result()
+
+    target, profile, matched = _hist_match_array(
+        arr, src_valid, profile, ref_hists, bixs, color_space,
+        match_proportion=match_proportion, method=method,
+        work_dtype=work_dtype, conversion=conversion,
+        creation_options=creation_options, threads=threads, stats=stats,
+        keep=plot)
+    del arr
 
     logger.info("Writing raster {}".format(dst_path))
-    with rasterio.open(dst_path, 'w', **profile) as dst:
-        dst.write(target_rgb[0], 1)
-        dst.write(target_rgb[1], 2)
-        dst.write(target_rgb[2], 3)
-        if src_mask is not None:
-            gdal_mask = (np.invert(src_mask) * 255).astype('uint8')
-            dst.write(gdal_mask, 4)
+    with stats.stage('write') as stage, \
+            rasterio.open(dst_path, 'w', **profile) as dst:
+        dst.write(target)
+        stage.bytes_written += target.nbytes
 
     if plot:
-        from .plot import make_plot
         outplot = os.path.splitext(dst_path)[0] + "_plot.png"
         logger.info("Writing figure to {}".format(outplot))
-        make_plot(
-            src_path, ref_path, dst_path,
-            src, ref, target,
-            output=outplot,
-            bands=tuple(zip(bixs, band_names)))
+        band_names = [color_space[x] for x in bixs]  # assume 1 letter per band
+        src, target_cs = matched
+        ref, ref_valid = kept
+        with stats.stage('plot'):
+            make_plot(
+                src_path, ref_path, dst_path,
+                src, ref, target_cs,
+                output=outplot,
+                bands=tuple(zip(bixs, band_names)),
+                src_valid=src_valid, ref_valid=ref_valid,
+                target_rgb=target[0:3])
@@ -0,0 +1,142 @@
+"""Reading only the part of a reference that overlaps a source
+
+When the reference is much larger than the source, a basemap for
+instance, its histograms are best built from the area that the source
+covers: that reads less and matches the source to the reference
+content it actually overlaps.
+
+overlap_window gives the window of a dataset that covers the bounds of
+another, in any coordinate reference system. reference_area opens a
+reference for reading that window, either on its own grid or resampled
+to the source grid through a WarpedVRT.
+"""
+from __future__ import division, absolute_import
+from contextlib import contextmanager
+import logging
+import math
+
+import numpy as np
+import rasterio
+from rasterio.enums import ColorInterp, Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+logger = logging.getLogger(__name__)
+
+# resampling methods of reference_area
+RESAMPLING = ('nearest', 'bilinear', 'cubic', 'cubic_spline', 'lanczos',
+              'average', 'mode')
+
+# tolerance, in pixels, of the rounding of overlap windows
+_EPSILON = 1e-6
+
+
+def _coefficients(transform):
+    return np.array([[transform.a, transform.b, transform.c],
+                     [transform.d, transform.e, transform.f]])
+
+
+def _bounds(dataset):
+    """(left, bottom, right, top) bounds of a dataset, from the corners
+    of its grid so that rotated grids are covered"""
+    coef = _coefficients(dataset.transform)
+    corners = np.array([[0, dataset.width, 0, dataset.width],
+                        [0, 0, dataset.height, dataset.height],
+                        [1, 1, 1, 1]])
+    xs, ys = coef.dot(corners)
+    return xs.min(), ys.min(), xs.max(), ys.max()
+
+
+def overlap_window(src, ref):
+    """
+    Window of ref that covers the bounds of src
+
+    Parameters:
+    -----------
+        src, ref: rasterio datasets
+            georeferenced datasets, in the same or different coordinate
+            reference systems
+
+    Returns:
+    -----------
+        window: rasterio.windows.Window
+            integer window of ref, rounded out to whole pixels and
+            clipped to the extent of ref
+
+    Raises ValueError if a dataset has no coordinate reference system
+    or the datasets do not overlap.
+    """
+    if src.crs is None or ref.crs is None:
+        raise ValueError("overlap requires georeferenced rasters")
+    left, bottom, right, top = _bounds(src)
+    if src.crs != ref.crs:
+        left, bottom, right, top = transform_bounds(
+            src.crs, ref.crs, left, bottom, right, top, densify_pts=21)
+
+    # pixel coordinates of the corners of the bounds in ref
+    coef = _coefficients(ref.transform)
+    inverse = np.linalg.inv(coef[:, :2])
+    corners = np.array([[left, right, left, right],
+                        [bottom, bottom, top, top]])
+    cols, rows = inverse.dot(corners - coef[:, 2:])
+
+    col_start = max(0, int(math.floor(cols.min() + _EPSILON)))
+    row_start = max(0, int(math.floor(rows.min() + _EPSILON)))
+    col_stop = min(ref.width, int(math.ceil(cols.max() - _EPSILON)))
+    row_stop = min(ref.height, int(math.ceil(rows.max() - _EPSILON)))
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError("rasters do not overlap")
+    return Window(col_start, row_start,
+                  col_stop - col_start, row_stop - row_start)
+
+
+def clip_windows(windows, window):
+    """Intersections of windows with window, leaving out those that
+    do not intersect it"""
+    row_start, col_start = window.row_off, window.col_off
+    row_stop, col_stop = row_start + window.height, col_start + window.width
+    clipped = []
+    for w in windows:
+        r0, c0 = max(w.row_off, row_start), max(w.col_off, col_start)
+        r1 = min(w.row_off + w.height, row_stop)
+        c1 = min(w.col_off + w.width, col_stop)
+        if r1 > r0 and c1 > c0:
+            clipped.append(Window(c0, r0, c1 - c0, r1 - r0))
+    return clipped
+
+
+@contextmanager
+def reference_area(src_path, ref_path, resampling=None):
+    """
+    Open a reference for reading the area that overlaps a source
+
+    Parameters:
+    -----------
+        src_path, ref_path: str
+        resampling: str, optional
+            one of RESAMPLING to read the reference resampled to the
+            grid of the source; by default it is read on its own grid
+
+    Yields:
+    -----------
+        dataset, window:
+            the reference dataset, or a WarpedVRT of it on the source
+            grid in which pixels outside the reference are masked, and
+            the window of it to read
+    """
+    with rasterio.open(src_path) as src, rasterio.open(ref_path) as ref:
+        window = overlap_window(src, ref)
+        logger.debug("Reference overlap {} of {}".format(window, ref.shape))
+        if resampling is None:
+            yield ref, window
+            return
+        if resampling not in RESAMPLING:
+            raise ValueError("Unknown resampling {!r}".format(resampling))
+        # an alpha band masks the pixels outside the reference
+        with WarpedVRT(ref, crs=src.crs, transform=src.transform,
+                       width=src.width, height=src.height,
+                       resampling=Resampling[resampling],
+                       add_alpha=ColorInterp.alpha not in ref.colorinterp) \
+                as vrt:
+            yield vrt, overlap_window(ref, vrt)
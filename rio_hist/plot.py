@@ -1,95 +1,146 @@
 from __future__ import division, absolute_import
 import logging
+import math
 
 import numpy as np
-import matplotlib.pyplot as plt
-from pylab import rcParams
-from .utils import raster_to_image
+import rasterio
+
+from .histogram import value_counts
 
 logger = logging.getLogger(__name__)
 
+# largest side of the images shown in the plot, in pixels
+PREVIEW_SIZE = 1024
+
+
+def require_matplotlib():
+    """Import the non-interactive parts of matplotlib used for plots
+
+    matplotlib is an optional dependency (the 'plot' extra), imported
+    only when a plot is made; pyplot and its interactive backends are
+    never imported. Call it before a long job that ends with a plot to
+    fail early if matplotlib is missing.
+
+    Returns the Figure and FigureCanvasAgg classes; raises ImportError
+    if matplotlib is not installed.
+    """
+    try:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+    except ImportError:
+        raise ImportError(
+            "plots require matplotlib, install it or rio-hist[plot]")
+    return Figure, FigureCanvasAgg
+
+
+def _decimation(shape, max_size=PREVIEW_SIZE):
+    """Step between the rows and columns of a preview of shape"""
+    return max(1, int(math.ceil(max(shape) / max_size)))
+
+
+def read_preview(path, max_size=PREVIEW_SIZE):
+    """Read the first three bands of a raster and its valid-data mask
+    decimated to at most max_size pixels on a side, using overviews
+    when available
+
+    Returns the (3, rows, cols) array and the boolean valid array.
+    """
+    with rasterio.open(path) as src:
+        step = _decimation(src.shape, max_size)
+        shape = (int(math.ceil(src.height / step)),
+                 int(math.ceil(src.width / step)))
+        arr = src.read((1, 2, 3), out_shape=(3, ) + shape)
+        valid = src.dataset_mask(out_shape=shape) > 0
+    return arr, valid
+
+
+def _preview_image(arr, valid):
+    """Make an image-ordered RGBA float image of an unsigned integer
+    RGB array, transparent where not valid"""
+    maxval = np.iinfo(arr.dtype).max
+    image = np.empty(arr.shape[1:] + (4, ), dtype='float32')
+    for b in range(3):
+        np.divide(arr[b], maxval, out=image[:, :, b])
+    image[:, :, 3] = valid
+    return image
+
+
+def _rgb_histogram(band, valid, bins):
+    """Fraction of the valid pixels of an unsigned integer band in each
+    of bins equal intervals of its range"""
+    maxval = np.iinfo(band.dtype).max
+    levels = band[valid].astype('uint32') * bins // maxval
+    counts = np.bincount(np.minimum(levels, bins - 1), minlength=bins)
+    return counts / max(1, levels.size)
+
+
+def _cdf(band, valid):
+    """Values and cumulative distribution of the valid pixels of a band"""
+    if valid is not None:
+        band = band[valid]
+    values, counts = value_counts(band, method='bincount')
+    return values, np.cumsum(counts) / band.size
+
 
 def make_plot(source, reference, target,
               src_arr, ref_arr, tar_arr,
-              output, bands):
+              output, bands, src_valid=None, ref_valid=None,
+              target_rgb=None):
     """ Create a diagnostic plot showing source, reference and matched image
     and the cumulative distribution functions for each band
-    """
-    rcParams['figure.figsize'] = 16, 14
 
-    logger.debug("reading images")
-    i1 = raster_to_image(source)
-    i2 = raster_to_image(reference)
-    i3 = raster_to_image(target)
-
-    f, ((ax1, ax2, ax3), (ax4, ax5, ax6), (ax7, ax8, ax9)) = plt.subplots(3, 3)
+    The images and RGB histograms are of previews read from the source,
+    reference and target paths (see read_preview), or, for the target,
+    taken from the in-memory target_rgb array, of which src_valid is
+    the valid-data mask. The cumulative distribution functions are of
+    the valid pixels of the color space arrays src_arr, ref_arr and
+    tar_arr.
+    """
+    Figure, FigureCanvasAgg = require_matplotlib()
+
+    logger.debug("reading previews")
+    previews = [read_preview(source), read_preview(reference)]
+    if target_rgb is not None:
+        step = _decimation(target_rgb.shape[1:])
+        valid = (np.ones(target_rgb.shape[1:], dtype=bool)
+                 if src_valid is None else src_valid)
+        previews.append(
+            (target_rgb[:, ::step, ::step], valid[::step, ::step]))
+    else:
+        previews.append(read_preview(target))
+
+    fig = Figure(figsize=(16, 14))
+    FigureCanvasAgg(fig)
+    ((ax1, ax2, ax3), (ax4, ax5, ax6), (ax7, ax8, ax9)) = fig.subplots(3, 3)
 
     logger.debug("showing images")
-    ax1.imshow(i1)
-    ax1.set_title('Source')
-    ax1.set_xticklabels([])
-    ax1.set_yticklabels([])
-
-    ax2.imshow(i2)
-    ax2.set_title('Reference')
-    ax2.set_xticklabels([])
-    ax2.set_yticklabels([])
-
-    ax3.imshow(i3)
-    ax3.set_title('Matched to ' + ', '.join(str(b) for _, b in bands))
-    ax3.set_xticklabels([])
-    ax3.set_yticklabels([])
+    titles = ('Source', 'Reference',
+              'Matched to ' + ', '.join(str(b) for _, b in bands))
+    for axis, (arr, valid), title in zip((ax1, ax2, ax3), previews, titles):
+        axis.imshow(_preview_image(arr, valid))
+        axis.set_title(title)
+        axis.set_xticklabels([])
+        axis.set_yticklabels([])
 
     logger.debug("RGB histograms")
     axes = (ax4, ax5, ax6)
-    imgs = (i1, i2, i3)
     titles = ('Source', 'Reference', 'Output')
     bins = 32
-    for i, axis in enumerate(axes):
-        im = imgs[i]
-        title = titles[i]
-        # compressed for masked arrays, ravel for ndarray
-        red, _ = np.histogram(im[:, :, 0].compressed(), bins, [0, 1])
-        green, _ = np.histogram(im[:, :, 1].compressed(), bins, [0, 1])
-        blue, _ = np.histogram(im[:, :, 2].compressed(), bins, [0, 1])
-        for color, name in ((red, "red"), (green, "green"), (blue, "blue")):
-            norm = color / im.size
-            # axis.plot(norm, color=name, lw=2)
+    for axis, (arr, valid), title in zip(axes, previews, titles):
+        for b, name in enumerate(("red", "green", "blue")):
+            norm = _rgb_histogram(arr[b], valid, bins)
             axis.fill_between([float(x) / bins for x in range(bins)],
                               norm, facecolor=name, alpha=0.15)
         axis.set_title("{} RGB histogram".format(title))
-        # axis.set_yticklabels([])
-        axis.grid('on')
+        axis.grid(True)
 
     logger.debug("CDF match plots")
     axes = (ax7, ax8, ax9)
     for b, band in bands:
         ax = axes[b]
-        source_band = src_arr[b]
-        reference_band = ref_arr[b]
-        target_band = tar_arr[b]
-        try:
-            source_band = source_band.compressed()
-        except:
-            pass
-
-        try:
-            reference_band = reference_band.compressed()
-        except:
-            pass
-
-        try:
-            target_band = target_band.compressed()
-        except:
-            pass
-
-        sv, sc = np.unique(source_band, return_counts=True)
-        rv, rc = np.unique(reference_band, return_counts=True)
-        tv, tc = np.unique(target_band, return_counts=True)
-
-        scdf = np.cumsum(sc).astype(np.float64) / source_band.size
-        rcdf = np.cumsum(rc).astype(np.float64) / reference_band.size
-        tcdf = np.cumsum(tc).astype(np.float64) / target_band.size
+        sv, scdf = _cdf(src_arr[b], src_valid)
+        rv, rcdf = _cdf(ref_arr[b], ref_valid)
+        tv, tcdf = _cdf(tar_arr[b], src_valid)
 
         ax.set_title("{} cumulative distribution".format(band))
         ax.plot(sv, scdf, label="Source")
@@ -97,7 +148,6 @@ def make_plot(source, reference, target,
         ax.plot(tv, tcdf, '--r', lw=2, label="Match")
         if b == 1:
             ax.legend(loc=9, bbox_to_anchor=(0.5, -0.05))
-        # ax.set_yticklabels([])
-        ax.grid('on')
+        ax.grid(True)
 
-    plt.savefig(output, bbox_inches='tight')
+    fig.savefig(output, bbox_inches='tight')
@@ -0,0 +1,77 @@
+"""Matching in the RAW color space
+
+In the RAW color space, bands are matched on their own values, without
+color space conversion, and keep the dtype of the source: matched
+values are rounded and clipped to integer dtypes. 8 and 16-bit integer
+bands are matched through lookup tables of their values
+(raw_lookup_table), others through mappings (see
+rio_hist.histogram.build_mapping). RAW rasters are matched block by
+block by the windowed engine (rio_hist.windowed).
+"""
+from __future__ import division, absolute_import
+
+import numpy as np
+from .histogram import apply_mapping, cdf_match_values
+
+
+# integer dtypes matched through lookup tables in the RAW color space
+_RAW_LUT_DTYPES = ('uint8', 'uint16', 'int8', 'int16')
+
+
+def _cast(arr, dtype):
+    """Cast matched values to dtype, rounded and clipped to its range
+    if it is an integer dtype"""
+    if not np.issubdtype(np.dtype(dtype), np.integer):
+        return arr.astype(dtype)
+    info = np.iinfo(dtype)
+    arr = np.rint(arr)
+    np.clip(arr, info.min, info.max, out=arr)
+    return arr.astype(dtype)
+
+
+def raw_lookup_table(s_hist, r_hist, dtype, match_proportion=1.0):
+    """
+    Lookup table of an 8 or 16-bit integer source band matched in the
+    RAW color space, on its own values
+
+    Parameters:
+    -----------
+        s_hist, r_hist: (values, counts) tuple
+            source and reference histograms
+        dtype: str
+            integer dtype of the source band, one of _RAW_LUT_DTYPES
+        match_proportion: float, range 0..1
+
+    Returns:
+    -----------
+        lut: np.ndarray
+            array of dtype with the matched value of each value of
+            dtype, from the smallest. Indexing it with the source band
+            less that value gives the same result as histogram_match
+            on the band, rounded to dtype.
+    """
+    info = np.iinfo(dtype)
+    levels = np.arange(info.min, info.max + 1, dtype='float64')
+    s_values, s_counts = s_hist
+    counts = np.zeros(levels.size, dtype='int64')
+    counts[(np.asarray(s_values) - info.min).astype(np.intp)] = s_counts
+    # empty source levels don't move the cdf
+    target = cdf_match_values(levels, counts, *r_hist)
+    if match_proportion is not None and match_proportion != 1:
+        diff = levels - target
+        target = levels - (diff * match_proportion)
+    return _cast(target, dtype)
+
+
+def _match_raw(arr, bixs, luts, mappings, interpolate):
+    """Match bands bixs of a block in the RAW color space, in place,
+    through lookup tables or mappings (see build_mapping)"""
+    for b in bixs:
+        if luts is not None:
+            offset = np.iinfo(arr.dtype).min
+            band = arr[b].astype(np.intp) if offset else arr[b]
+            arr[b] = luts[b][band - offset if offset else band]
+        else:
+            arr[b] = _cast(apply_mapping(
+                arr[b], mappings[b], interpolate=interpolate), arr.dtype)
+    return arr
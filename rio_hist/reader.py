@@ -0,0 +1,154 @@
+"""Concurrent reads of local and remote rasters
+
+Rasters may be local files or URLs and GDAL virtual file system paths
+(https://, s3://, /vsis3/, /vsicurl/, ...). Reading a remote raster
+window by window is bound by the latency of each request, so windows
+are read by a bounded pool of threads, each with its own dataset
+handle (handles can't be shared between threads).
+
+gdal_options gives the GDAL configuration that hist_match_worker sets
+for remote inputs: a larger block cache, the VSI cache, and merged
+HTTP range requests.
+"""
+from __future__ import division, absolute_import
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import posixpath
+import threading
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags
+
+logger = logging.getLogger(__name__)
+
+# GDAL configuration for remote rasters; options already in the
+# environment are left to it
+REMOTE_OPTIONS = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': True,
+    'GDAL_HTTP_MAX_RETRY': 3,
+    'GDAL_HTTP_RETRY_DELAY': 1,
+    'VSI_CACHE': True,
+    'VSI_CACHE_SIZE': 64 * 2 ** 20,
+    'GDAL_CACHEMAX': 512,
+}
+
+
+def is_remote(path):
+    """True if path is a URL or a GDAL virtual file system path"""
+    return path is not None and ('://' in path or path.startswith('/vsi'))
+
+
+def basename(path):
+    """Base name of a local or remote path, without a URL's query"""
+    if is_remote(path):
+        return posixpath.basename(path.split('?', 1)[0])
+    return os.path.basename(path)
+
+
+def gdal_options(paths, cache_mb=None):
+    """GDAL configuration options for reading paths
+
+    Returns REMOTE_OPTIONS if any of paths is remote, and a block cache
+    (GDAL_CACHEMAX) of cache_mb megabytes if given, without the options
+    set in the environment.
+    """
+    options = {}
+    if any(is_remote(p) for p in paths):
+        options.update(REMOTE_OPTIONS)
+    if cache_mb is not None:
+        options['GDAL_CACHEMAX'] = int(cache_mb)
+    return dict((k, v) for k, v in options.items() if k not in os.environ)
+
+
+class _Handles(object):
+    """Dataset handles of a raster, one per thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = []
+
+    def get(self):
+        dataset = getattr(self._local, 'dataset', None)
+        if dataset is None:
+            dataset = self._local.dataset = rasterio.open(self.path)
+            with self._lock:
+                self._opened.append(dataset)
+        return dataset
+
+    def close(self):
+        for dataset in self._opened:
+            dataset.close()
+
+
+def _read_window(handles, window, indexes, masked):
+    dataset = handles.get()
+    arr = dataset.read(indexes, window=window)
+    valid = dataset.dataset_mask(window=window) > 0 if masked else None
+    return arr, valid
+
+
+def read_windows(path, windows, indexes=None, masked=True, threads=1):
+    """Read windows of a raster, in order
+
+    With threads > 1, up to twice as many windows are read ahead by a
+    pool of threads.
+
+    Yields the array of bands indexes (all by default) and the boolean
+    valid-data mask, or None if masked is False, of each window.
+    """
+    handles = _Handles(path)
+    try:
+        if threads == 1:
+            for window in windows:
+                yield _read_window(handles, window, indexes, masked)
+            return
+        with ThreadPoolExecutor(threads) as executor:
+            pending = deque()
+            for window in windows:
+                pending.append(executor.submit(
+                    _read_window, handles, window, indexes, masked))
+                if len(pending) >= 2 * threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        handles.close()
+
+
+def _all_valid(dataset):
+    """True if the mask flags say that every pixel is valid"""
+    return all(flags == [MaskFlags.all_valid]
+               for flags in dataset.mask_flag_enums)
+
+
+def read_raster(path, indexes=None, threads=1):
+    """Read a raster block by block with a pool of threads
+
+    Returns the array of bands indexes (all by default) and its boolean
+    valid-data mask, None if every pixel is valid.
+    """
+    with rasterio.open(path) as src:
+        bands = indexes or src.indexes
+        arr = np.empty((len(bands), src.height, src.width),
+                       dtype=src.dtypes[bands[0] - 1])
+        masked = not _all_valid(src)
+        valid = np.empty(src.shape, dtype=bool) if masked else None
+        windows = [window for _, window in src.block_windows(1)]
+
+    logger.debug("Reading {} windows of {} in {} threads".format(
+        len(windows), path, threads))
+    reads = read_windows(path, windows, bands, masked, threads)
+    for window, (block, block_valid) in zip(windows, reads):
+        rows, cols = window.toslices()
+        arr[:, rows, cols] = block
+        if masked:
+            valid[rows, cols] = block_valid
+    if masked and valid.all():
+        valid = None
+    return arr, valid
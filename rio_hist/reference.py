@@ -0,0 +1,78 @@
+"""Reference histogram profiles
+
+A profile holds the histograms of the bands of a reference raster in one
+or more color spaces. Saving it once lets many sources be matched to the
+reference without reading the reference raster again.
+
+A profile is a dict of lowercase color space -> band index -> (values,
+counts), as returned by rio_hist.histogram.value_counts.
+"""
+from __future__ import division, absolute_import
+import logging
+
+import numpy as np
+import rasterio
+
+from .utils import parse_bands
+
+logger = logging.getLogger(__name__)
+
+
+def reference_profile(ref_path, color_spaces=('RGB',), bands='1,2,3',
+                      method='auto'):
+    """Compute the profile of a reference raster
+
+    The raster is read block by block, once per color space. The
+    profile of many rasters is made by rio_hist.batch.mosaic_profile.
+    """
+    from .windowed import windowed_histograms
+
+    profile = {}
+    with rasterio.open(ref_path) as ref:
+        for cs in color_spaces:
+            bixs = parse_bands(bands, ref.count if cs.lower() == 'raw' else 3)
+            logger.debug("Accumulating {} histograms".format(cs))
+            hists, _ = windowed_histograms(ref, cs, bixs, method)
+            profile[cs.lower()] = hists
+    return profile
+
+
+def save_profile(path, profile, extra=None):
+    """Write a profile to a compressed .npz file
+
+    extra is a dict of other arrays to save, with names that don't end
+    with _values or _counts.
+    """
+    arrays = dict(extra or {})
+    for cs, hists in profile.items():
+        for b, (values, counts) in hists.items():
+            key = "{}_{}".format(cs, b)
+            arrays[key + "_values"] = values
+            arrays[key + "_counts"] = counts
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def load_profile(path):
+    """Read a profile written by save_profile"""
+    profile = {}
+    with np.load(path) as data:
+        for key in data.files:
+            if not key.endswith("_values"):
+                continue
+            cs, b, _ = key.split("_")
+            counts = data["{}_{}_counts".format(cs, b)]
+            profile.setdefault(cs, {})[int(b)] = (data[key], counts)
+    return profile
+
+
+def profile_histograms(profile, color_space, bixs):
+    """Histograms of bands bixs in color_space, from a profile"""
+    try:
+        hists = profile[color_space.lower()]
+        return dict((b, hists[b]) for b in bixs)
+    except KeyError:
+        raise ValueError(
+            "Reference profile has no histograms for bands {} in {} "
+            "color space".format(
+                ','.join(str(b + 1) for b in bixs), color_space))
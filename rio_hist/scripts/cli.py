@@ -1,11 +1,25 @@
+import glob
 import logging
+import os
 
 import click
 from rasterio.rio.options import creation_options
-from rio_hist.match import hist_match_worker
+from rio_hist.overlap import RESAMPLING
+
+# The commands are loaded by every rio invocation: the modules that do
+# the work (and rio_color, concurrent.futures, multiprocessing) are
+# imported only when a command runs.
 
 logger = logging.getLogger('rio_hist')
 
+color_spaces = ['RGB', 'LCH', 'LAB', 'Lab', 'LUV', 'XYZ', 'RAW']
+
+method_opt = click.option(
+    '--method', default='auto',
+    type=click.Choice(['auto', 'unique', 'bincount']),
+    help="Histogram method: exact 'unique', linear time 'bincount' or "
+         "'auto' (default) to use bincount when it is exact")
+
 
 def validate_proportion(ctx, param, value):
     if value < 0 or value > 1:
@@ -13,30 +27,441 @@ def validate_proportion(ctx, param, value):
     return float(value)
 
 
+def validate_paths(ctx, param, value):
+    from rio_hist.reader import is_remote
+    for path in value[:-1]:
+        if not is_remote(path) and not os.path.exists(path):
+            raise click.BadParameter(
+                "Path '{}' does not exist.".format(path))
+    return value
+
+
+def validate_raster(ctx, param, value):
+    """A local raster that exists, or a remote one"""
+    from rio_hist.reader import is_remote
+    if value is not None and not is_remote(value) \
+            and not os.path.exists(value):
+        raise click.BadParameter("Path '{}' does not exist.".format(value))
+    return value
+
+
+def check_bands(bands, color_spaces, path=None):
+    """Raise click.BadParameter unless bands are between 1 and the
+    number of bands matched in each of color_spaces: 3, or in RAW the
+    band count of the raster at path, if given"""
+    from rio_hist.utils import parse_bands
+    counts = [3 for cs in color_spaces if cs != 'RAW']
+    if 'RAW' in color_spaces and path is not None:
+        import rasterio
+        with rasterio.open(path) as src:
+            counts.append(src.count)
+    try:
+        parse_bands(bands, min(counts) if counts else None)
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint='--bands')
+
+
+read_threads_opt = click.option(
+    '--read-threads', default=1, type=click.IntRange(min=1),
+    help="number of threads reading blocks of the rasters concurrently, "
+         "to hide the latency of remote reads (default 1)")
+
+gdal_cache_opt = click.option(
+    '--gdal-cache', type=click.IntRange(min=1), metavar='MB',
+    help="size of GDAL's block cache in megabytes")
+
+profile_json_opt = click.option(
+    '--profile-json', type=click.Path(dir_okay=False),
+    help="write the time, bytes read and written and peak memory growth "
+         "of each stage of the job to this JSON file")
+
+
+def cache_options(f):
+    """--cache options of the matching commands"""
+    options = [
+        click.option(
+            '--cache', is_flag=True, default=False,
+            help="reuse the outputs and reference histograms of previous "
+                 "runs with the same inputs and options, cached in "
+                 "$RIO_HIST_CACHE_DIR (default ~/.cache/rio-hist)"),
+        click.option(
+            '--cache-size', type=click.IntRange(min=1), default=10240,
+            metavar='MB', help="with --cache, size above which the least "
+                               "recently used entries are removed "
+                               "(default 10240)"),
+        click.option(
+            '--cache-checksum', is_flag=True, default=False,
+            help="with --cache, recognize inputs by a checksum of their "
+                 "content rather than by their size and modification "
+                 "time"),
+        click.option(
+            '--cache-link', is_flag=True, default=False,
+            help="with --cache, hard link cached outputs instead of "
+                 "copying them; cached outputs and their links are made "
+                 "read-only")]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def result_cache(cache, cache_size, cache_checksum, cache_link):
+    """The ResultCache of the --cache options, or None"""
+    if not cache:
+        return None
+    from rio_hist.cache import ResultCache
+    try:
+        return ResultCache(max_bytes=cache_size * 2 ** 20,
+                           checksum=cache_checksum, link=cache_link)
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint='--cache')
+
+
+cog_opt = click.option(
+    '--cog', is_flag=True, default=False,
+    help="write a tiled, compressed cloud optimized GeoTIFF with "
+         "overviews, block by block")
+
+
 @click.command('hist')
 @click.option('--color-space', '-c', default="RGB",
-              type=click.Choice(['RGB', 'LCH', 'LAB', 'Lab', 'LUV', 'XYZ']),
-              help="Colorspace")
+              type=click.Choice(color_spaces),
+              help="Colorspace. RAW matches bands on their own values and "
+                   "keeps the bands and dtype of the source.")
 @click.option('--bands', '-b', default="1,2,3",
               help="comma-separated list of bands to match (default 1,2,3)")
 @click.option('--match-proportion', '-m', default=1.0, type=float,
               callback=validate_proportion,
               help="Interpolate values between source and reference histogram. "
                    "1.0 (default) is full match, 0.0 is no match")
+@method_opt
+@click.option('--ref-profile', type=click.Path(exists=True),
+              help="reference profile made by rio hist-profile, "
+                   "used in place of REF_PATH")
 @click.option('--plot', is_flag=True, default=False,
               help="create a <basename>_plot.png with diagnostic plots")
+@click.option('--windowed', is_flag=True, default=False,
+              help="process the rasters block by block to limit memory use")
+@cog_opt
+@click.option('--threads', default=1, type=click.IntRange(min=1),
+              help="number of threads for reading and matching bands "
+                   "(default 1)")
+@click.option('--work-dtype', default='float64',
+              type=click.Choice(['float64', 'float32']),
+              help="float type of the color space arrays; float32 uses "
+                   "half the memory (default float64)")
+@click.option('--conversion', default='exact',
+              type=click.Choice(['exact', 'lut']),
+              help="color space conversion: 'exact' (default) or through "
+                   "cached lookup tables, faster for 8-bit rasters")
+@click.option('--sample-resolution', type=float,
+              help="build the histograms from reads decimated to this "
+                   "resolution, in units of each raster's CRS, using "
+                   "overviews when available")
+@click.option('--max-samples', type=click.IntRange(min=1),
+              help="build the histograms from randomly chosen blocks of "
+                   "at least this many pixels in all")
+@click.option('--overlap', is_flag=True, default=False,
+              help="build the reference histograms from the area of "
+                   "REF_PATH that overlaps SRC_PATH only")
+@click.option('--resampling', type=click.Choice(RESAMPLING),
+              help="with --overlap, read the reference resampled to the "
+                   "source grid with this method")
+@click.option('--save-mapping', 'mapping_path',
+              type=click.Path(dir_okay=False),
+              help="save the mapping of source values to matched values "
+                   "to this .npz file for rio hist-apply; the source is "
+                   "matched block by block")
+@profile_json_opt
+@read_threads_opt
+@gdal_cache_opt
+@cache_options
 @click.option('--verbose', '-v', is_flag=True, default=False)
-@click.argument('src_path', type=click.Path(exists=True))
-@click.argument('ref_path', type=click.Path(exists=True))
-@click.argument('dst_path', type=click.Path(exists=False))
+@click.argument('paths', nargs=-1, required=True, callback=validate_paths,
+                metavar="SRC_PATH [REF_PATH] DST_PATH")
 @click.pass_context
 @creation_options
-def hist(ctx, src_path, ref_path, dst_path, match_proportion,
-         verbose, creation_options, bands, color_space, plot):
+def hist(ctx, paths, match_proportion, verbose, creation_options, bands,
+         color_space, plot, windowed, method, ref_profile, threads,
+         work_dtype, conversion, sample_resolution, max_samples, cog,
+         profile_json, read_threads, gdal_cache, overlap, resampling,
+         mapping_path, cache, cache_size, cache_checksum, cache_link):
     """Color correction by histogram matching
+
+    REF_PATH is omitted when a reference profile is given. With
+    --sample-resolution or --max-samples, the histograms are built from
+    a sample of the rasters and the full resolution source is matched
+    block by block, as with --windowed.
+
+    SRC_PATH and REF_PATH may be URLs or GDAL virtual file system paths
+    (/vsicurl/, /vsis3/, ...).
+    """
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    if ref_profile:
+        if len(paths) != 2:
+            raise click.BadParameter(
+                "expected SRC_PATH DST_PATH with --ref-profile",
+                param_hint='PATHS')
+        (src_path, dst_path), ref_path = paths, None
+    else:
+        if len(paths) != 3:
+            raise click.BadParameter(
+                "expected SRC_PATH REF_PATH DST_PATH", param_hint='PATHS')
+        src_path, ref_path, dst_path = paths
+
+    check_bands(bands, [color_space], src_path)
+    if windowed and plot:
+        raise click.BadParameter(
+            "not supported with --windowed", param_hint='--plot')
+    if cog and plot:
+        raise click.BadParameter(
+            "not supported with --cog", param_hint='--plot')
+    if color_space == 'RAW' and plot:
+        raise click.BadParameter(
+            "not supported in the RAW color space", param_hint='--plot')
+    if sample_resolution is not None and sample_resolution <= 0:
+        raise click.BadParameter(
+            "must be positive", param_hint='--sample-resolution')
+    if sample_resolution and max_samples:
+        raise click.BadParameter(
+            "not supported with --max-samples",
+            param_hint='--sample-resolution')
+    if (sample_resolution or max_samples) and plot:
+        raise click.BadParameter(
+            "not supported with --sample-resolution or --max-samples",
+            param_hint='--plot')
+    if ref_profile and plot:
+        raise click.BadParameter(
+            "not supported with --ref-profile", param_hint='--plot')
+    if resampling and not overlap:
+        raise click.BadParameter(
+            "requires --overlap", param_hint='--resampling')
+    if overlap and ref_profile:
+        raise click.BadParameter(
+            "not supported with --ref-profile", param_hint='--overlap')
+    if overlap and plot:
+        raise click.BadParameter(
+            "not supported with --overlap", param_hint='--plot')
+    if mapping_path and plot:
+        raise click.BadParameter(
+            "not supported with --save-mapping", param_hint='--plot')
+
+    from rio_hist.match import hist_match_worker
+    stats = hist_match_worker(
+        src_path, ref_path, dst_path, match_proportion, creation_options,
+        bands, color_space, plot, windowed=windowed, method=method,
+        ref_profile=ref_profile, threads=threads, work_dtype=work_dtype,
+        conversion=conversion, sample_resolution=sample_resolution,
+        max_samples=max_samples, cog=cog, read_threads=read_threads,
+        gdal_cache=gdal_cache, overlap=overlap, resampling=resampling,
+        mapping_path=mapping_path,
+        cache=result_cache(cache, cache_size, cache_checksum, cache_link))
+    if profile_json:
+        stats.to_json(profile_json)
+
+
+@click.command('hist-profile')
+@click.option('--color-space', '-c', 'color_space', multiple=True,
+              default=["RGB"], type=click.Choice(color_spaces),
+              help="Colorspace, may be repeated (default RGB)")
+@click.option('--bands', '-b', default="1,2,3",
+              help="comma-separated list of bands (default 1,2,3)")
+@method_opt
+@click.option('--accumulate', is_flag=True, default=False,
+              help="add the histograms of REF_PATH to those of OUTPUT, if it "
+                   "exists, counting exactly in RGB and in fixed bins in "
+                   "other color spaces. The color spaces and bands of an "
+                   "existing OUTPUT are kept.")
+@click.option('--remove', is_flag=True, default=False,
+              help="with --accumulate, subtract the histograms of REF_PATH "
+                   "from those of OUTPUT")
+@click.option('--verbose', '-v', is_flag=True, default=False)
+@click.argument('ref_path', callback=validate_raster)
+@click.argument('output', type=click.Path(exists=False))
+def hist_profile(ref_path, output, color_space, bands, method, accumulate,
+                 remove, verbose):
+    """Save the histograms of a reference raster to a .npz profile
+    for use with rio hist --ref-profile
+
+    With --accumulate, OUTPUT holds the summed histograms of several
+    rasters and is updated by reading only REF_PATH.
+    """
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    if remove and not accumulate:
+        raise click.BadParameter("requires --accumulate", param_hint='--remove')
+
+    if not accumulate:
+        check_bands(bands, color_space, ref_path)
+        from rio_hist.reference import reference_profile, save_profile
+        profile = reference_profile(ref_path, color_space, bands, method)
+        save_profile(output, profile)
+        return
+
+    from rio_hist.accumulator import HistogramAccumulator
+    if os.path.exists(output):
+        acc = HistogramAccumulator.load(output)
+    elif remove:
+        raise click.BadParameter(
+            "{} does not exist".format(output), param_hint='OUTPUT')
+    else:
+        check_bands(bands, color_space, ref_path)
+        acc = HistogramAccumulator(color_space, bands)
+    if remove:
+        acc.remove_raster(ref_path)
+    else:
+        acc.add_raster(ref_path)
+    acc.save(output)
+
+
+@click.command('hist-batch')
+@click.option('--color-space', '-c', default="RGB",
+              type=click.Choice(color_spaces),
+              help="Colorspace. RAW matches bands on their own values and "
+                   "keeps the bands and dtype of the source.")
+@click.option('--bands', '-b', default="1,2,3",
+              help="comma-separated list of bands to match (default 1,2,3)")
+@click.option('--match-proportion', '-m', default=1.0, type=float,
+              callback=validate_proportion,
+              help="Interpolate values between source and reference histogram. "
+                   "1.0 (default) is full match, 0.0 is no match")
+@method_opt
+@click.option('--ref', 'ref_path', callback=validate_raster,
+              help="reference raster")
+@click.option('--ref-profile', type=click.Path(exists=True),
+              help="reference profile made by rio hist-profile")
+@click.option('--mosaic', is_flag=True, default=False,
+              help="match every source to the merged histograms of all "
+                   "sources, in place of a reference")
+@click.option('--mosaic-weight', 'mosaic_weights', nargs=2,
+              type=(str, float), multiple=True, metavar='PATH WEIGHT',
+              help="with --mosaic, scale the histogram counts of source PATH "
+                   "by WEIGHT (default 1); 0 leaves it out of the target. "
+                   "May be repeated.")
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1),
+              help="number of sources to match in parallel (default 1)")
+@click.option('--windowed', is_flag=True, default=False,
+              help="process the rasters block by block to limit memory use")
+@cog_opt
+@read_threads_opt
+@gdal_cache_opt
+@cache_options
+@click.option('--verbose', '-v', is_flag=True, default=False)
+@click.argument('src_paths', nargs=-1, required=True)
+@click.argument('dst_dir', type=click.Path(file_okay=False))
+@click.pass_context
+@creation_options
+def hist_batch(ctx, src_paths, dst_dir, ref_path, ref_profile,
+               match_proportion, verbose, creation_options, bands,
+               color_space, windowed, method, jobs, cog, mosaic,
+               mosaic_weights, read_threads, gdal_cache, cache, cache_size,
+               cache_checksum, cache_link):
+    """Match many sources to one reference
+
+    SRC_PATHS may be glob patterns, or URLs and GDAL virtual file
+    system paths, which are not expanded. Each output is written to DST_DIR
+    with the basename of its source. The reference, given by --ref or
+    --ref-profile, is read once. With --mosaic, the reference is the
+    merged histograms of the sources, so that a mosaic of them is
+    balanced to a common target.
+    """
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    if mosaic:
+        if ref_path or ref_profile:
+            raise click.UsageError(
+                "--ref and --ref-profile are not supported with --mosaic")
+    elif bool(ref_path) == bool(ref_profile):
+        raise click.UsageError(
+            "exactly one of --ref, --ref-profile or --mosaic is required")
+    if mosaic_weights and not mosaic:
+        raise click.BadParameter(
+            "requires --mosaic", param_hint='--mosaic-weight')
+    # RAW bands are checked against each source
+    check_bands(bands, [color_space])
+
+    from rio_hist.reader import is_remote
+    paths = []
+    for pattern in src_paths:
+        if not is_remote(pattern) and any(c in pattern for c in '*?['):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        if not matches:
+            raise click.BadParameter(
+                "'{}' matches no files".format(pattern), param_hint='SRC_PATHS')
+        paths.extend(matches)
+
+    from rio_hist.batch import hist_match_batch, output_paths
+    try:
+        output_paths(paths, dst_dir)
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint='SRC_PATHS')
+
+    weights = dict(mosaic_weights)
+    for path, weight in mosaic_weights:
+        if weight < 0:
+            raise click.BadParameter(
+                "weight of {} is negative".format(path),
+                param_hint='--mosaic-weight')
+        if path not in paths and \
+                os.path.normpath(path) not in map(os.path.normpath, paths):
+            raise click.BadParameter(
+                "{} is not a source".format(path),
+                param_hint='--mosaic-weight')
+
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+
+    results = hist_match_batch(
+        paths, ref_path, dst_dir, match_proportion, creation_options, bands,
+        color_space, jobs=jobs, windowed=windowed, method=method,
+        ref_profile=ref_profile, cog=cog, mosaic=mosaic, weights=weights,
+        read_threads=read_threads, gdal_cache=gdal_cache,
+        cache=result_cache(cache, cache_size, cache_checksum, cache_link))
+
+    failed = [(src, err) for src, _, err in results if err is not None]
+    for src, err in failed:
+        click.echo("{}: {}".format(src, err), err=True)
+    if failed:
+        raise click.ClickException("{} of {} sources failed".format(
+            len(failed), len(results)))
+
+
+@click.command('hist-apply')
+@cog_opt
+@profile_json_opt
+@read_threads_opt
+@gdal_cache_opt
+@click.option('--verbose', '-v', is_flag=True, default=False)
+@click.argument('src_path', callback=validate_raster)
+@click.argument('mapping', type=click.Path(exists=True, dir_okay=False))
+@click.argument('dst_path', type=click.Path(exists=False))
+@click.pass_context
+@creation_options
+def hist_apply(ctx, src_path, mapping, dst_path, verbose, creation_options,
+               cog, profile_json, read_threads, gdal_cache):
+    """Match a raster through a mapping saved by rio hist --save-mapping
+
+    The raster is read, looked up and written block by block, without
+    computing histograms, so that the mapping of one source can be
+    applied to other rasters of the same acquisition. Values that are
+    not in the mapping are interpolated.
     """
     if verbose:
         logger.setLevel(logging.DEBUG)
 
-    hist_match_worker(src_path, ref_path, dst_path, match_proportion,
-                      creation_options, bands, color_space, plot)
+    from rio_hist.match import hist_apply_worker
+    from rio_hist.mapping import load_mapping
+    try:
+        mapping = load_mapping(mapping)
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint='MAPPING')
+    stats = hist_apply_worker(
+        src_path, mapping, dst_path, creation_options, cog=cog,
+        read_threads=read_threads, gdal_cache=gdal_cache)
+    if profile_json:
+        stats.to_json(profile_json)
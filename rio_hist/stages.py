@@ -0,0 +1,154 @@
+"""Per-stage timing and memory of matching jobs
+
+hist_match_worker records the wall time, the bytes of pixel data read
+and written and the growth of the process's peak resident set size of
+each of its stages (reading, color space conversion, matching, writing,
+...) in a StageStats, which it returns.
+
+Stages that run in several threads or many times (once per block in
+windowed mode) are summed, so the stage times of a threaded job can add
+up to more than its total time.
+"""
+from __future__ import division, absolute_import
+from contextlib import contextmanager
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # pragma: no cover, not on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes, or None if
+    it can't be known on this platform
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class Stage(object):
+    """Measurements of one run of a stage, see StageStats.stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss_delta = None
+        self.calls = 0
+
+
+class StageStats(object):
+    """Measurements of the stages of a job, in the order they started"""
+
+    def __init__(self):
+        self._stages = {}
+        self._order = []
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._start_rss = peak_rss()
+        self.seconds = None
+        self.peak_rss_delta = None
+
+    @contextmanager
+    def stage(self, name):
+        """Measure a block of code as the stage name
+
+        The yielded Stage's bytes_read and bytes_written are for the
+        block to increment.
+        """
+        run = Stage(name)
+        rss = peak_rss()
+        start = time.time()
+        try:
+            yield run
+        finally:
+            run.seconds = time.time() - start
+            if rss is not None:
+                run.peak_rss_delta = peak_rss() - rss
+            self._add(run)
+
+    def _add(self, run):
+        with self._lock:
+            total = self._stages.get(run.name)
+            if total is None:
+                total = self._stages[run.name] = Stage(run.name)
+                self._order.append(run.name)
+            total.calls += 1
+            total.seconds += run.seconds
+            total.bytes_read += run.bytes_read
+            total.bytes_written += run.bytes_written
+            if run.peak_rss_delta is not None:
+                total.peak_rss_delta = (
+                    (total.peak_rss_delta or 0) + run.peak_rss_delta)
+
+    def finish(self):
+        """Record the total time and peak RSS growth of the job"""
+        self.seconds = time.time() - self._start
+        if self._start_rss is not None:
+            self.peak_rss_delta = peak_rss() - self._start_rss
+        for name in self._order:
+            stage = self._stages[name]
+            logger.debug(
+                "{}: {:.3f} s, {} bytes read, {} bytes written".format(
+                    name, stage.seconds, stage.bytes_read,
+                    stage.bytes_written))
+        logger.debug("total: {:.3f} s".format(self.seconds))
+
+    def __getitem__(self, name):
+        return self._stages[name]
+
+    def __contains__(self, name):
+        return name in self._stages
+
+    def as_dict(self):
+        """JSON serializable measurements"""
+        stages = []
+        for name in self._order:
+            stage = self._stages[name]
+            stages.append({
+                'name': name,
+                'calls': stage.calls,
+                'seconds': stage.seconds,
+                'bytes_read': stage.bytes_read,
+                'bytes_written': stage.bytes_written,
+                'peak_rss_delta': stage.peak_rss_delta})
+        return {
+            'seconds': self.seconds,
+            'peak_rss_delta': self.peak_rss_delta,
+            'bytes_read': sum(s['bytes_read'] for s in stages),
+            'bytes_written': sum(s['bytes_written'] for s in stages),
+            'stages': stages}
+
+    def to_json(self, path):
+        """Write as_dict() to a JSON file"""
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+@contextmanager
+def _no_stage(name):
+    yield Stage(name)
+
+
+class NullStats(object):
+    """A StageStats that measures nothing"""
+
+    stage = staticmethod(_no_stage)
+
+    def finish(self):
+        pass
+
+
+# default stats of the functions that measure their stages optionally
+NULL_STATS = NullStats()
@@ -1,4 +1,6 @@
 from __future__ import division, absolute_import
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
 import warnings
 
 import numpy as np
@@ -6,6 +8,8 @@ import rasterio
 from rasterio.enums import ColorInterp, MaskFlags
 from rio_color.colorspace import convert_arr, ColorSpace
 
+logger = logging.getLogger(__name__)
+
 
 def reshape_as_image(arr):
     """raster order (bands, rows, cols) -> image (rows, cols, bands)
@@ -23,58 +27,114 @@ def reshape_as_raster(arr):
     return np.swapaxes(np.swapaxes(arr, 2, 0), 2, 1)
 
 
-def cs_forward(arr, cs='rgb'):
+# pixels per chunk of the color space conversions
+_CHUNK_PIXELS = 2 ** 16
+
+_COLOR_SPACES = {
+    'lch': ColorSpace.lch,
+    'lab': ColorSpace.lab,
+    'luv': ColorSpace.luv,
+    'xyz': ColorSpace.xyz}
+
+
+def _row_chunks(arr):
+    """Slices of rows of a (bands, rows, cols) array, of about
+    _CHUNK_PIXELS pixels each"""
+    rows, cols = arr.shape[1:]
+    step = max(1, _CHUNK_PIXELS // max(cols, 1))
+    for start in range(0, rows, step):
+        yield slice(start, start + step)
+
+
+def parse_bands(bands, count=None):
+    """0-based indexes of a comma-separated list of 1-based bands
+
+    Raises ValueError unless every band is an integer between 1 and
+    count, or at least 1 if count is None.
+    """
+    try:
+        bixs = tuple(int(x) - 1 for x in bands.split(','))
+    except ValueError:
+        raise ValueError("bands must be a comma-separated list of "
+                         "integers, got {!r}".format(bands))
+    for b in bixs:
+        if count is None and b < 0:
+            raise ValueError("band {} is not positive".format(b + 1))
+        if count is not None and not 0 <= b < count:
+            raise ValueError("band {} is not between 1 and {}".format(
+                b + 1, count))
+    return bixs
+
+
+def _check_rgb_dtype(dtypes):
+    """Raise ValueError unless dtypes, those of RGB bands, are unsigned
+    integer dtypes"""
+    for dtype in map(np.dtype, dtypes):
+        if dtype.kind != 'u':
+            raise ValueError("expected unsigned integer RGB bands, got "
+                             "dtype {}".format(dtype))
+
+
+def cs_forward(arr, cs='rgb', dtype='float64', conversion='exact'):
     """ RGB (any dtype) to whatevs
+
+    The first three bands are normalized to 0..1 and converted chunk by
+    chunk into an array of dtype, so that no full size float64
+    intermediates are made. Color space conversions are computed in
+    float64 whatever the output dtype.
+
+    With conversion='lut', 8-bit input is converted through a cached
+    lookup table (see rio_hist.colorlut); other input is converted
+    exactly.
+
+    In the 'raw' color space, all bands are returned as they are.
     """
-    arrnorm_raw = arr.astype('float64') / np.iinfo(arr.dtype).max
-    arrnorm = arrnorm_raw[0:3]
     cs = cs.lower()
+    if cs == 'raw':
+        return arr
+    maxval = np.iinfo(arr.dtype).max
+    if conversion == 'lut' and cs != 'rgb':
+        if arr.dtype == np.uint8:
+            from .colorlut import lut_forward
+            return lut_forward(np.asarray(arr[0:3]), cs, dtype)
+        logger.debug("No lookup table for {} input".format(arr.dtype))
+
     if cs == 'rgb':
+        arrnorm = arr[0:3].astype(dtype)
+        arrnorm /= maxval
         return arrnorm
-    elif cs == 'lch':
-        return convert_arr(arrnorm,
-                           src=ColorSpace.rgb,
-                           dst=ColorSpace.lch)
-    elif cs == 'lab':
-        return convert_arr(arrnorm,
-                           src=ColorSpace.rgb,
-                           dst=ColorSpace.lab)
-    elif cs == 'luv':
-        return convert_arr(arrnorm,
-                           src=ColorSpace.rgb,
-                           dst=ColorSpace.luv)
-    elif cs == 'xyz':
-        return convert_arr(arrnorm,
-                           src=ColorSpace.rgb,
-                           dst=ColorSpace.xyz)
-
-
-def cs_backward(arr, cs='rgb'):
+
+    out = np.empty((3, ) + arr.shape[1:], dtype=dtype)
+    for rows in _row_chunks(arr):
+        chunk = arr[0:3, rows].astype('float64')
+        chunk /= maxval
+        out[:, rows] = convert_arr(chunk,
+                                   src=ColorSpace.rgb,
+                                   dst=_COLOR_SPACES[cs])
+    return out
+
+
+def cs_backward(arr, cs='rgb', conversion='exact'):
     """ whatevs to RGB 8-bit
+
+    Converted chunk by chunk, directly into the 8-bit output, or with
+    conversion='lut' through a cached lookup table (see rio_hist.colorlut).
     """
     cs = cs.lower()
-    if cs == 'rgb':
-        return (arr * 255).astype('uint8')
-    elif cs == 'lch':
-        rgb = convert_arr(arr,
-                          src=ColorSpace.lch,
-                          dst=ColorSpace.rgb)
-        return (rgb * 255).astype('uint8')
-    elif cs == 'lab':
-        rgb = convert_arr(arr,
-                          src=ColorSpace.lab,
-                          dst=ColorSpace.rgb)
-        return (rgb * 255).astype('uint8')
-    elif cs == 'luv':
-        rgb = convert_arr(arr,
-                          src=ColorSpace.luv,
-                          dst=ColorSpace.rgb)
-        return (rgb * 255).astype('uint8')
-    elif cs == 'xyz':
-        rgb = convert_arr(arr,
-                          src=ColorSpace.xyz,
-                          dst=ColorSpace.rgb)
-        return (rgb * 255).astype('uint8')
+    if conversion == 'lut' and cs != 'rgb':
+        from .colorlut import lut_backward
+        return lut_backward(arr, cs)
+
+    out = np.empty(arr.shape, dtype='uint8')
+    for rows in _row_chunks(arr):
+        if cs == 'rgb':
+            rgb = arr[:, rows]
+        else:
+            rgb = convert_arr(arr[:, rows].astype('float64'),
+                              src=_COLOR_SPACES[cs],
+                              dst=ColorSpace.rgb)
+        out[:, rows] = rgb * 255
+    return out
 
 
 def raster_to_image(raster):
@@ -101,3 +161,31 @@ def read_mask(dataset):
 
     """
     return dataset.dataset_mask()
+
+
+class _SerialExecutor(object):
+    """An executor that runs everything immediately, in the calling thread"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+
+def _executor(threads):
+    """A thread pool, or a serial executor for a single thread"""
+    if threads > 1:
+        return ThreadPoolExecutor(threads)
+    return _SerialExecutor()
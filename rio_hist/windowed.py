@@ -0,0 +1,603 @@
+"""Block by block histogram matching, the windowed engine
+
+Rasters of any size are matched in two passes over their blocks. The
+first accumulates the histograms of the source and the reference block
+by block (windowed_histograms), or of a sample of their pixels
+(sampled_histograms). The second maps the source block by block of the
+output through a mapping of its values (see rio_hist.mapping), writing
+each block while the next is mapped. Peak memory depends on block
+size, not on image size.
+
+The output profile and dataset (_output_profile, _output_dataset, which
+writes cloud optimized GeoTIFFs) are shared with the in-memory engine
+of rio_hist.match.
+"""
+from __future__ import division, absolute_import
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.shutil import copy as copy_dataset
+from rasterio.transform import guard_transform
+from .histogram import (
+    FLOAT_RANGES, _BandHistogram, _bin_quantization, apply_mapping,
+    build_mapping)
+from .lut import _apply_luts, _lut_compatible, _rgb_histograms, _rgb_luts
+from .mapping import save_mapping
+from .overlap import clip_windows, reference_area
+from .raw import _RAW_LUT_DTYPES, _match_raw, raw_lookup_table
+from .reader import read_windows
+from .stages import NULL_STATS
+from .utils import _check_rgb_dtype, _executor, cs_backward, cs_forward
+
+
+logger = logging.getLogger(__name__)
+
+
+def _window_mask(dataset, window):
+    """Boolean valid-data mask of a window, True where data is valid"""
+    return dataset.dataset_mask(window=window) > 0
+
+
+def windowed_histograms(dataset, color_space, bixs, method='auto',
+                        dtype='float64', conversion='exact', stage=None,
+                        read_threads=1, window=None):
+    """First pass of the windowed engine
+
+    Accumulate the histogram of each band in bixs, block by block,
+    excluding masked pixels. See value_counts for method and cs_forward
+    for dtype and conversion; with the 'bincount' method, values are
+    binned on a grid fixed for each band, see
+    rio_hist.histogram._BandHistogram. The bytes read are added to the
+    bytes_read of stage, a rio_hist.stages.Stage, if given. With
+    read_threads > 1, blocks are read ahead by a pool of threads (see
+    rio_hist.reader.read_windows). With a window, only the parts of
+    blocks within it are read.
+
+    Returns a dict of band index -> (values, counts) and a flag
+    that is True if any pixel of the dataset is masked.
+    """
+    windows = [w for _, w in dataset.block_windows(1)]
+    if window is not None:
+        windows = clip_windows(windows, window)
+
+    def reads():
+        if read_threads > 1:
+            return read_windows(dataset.name, windows, threads=read_threads)
+        return ((dataset.read(window=w), _window_mask(dataset, w))
+                for w in windows)
+
+    return _accumulate_histograms(
+        dataset, reads, color_space, bixs, method=method, dtype=dtype,
+        conversion=conversion, stage=stage)
+
+
+def sampled_histograms(dataset, color_space, bixs, method='auto',
+                       dtype='float64', conversion='exact',
+                       sample_resolution=None, max_samples=None, stage=None,
+                       window=None):
+    """Histograms of a sample of the dataset's pixels, or of those in
+    window if given
+
+    With sample_resolution, in units of the dataset's coordinate
+    reference system, the dataset is read decimated to that resolution,
+    from its overviews when it has them. With max_samples, randomly
+    chosen blocks are read until at least that many pixels are read.
+    Datasets coarser than sample_resolution or smaller than max_samples
+    are read entirely.
+
+    Returns a dict of band index -> (values, counts) and a flag that is
+    True if the dataset has a mask, see windowed_histograms for stage.
+    """
+    if sample_resolution is not None:
+        def reads():
+            return _decimated_reads(dataset, sample_resolution, window)
+    elif max_samples is not None:
+        def reads():
+            return _random_block_reads(dataset, max_samples, window=window)
+    else:
+        raise ValueError("sample_resolution or max_samples is required")
+
+    hists, _ = _accumulate_histograms(
+        dataset, reads, color_space, bixs, method=method, dtype=dtype,
+        conversion=conversion, stage=stage)
+    # a sample may miss masked pixels, rely on the dataset's mask flags
+    masked = any(flags != [MaskFlags.all_valid]
+                 for flags in dataset.mask_flag_enums)
+    return hists, masked
+
+
+def _decimated_reads(dataset, sample_resolution, window=None):
+    """Read the dataset, or a window of it, at a coarser resolution"""
+    xres, yres = abs(dataset.transform.a), abs(dataset.transform.e)
+    height, width = ((window.height, window.width) if window is not None
+                     else dataset.shape)
+    out_shape = (max(1, min(height,
+                            int(round(height * yres / sample_resolution)))),
+                 max(1, min(width,
+                            int(round(width * xres / sample_resolution)))))
+    logger.debug("Sampling {} of {} rows and columns".format(
+        out_shape, (height, width)))
+    arr = dataset.read(window=window, out_shape=(dataset.count, ) + out_shape)
+    yield arr, dataset.dataset_mask(window=window, out_shape=out_shape) > 0
+
+
+def _random_block_reads(dataset, max_samples, seed=0, window=None):
+    """Read randomly chosen blocks of the dataset, or of their parts
+    within window"""
+    windows = [w for _, w in dataset.block_windows(1)]
+    if window is not None:
+        windows = clip_windows(windows, window)
+    order = np.random.RandomState(seed).permutation(len(windows))
+    samples = blocks = 0
+    for i in order:
+        if samples >= max_samples:
+            break
+        block = windows[i]
+        samples += block.height * block.width
+        blocks += 1
+        yield dataset.read(window=block), _window_mask(dataset, block)
+    logger.debug("Sampled {} of {} blocks".format(blocks, len(windows)))
+
+
+def _accumulate_histograms(dataset, reads, color_space, bixs, *, method,
+                           dtype, conversion, stage=None, bins=65536):
+    """Accumulate the histograms of bands bixs of the (arr, valid)
+    reads of the dataset made by reads(), which is called once more if
+    the value range of a RAW band is needed to bin it
+
+    Returns the histograms and a flag that is True if any pixel read
+    is masked. Integer RGB histograms are counted on their levels;
+    others are accumulated as by _BandHistogram, with bins bins, in
+    memory that does not grow with the number of reads unless method
+    is 'unique'.
+    """
+    if stage is not None:
+        uncounted = reads
+
+        def reads():
+            return _counted(uncounted(), stage)
+    if _lut_compatible(dataset, color_space):
+        return _rgb_histograms(dataset, reads(), bixs)
+
+    ranges = {}
+
+    def value_ranges():
+        if not ranges:
+            ranges.update(_value_ranges(reads(), bixs))
+        return ranges
+
+    def grid(b):
+        return _band_grid(dataset, color_space, b, bins, value_ranges)
+
+    hists = dict((b, _BandHistogram(method, grid, b, bins)) for b in bixs)
+    masked = False
+    for arr, valid in reads():
+        arr = cs_forward(arr, color_space, dtype, conversion)
+        window_masked = not valid.all()
+        masked = masked or window_masked
+        for b in bixs:
+            hists[b].add(arr[b][valid] if window_masked else arr[b])
+    return dict((b, hists[b].histogram()) for b in bixs), masked
+
+
+def _band_grid(dataset, color_space, b, bins, value_ranges):
+    """(origin, divisor) of the bins equal bins of band b in
+    color_space (see _bin_quantization), or None if its values are on
+    at most 2 ** 16 integer levels, which are counted exactly
+
+    Bins are over FLOAT_RANGES in the float color spaces, 0..1 in RGB,
+    and in RAW over the range of the band in value_ranges(), a dict of
+    band index -> (min, max).
+    """
+    cs = color_space.lower()
+    if cs in FLOAT_RANGES:
+        lo, hi = FLOAT_RANGES[cs][b]
+        return _bin_quantization(lo, hi, bins)
+
+    dtypes = dataset.dtypes if cs == 'raw' else dataset.dtypes[0:3]
+    dtype = np.result_type(*dtypes)
+    if dtype.kind in 'ui' and dtype.itemsize <= 2:
+        return None
+    lo, hi = (0.0, 1.0) if cs == 'rgb' else value_ranges()[b]
+    return _bin_quantization(lo, max(hi, lo + 1.0), bins)
+
+
+def _value_ranges(reads, bixs):
+    """(min, max) of the finite values of bands bixs of (arr, valid)
+    reads, (0, 1) for bands without any"""
+    lows = dict((b, np.inf) for b in bixs)
+    highs = dict((b, -np.inf) for b in bixs)
+    for arr, valid in reads:
+        for b in bixs:
+            band = arr[b][valid]
+            band = band[np.isfinite(band)]
+            if band.size:
+                lows[b] = min(lows[b], float(band.min()))
+                highs[b] = max(highs[b], float(band.max()))
+    return dict((b, (lows[b], highs[b]) if lows[b] <= highs[b]
+                 else (0.0, 1.0)) for b in bixs)
+
+
+def _counted(reads, stage):
+    """Add the bytes of (arr, valid) reads to the bytes_read of stage"""
+    for arr, valid in reads:
+        stage.bytes_read += arr.nbytes
+        yield arr, valid
+
+
+def _hist_match_windowed(src_path, ref_path, dst_path, *, match_proportion,
+                         creation_options, bixs, color_space, method,
+                         ref_hists=None, threads=1, work_dtype='float64',
+                         conversion='exact', sample_resolution=None,
+                         max_samples=None, cog=False, stats=NULL_STATS,
+                         read_threads=1, mapping_path=None):
+    """Two-pass, block by block histogram matching
+
+    The first pass accumulates the source and reference histograms
+    over the datasets' internal blocks; the second pass maps the source
+    block by block of dst and writes each block, in a separate thread,
+    while the next is mapped (see _apply_windowed). Histograms are
+    binned beyond a number of distinct values (see _BandHistogram)
+    unless method is 'unique', so that peak memory depends on block
+    size, not on image size.
+    With threads > 1 the reference and source passes run concurrently.
+
+    With cog=True, dst is a cloud optimized GeoTIFF, see
+    _output_dataset.
+
+    With sample_resolution or max_samples, the first pass reads only a
+    sample of each dataset, see sampled_histograms, and source values
+    missing from the sample are interpolated in the second.
+
+    In the RAW color space, all bands of the source are read and those
+    in bixs are matched on their own values; the output has the bands,
+    dtype and nodata value of the source.
+
+    With read_threads > 1, blocks of the source and reference are read
+    ahead by a pool of threads, see rio_hist.reader.
+
+    With mapping_path, the mapping of the source to the reference is
+    saved there, see rio_hist.mapping.
+
+    Stages are measured in stats, see rio_hist.stages.
+    """
+    sampled = sample_resolution is not None or max_samples is not None
+
+    with _executor(threads) as executor, rasterio.open(src_path) as src:
+        if color_space.lower() != 'raw':
+            _check_rgb_dtype(src.dtypes[0:3])
+        # the options of the first pass over each dataset
+        options = dict(
+            method=method, work_dtype=work_dtype, conversion=conversion,
+            sample_resolution=sample_resolution, max_samples=max_samples,
+            stats=stats, read_threads=read_threads)
+        if ref_hists is None:
+            ref_future = executor.submit(
+                _windowed_reference, ref_path, color_space, bixs, **options)
+        logger.debug("Accumulating source histograms")
+        src_hists, masked = _dataset_histograms(
+            src, 'histograms', color_space, bixs, **options)
+        if ref_hists is None:
+            ref_hists = ref_future.result()
+
+        mapping = _source_mapping(
+            src, src_hists, ref_hists, bixs, color_space,
+            match_proportion=match_proportion, work_dtype=work_dtype,
+            conversion=conversion, sampled=sampled)
+        if mapping_path is not None:
+            logger.info("Writing mapping {}".format(mapping_path))
+            save_mapping(mapping_path, mapping)
+        # sampled and binned values are not all in the mapping
+        _apply_windowed(src, src_path, dst_path, mapping, masked,
+                        creation_options, cog=cog, stats=stats,
+                        read_threads=read_threads,
+                        interpolate=True if sampled else None)
+
+
+def _dataset_histograms(dataset, name, color_space, bixs, *, method,
+                        work_dtype, conversion, sample_resolution,
+                        max_samples, stats=NULL_STATS, read_threads=1):
+    """First pass of the windowed engine over a dataset, measured as
+    the stage name: windowed_histograms, or sampled_histograms with
+    sample_resolution or max_samples"""
+    with stats.stage(name) as stage:
+        if sample_resolution is not None or max_samples is not None:
+            return sampled_histograms(
+                dataset, color_space, bixs, method, dtype=work_dtype,
+                conversion=conversion, sample_resolution=sample_resolution,
+                max_samples=max_samples, stage=stage)
+        return windowed_histograms(
+            dataset, color_space, bixs, method, dtype=work_dtype,
+            conversion=conversion, stage=stage, read_threads=read_threads)
+
+
+def _windowed_reference(ref_path, color_space, bixs, *, method, work_dtype,
+                        conversion, sample_resolution, max_samples,
+                        stats=NULL_STATS, read_threads=1):
+    """Reference histograms of the windowed engine"""
+    with rasterio.open(ref_path) as ref:
+        if color_space.lower() != 'raw':
+            _check_rgb_dtype(ref.dtypes[0:3])
+        logger.debug("Accumulating reference histograms")
+        return _dataset_histograms(
+            ref, 'reference_histograms', color_space, bixs, method=method,
+            work_dtype=work_dtype, conversion=conversion,
+            sample_resolution=sample_resolution, max_samples=max_samples,
+            stats=stats, read_threads=read_threads)[0]
+
+
+def _overlap_histograms(src_path, ref_path, color_space, bixs, *, method,
+                        dtype, conversion, resampling, sample_resolution,
+                        max_samples, stats, read_threads=1):
+    """Histograms of the area of the reference that overlaps the
+    source, see rio_hist.overlap.reference_area
+
+    The area is read block by block, or sampled as by
+    sampled_histograms, in the 'reference_histograms' stage.
+    """
+    with reference_area(src_path, ref_path, resampling) as (ref, window), \
+            stats.stage('reference_histograms') as stage:
+        if sample_resolution is not None or max_samples is not None:
+            return sampled_histograms(
+                ref, color_space, bixs, method, dtype=dtype,
+                conversion=conversion, sample_resolution=sample_resolution,
+                max_samples=max_samples, stage=stage, window=window)[0]
+        # blocks of a resampled reference are read from its WarpedVRT
+        if resampling is not None:
+            read_threads = 1
+        return windowed_histograms(
+            ref, color_space, bixs, method, dtype=dtype,
+            conversion=conversion, stage=stage, read_threads=read_threads,
+            window=window)[0]
+
+
+def _source_mapping(src, src_hists, ref_hists, bixs, color_space, *,
+                    match_proportion, work_dtype, conversion, sampled):
+    """Mapping of a source dataset to the reference histograms, see
+    rio_hist.mapping
+
+    8 and 16-bit rasters are mapped through lookup tables in the RGB
+    color space, as are 8 and 16-bit integer bands in the RAW color
+    space unless the histograms are sampled.
+    """
+    mapping = {
+        'color_space': color_space.lower(), 'bands': tuple(bixs),
+        'match_proportion': match_proportion, 'dtype': src.dtypes[0],
+        'work_dtype': work_dtype, 'conversion': conversion}
+
+    if _lut_compatible(src, color_space):
+        logger.debug("Matching through lookup tables")
+        maxval = np.iinfo(src.dtypes[0]).max
+        luts = _rgb_luts(src_hists, ref_hists, maxval, match_proportion)
+        mapping.update(kind='rgb_lut', tables=dict(enumerate(luts)))
+
+    elif mapping['color_space'] == 'raw' and not sampled and all(
+            src.dtypes[b] in _RAW_LUT_DTYPES for b in bixs):
+        logger.debug("Matching through lookup tables")
+        mapping.update(kind='raw_lut', tables=dict(
+            (b, raw_lookup_table(src_hists[b], ref_hists[b], src.dtypes[b],
+                                 match_proportion))
+            for b in bixs))
+
+    else:
+        mapping.update(kind='values', tables=dict(
+            (b, build_mapping(src_hists[b], ref_hists[b], match_proportion))
+            for b in bixs))
+    return mapping
+
+
+def _check_mapping(src, mapping):
+    """Raise ValueError if src lacks the bands a mapping applies to, or
+    if its lookup tables are not of the dtype of those bands"""
+    # color spaces other than RAW are converted from the first three bands
+    if mapping['color_space'] == 'raw':
+        bixs = mapping['bands']
+    else:
+        bixs = (0, 1, 2)
+    if max(bixs) >= src.count:
+        raise ValueError("mapping of bands {} cannot be applied to a raster "
+                         "of {} bands".format(
+                             ','.join(str(b + 1) for b in bixs), src.count))
+    if mapping['kind'] == 'values':
+        return
+    dtypes = set(src.dtypes[b] for b in bixs)
+    if dtypes != set([mapping['dtype']]):
+        raise ValueError(
+            "mapping of {} rasters cannot be applied to {} bands".format(
+                mapping['dtype'], ', '.join(sorted(dtypes))))
+
+
+def _apply_windowed(src, src_path, dst_path, mapping, masked,
+                    creation_options, *, cog=False, stats=NULL_STATS,
+                    read_threads=1, interpolate=None):
+    """Second pass of the windowed engine
+
+    Map the source block by block of dst through a mapping (see
+    rio_hist.mapping) and write each block, in a separate thread,
+    while the next is mapped. The output has an alpha band, or in the
+    RAW color space a dataset mask, if masked is True. interpolate is
+    passed to apply_mapping.
+    """
+    color_space = mapping['color_space']
+    kind, tables = mapping['kind'], mapping['tables']
+    raw = color_space == 'raw'
+    luts = [tables[b] for b in range(3)] if kind == 'rgb_lut' else None
+    raw_luts = tables if kind == 'raw_lut' else None
+    mappings = tables if kind == 'values' else None
+
+    profile = _output_profile(src.profile, masked, creation_options, cog, raw)
+    if raw:
+        # invalid pixels are written as nodata, or in the dataset mask
+        fill = np.array(src.nodata if src.nodata is not None else 0,
+                        dtype=src.dtypes[0])
+        write = _write_raw_window
+    else:
+        fill = _nodata_fill(src.nodata)
+        write = _write_window
+
+    logger.info("Writing raster {}".format(dst_path))
+    with _output_dataset(dst_path, profile, cog) as dst, \
+            ThreadPoolExecutor(1) as writer:
+        written = None
+        windows = [window for _, window in dst.block_windows(1)]
+        reads = read_windows(
+            src_path, windows, (1, 2, 3) if luts is not None else None,
+            masked, read_threads)
+        for window in windows:
+            with stats.stage('read') as stage:
+                arr, valid = next(reads)
+                stage.bytes_read += arr.nbytes
+
+            if luts is not None:
+                with stats.stage('match'):
+                    target_rgb = _apply_luts(arr, luts, valid, fill)
+            elif raw:
+                with stats.stage('match'):
+                    target_rgb = _match_raw(
+                        arr, mapping['bands'], raw_luts, mappings,
+                        interpolate)
+                    if valid is not None:
+                        np.copyto(target_rgb, fill, where=~valid)
+                        if src.nodata is not None:
+                            valid = None
+            else:
+                with stats.stage('cs_forward'):
+                    arr = cs_forward(arr, color_space, mapping['work_dtype'],
+                                     mapping['conversion'])
+                with stats.stage('match'):
+                    # interpolating nodata values can leave the gamut
+                    for b in mapping['bands']:
+                        apply_mapping(arr[b], mappings[b], valid, arr[b],
+                                      interpolate)
+                with stats.stage('cs_backward'):
+                    target_rgb = cs_backward(arr, color_space,
+                                             mapping['conversion'])
+                    if valid is not None:
+                        np.copyto(target_rgb, fill, where=~valid)
+
+            # one block is written while the next is mapped
+            if written is not None:
+                written.result()
+            written = writer.submit(
+                write, dst, target_rgb, valid, window, stats)
+        if written is not None:
+            written.result()
+
+
+def _output_profile(profile, masked, creation_options, cog=False,
+                    raw=False):
+    """The 8-bit RGB(A) profile of the matched raster
+
+    With raw=True, the bands, dtype and nodata value of the source are
+    kept instead. With cog=True, the layout and compression of the
+    source are replaced by COG_OPTIONS before creation_options are
+    applied.
+    """
+    profile = profile.copy()
+    if not raw:
+        profile['count'] = 4 if masked else 3
+        profile['dtype'] = 'uint8'
+        profile['nodata'] = None
+    profile['transform'] = guard_transform(profile['transform'])
+    if cog:
+        for key in _SOURCE_LAYOUT:
+            profile.pop(key, None)
+        profile['driver'] = 'GTiff'
+        profile.update(COG_OPTIONS)
+    profile.update(creation_options)
+    return profile
+
+
+# creation options of cloud optimized GeoTIFF outputs; deflate with
+# horizontal differencing is lossless and compresses RGB imagery well
+COG_OPTIONS = {
+    'tiled': True, 'blockxsize': 512, 'blockysize': 512,
+    'compress': 'deflate', 'predictor': 2, 'interleave': 'pixel'}
+
+# source profile keys that don't carry over to COG outputs
+_SOURCE_LAYOUT = ('blockxsize', 'blockysize', 'tiled', 'compress',
+                  'photometric', 'interleave', 'predictor', 'jpeg_quality')
+
+# profile keys that are not creation options, see _output_dataset
+_DATASET_KEYS = ('driver', 'dtype', 'count', 'width', 'height', 'crs',
+                 'transform', 'nodata')
+
+
+def _overview_factors(width, height, blocksize):
+    """Overview decimation factors, down to a single block"""
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+@contextmanager
+def _output_dataset(dst_path, profile, cog=False):
+    """Open the output for writing
+
+    With cog=True, a temporary tiled GeoTIFF is yielded instead; on
+    exit its overviews are built and it is copied to dst_path with
+    its overviews ahead of the full resolution data, the layout of a
+    cloud optimized GeoTIFF.
+    """
+    if not cog:
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            yield dst
+        return
+
+    tmpdir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(dst_path)))
+    try:
+        tmp_path = os.path.join(tmpdir, 'cog.tif')
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            yield dst
+            factors = _overview_factors(
+                dst.width, dst.height, int(profile['blockxsize']))
+            if factors:
+                logger.debug("Building overviews {}".format(factors))
+                dst.build_overviews(factors, Resampling.average)
+        creation_options = dict((k, v) for k, v in profile.items()
+                                if k not in _DATASET_KEYS)
+        copy_dataset(tmp_path, dst_path, driver='GTiff',
+                     copy_src_overviews=True, **creation_options)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _nodata_fill(nodata):
+    """Value of the masked pixels of 8-bit outputs: the source's nodata
+    value if it is an 8-bit value, otherwise 0
+    """
+    if nodata is not None and nodata in range(256):
+        return int(nodata)
+    return 0
+
+
+def _write_window(dst, target_rgb, valid, window, stats=NULL_STATS):
+    """Write a window of the output, and its alpha band if valid is given"""
+    with stats.stage('write') as stage:
+        dst.write(target_rgb, (1, 2, 3), window=window)
+        stage.bytes_written += target_rgb.nbytes
+        if valid is not None:
+            dst.write((valid * 255).astype('uint8'), 4, window=window)
+            stage.bytes_written += valid.size
+
+
+def _write_raw_window(dst, target, valid, window, stats=NULL_STATS):
+    """Write a window of all bands of a RAW output, and its dataset mask
+    if valid is given"""
+    with stats.stage('write') as stage:
+        dst.write(target, window=window)
+        stage.bytes_written += target.nbytes
+        if valid is not None:
+            dst.write_mask((valid * 255).astype('uint8'), window=window)
+            stage.bytes_written += valid.size
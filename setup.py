@@ -35,9 +35,13 @@ setup(name='rio-hist',
       install_requires=["click", "rasterio~=1.0", "rio_color>=0.4"],
       extras_require={
           'plot': ['matplotlib'],
+          'dask': ['dask[array]'],
           'test': ['pytest', 'pytest-cov', 'codecov']},
       entry_points="""
       [rasterio.rio_plugins]
       hist=rio_hist.scripts.cli:hist
+      hist-profile=rio_hist.scripts.cli:hist_profile
+      hist-batch=rio_hist.scripts.cli:hist_batch
+      hist-apply=rio_hist.scripts.cli:hist_apply
       """
       )
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from rio_hist.accumulator import HistogramAccumulator
+from rio_hist.histogram import merge_histograms
+from rio_hist.match import hist_match_worker
+from rio_hist.reference import load_profile, reference_profile
+
+REFS = ['tests/data/reference1.tif', 'tests/data/reference2.tif']
+
+
+def assert_profiles_equal(a, b):
+    assert sorted(a) == sorted(b)
+    for cs in a:
+        assert sorted(a[cs]) == sorted(b[cs])
+        for band in a[cs]:
+            assert np.array_equal(a[cs][band][0], b[cs][band][0])
+            assert np.array_equal(a[cs][band][1], b[cs][band][1])
+
+
+def test_rgb_exact():
+    acc = HistogramAccumulator(('RGB', ), '1,2')
+    for path in REFS:
+        acc.add_raster(path)
+    singles = [reference_profile(path, ('RGB', ), '1,2') for path in REFS]
+    expected = dict(rgb=dict(
+        (b, merge_histograms([p['rgb'][b] for p in singles]))
+        for b in (0, 1)))
+    assert_profiles_equal(acc.profile(), expected)
+
+
+def test_float_bins():
+    acc = HistogramAccumulator(('LCH', ), bins=1024)
+    acc.add_raster(REFS[0])
+    exact = reference_profile(REFS[0], ('LCH', ))
+    binned = HistogramAccumulator(('LCH', ), bins=1024).add_histograms(exact)
+    assert_profiles_equal(acc.profile(), binned.profile())
+    for b in range(3):
+        values, counts = acc.profile()['lch'][b]
+        assert counts.sum() == exact['lch'][b][1].sum()
+        assert values.size <= 1024
+
+
+def test_remove():
+    acc = HistogramAccumulator(('RGB', 'LAB'), bins=4096)
+    first = HistogramAccumulator(('RGB', 'LAB'), bins=4096)
+    first.add_raster(REFS[0])
+    acc.add_raster(REFS[0]).add_raster(REFS[1]).remove_raster(REFS[1])
+    assert_profiles_equal(acc.profile(), first.profile())
+    with pytest.raises(ValueError):
+        acc.remove_raster(REFS[1])
+
+
+def test_merge():
+    a = HistogramAccumulator(('RGB', 'XYZ'), bins=4096).add_raster(REFS[0])
+    b = HistogramAccumulator(('RGB', 'XYZ'), bins=4096).add_raster(REFS[1])
+    both = HistogramAccumulator(('RGB', 'XYZ'), bins=4096)
+    both.add_raster(REFS[0]).add_raster(REFS[1])
+    assert_profiles_equal(a.merge(b).profile(), both.profile())
+    with pytest.raises(ValueError):
+        a.merge(HistogramAccumulator(('RGB', 'XYZ'), bins=1024))
+
+
+def test_missing_band():
+    acc = HistogramAccumulator(('LCH', ))
+    with pytest.raises(ValueError):
+        acc.add_histograms(reference_profile(REFS[0], ('RGB', )))
+
+
+def test_save_load(tmpdir):
+    path = str(tmpdir.join('acc.npz'))
+    acc = HistogramAccumulator(('RGB', 'LUV'), '1,3', bins=4096)
+    acc.add_raster(REFS[0])
+    acc.save(path)
+    loaded = HistogramAccumulator.load(path)
+    assert loaded.color_spaces == ('rgb', 'luv')
+    assert loaded.bixs == (0, 2)
+    assert loaded.bins == 4096
+    assert_profiles_equal(loaded.profile(), acc.profile())
+    # saved accumulators are reference profiles
+    assert_profiles_equal(load_profile(path), acc.profile())
+    output = str(tmpdir.join('matched.tif'))
+    hist_match_worker('tests/data/source1.tif', None, output, 1.0, {}, '1,3',
+                      'LUV', False, ref_profile=path)
+
+
+def test_load_profile(tmpdir):
+    from rio_hist.reference import save_profile
+    path = str(tmpdir.join('profile.npz'))
+    save_profile(path, reference_profile(REFS[0]))
+    with pytest.raises(ValueError):
+        HistogramAccumulator.load(path)
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.io import MemoryFile
+
+from rio_hist.match import hist_match_array, hist_match_worker
+from rio_hist.reference import reference_profile
+
+CO = {'compress': 'deflate'}
+SRC = 'tests/data/source1.tif'
+REF = 'tests/data/reference1.tif'
+
+
+def _matched_file(tmpdir, color_space, src=SRC, ref=REF, **kwargs):
+    path = str(tmpdir.join('expected.tif'))
+    hist_match_worker(src, ref, path, 1.0, CO, '1,2,3', color_space, False,
+                      **kwargs)
+    with rasterio.open(path) as dst:
+        return dst.read(), dst.profile
+
+
+@pytest.mark.parametrize('color_space', ['RGB', 'LCH', 'LAB'])
+def test_datasets_match_files(tmpdir, color_space):
+    expected, expected_profile = _matched_file(tmpdir, color_space)
+    with rasterio.open(SRC) as src, rasterio.open(REF) as ref:
+        target, profile = hist_match_array(src, ref, color_space=color_space,
+                                           creation_options=CO)
+    assert np.array_equal(target, expected)
+    for key in ('count', 'dtype', 'width', 'height', 'crs', 'transform'):
+        assert profile[key] == expected_profile[key]
+
+
+@pytest.mark.parametrize('color_space', ['RGB', 'LCH'])
+def test_arrays_match_files(tmpdir, color_space):
+    expected, _ = _matched_file(tmpdir, color_space)
+    with rasterio.open(SRC) as src, rasterio.open(REF) as ref:
+        source = src.read(masked=True)
+        reference = ref.read(masked=True)
+        ref_valid = ref.dataset_mask() > 0
+    target, profile = hist_match_array(
+        source, reference.data, color_space=color_space,
+        reference_valid=ref_valid)
+    assert np.array_equal(target, expected)
+    assert profile['count'] == target.shape[0]
+    assert profile['crs'] is None
+
+
+def test_memory_file(tmpdir):
+    expected, _ = _matched_file(tmpdir, 'LCH')
+    with open(SRC, 'rb') as f:
+        data = f.read()
+    with MemoryFile(data) as memfile, memfile.open() as src, \
+            rasterio.open(REF) as ref:
+        target, profile = hist_match_array(src, ref, color_space='LCH')
+    assert np.array_equal(target, expected)
+    with MemoryFile() as memfile, memfile.open(**profile) as dst:
+        dst.write(target)
+
+
+def test_valid_mask():
+    with rasterio.open(SRC) as src, rasterio.open(REF) as ref:
+        source = src.read()
+        reference = ref.read()
+    valid = np.ones(source.shape[1:], dtype=bool)
+    valid[:20, :30] = False
+    target, profile = hist_match_array(source, reference, source_valid=valid)
+    assert target.shape == (4, ) + source.shape[1:]
+    assert profile['count'] == 4
+    assert not target[:, :20, :30].any()
+    assert (target[3][valid] == 255).all()
+
+    # masked pixels are left out of the histograms
+    masked = np.ma.masked_array(source, np.broadcast_to(~valid, source.shape))
+    masked_target, _ = hist_match_array(masked, reference)
+    assert np.array_equal(masked_target, target)
+
+
+def test_reference_profile(tmpdir):
+    profile = reference_profile(REF, ('RGB', 'LCH'))
+    for color_space in ('RGB', 'LCH'):
+        expected, _ = _matched_file(tmpdir, color_space, ref_profile=profile)
+        with rasterio.open(SRC) as src:
+            target, _ = hist_match_array(src, profile,
+                                         color_space=color_space)
+        assert np.array_equal(target, expected)
+
+
+def test_invalid_inputs():
+    with rasterio.open(SRC) as src:
+        source = src.read()
+        with pytest.raises(ValueError):
+            hist_match_array(source[0:2], source)
+        with pytest.raises(ValueError):
+            hist_match_array(src, source, source_valid=np.ones(src.shape))
+    with pytest.raises(ValueError):
+        hist_match_array(source, source, color_space='RAW')
+    with pytest.raises(ValueError, match='unsigned integer'):
+        hist_match_array(source.astype('float32'), source)
+    with pytest.raises(ValueError, match='unsigned integer'):
+        hist_match_array(source, source.astype('int16'))
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import rasterio
+
+from rio_hist.batch import hist_match_batch, mosaic_profile
+from rio_hist.histogram import merge_histograms
+from rio_hist.match import hist_match_worker
+from rio_hist.reference import reference_profile
+
+SOURCES = ['tests/data/source1.tif', 'tests/data/source2.tif']
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_mosaic_profile(jobs):
+    profile = mosaic_profile(SOURCES, ('RGB', 'LCH'), '1,2', jobs=jobs)
+    singles = [reference_profile(path, ('RGB', 'LCH'), '1,2')
+               for path in SOURCES]
+    for cs in ('rgb', 'lch'):
+        assert sorted(profile[cs]) == [0, 1]
+        for b in (0, 1):
+            expected = merge_histograms([p[cs][b] for p in singles])
+            assert np.array_equal(profile[cs][b][0], expected[0])
+            assert np.array_equal(profile[cs][b][1], expected[1])
+
+
+def test_mosaic_profile_weights():
+    single = reference_profile(SOURCES[0])
+    profile = mosaic_profile(SOURCES, weights={SOURCES[1]: 0})
+    assert np.array_equal(profile['rgb'][0][1], single['rgb'][0][1])
+    profile = mosaic_profile(
+        SOURCES, weights={SOURCES[0]: 2.5, SOURCES[1]: 0})
+    assert profile['rgb'][0][1].dtype == np.float64
+    assert np.allclose(profile['rgb'][0][1], single['rgb'][0][1] * 2.5)
+    with pytest.raises(ValueError):
+        mosaic_profile(SOURCES, weights={SOURCES[0]: 0, SOURCES[1]: 0})
+
+
+def test_mosaic_batch(tmpdir):
+    outdir = tmpdir.mkdir('out')
+    results = hist_match_batch(
+        SOURCES, None, str(outdir), 1.0, {}, '1,2,3', 'LCH', jobs=2,
+        mosaic=True)
+    assert [err for _, _, err in results] == [None, None]
+
+    expected = str(tmpdir.join('expected.tif'))
+    hist_match_worker(
+        SOURCES[1], None, expected, 1.0, {}, '1,2,3', 'LCH', False,
+        ref_profile=mosaic_profile(SOURCES, ('LCH', ), '1,2,3'))
+    with rasterio.open(str(outdir.join('source2.tif'))) as a, \
+            rasterio.open(expected) as b:
+        assert np.array_equal(a.read(), b.read())
+
+
+def test_batch_same_basename(tmpdir):
+    paths = [tmpdir.join('source1.tif'),
+             tmpdir.mkdir('other').join('source1.tif')]
+    for path in paths:
+        path.write_binary(open(SOURCES[0], 'rb').read())
+    outdir = tmpdir.mkdir('out')
+    with pytest.raises(ValueError, match='same basename'):
+        hist_match_batch([str(path) for path in paths], SOURCES[1],
+                         str(outdir), 1.0, {}, '1,2,3', 'RGB')
+    assert outdir.listdir() == []
+
+
+def test_batch_output_is_source(tmpdir):
+    src = tmpdir.join('source1.tif')
+    src.write_binary(open(SOURCES[0], 'rb').read())
+    before = src.read_binary()
+    with pytest.raises(ValueError, match='source itself'):
+        hist_match_batch([str(src)], SOURCES[1], str(tmpdir), 1.0, {},
+                         '1,2,3', 'RGB')
+    assert src.read_binary() == before
@@ -0,0 +1,189 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import rasterio
+from click.testing import CliRunner
+
+from rio_hist.batch import hist_match_batch
+from rio_hist.cache import ResultCache, fingerprint
+from rio_hist.match import hist_match_worker
+from rio_hist.scripts.cli import hist
+
+CO = {'compress': 'deflate'}
+SRC = 'tests/data/source1.tif'
+REF = 'tests/data/reference1.tif'
+
+
+def _read(path):
+    with rasterio.open(path) as src:
+        return src.read()
+
+
+def _match(dst, cache, src=SRC, **kwargs):
+    kwargs = dict({'color_space': 'LCH'}, **kwargs)
+    return hist_match_worker(src, REF, dst, kwargs.pop('proportion', 1.0),
+                             CO, '1,2,3', kwargs.pop('color_space'), False,
+                             cache=cache, **kwargs)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'windowed': True},
+                                    {'color_space': 'RGB'}])
+def test_hit(tmpdir, kwargs):
+    cache = ResultCache(str(tmpdir.join('cache')))
+    first = str(tmpdir.join('first.tif'))
+    second = str(tmpdir.join('second.tif'))
+    stats = _match(first, cache, **kwargs)
+    assert 'match' in stats
+    stats = _match(second, cache, **kwargs)
+    assert _stage_names(stats) == ['cache']
+    assert np.array_equal(_read(first), _read(second))
+
+
+def test_parameters_and_inputs_miss(tmpdir):
+    cache = ResultCache(str(tmpdir.join('cache')))
+    dst = str(tmpdir.join('out.tif'))
+    _match(dst, cache)
+    assert 'match' in _match(dst, cache, proportion=0.5)
+    assert 'match' not in _match(dst, cache, proportion=0.5)
+
+    src = str(tmpdir.join('source.tif'))
+    shutil.copy(SRC, src)
+    _match(dst, cache, src=src)
+    os.utime(src, (0, 0))
+    assert 'match' in _match(dst, cache, src=src)
+
+
+def test_checksum(tmpdir):
+    src = str(tmpdir.join('source.tif'))
+    shutil.copy(SRC, src)
+    assert fingerprint(src, checksum=True) == fingerprint(SRC, checksum=True)
+    assert fingerprint(src) != fingerprint(SRC)
+    assert fingerprint('https://example.com/a.tif') is None
+
+    cache = ResultCache(str(tmpdir.join('cache')), checksum=True)
+    dst = str(tmpdir.join('out.tif'))
+    _match(dst, cache, src=src)
+    os.utime(src, (0, 0))
+    assert 'match' not in _match(dst, cache, src=src)
+
+
+def test_reference_histograms(tmpdir):
+    cache = ResultCache(str(tmpdir.join('cache')))
+    for kwargs in ({}, {'windowed': True}):
+        _match(str(tmpdir.join('a.tif')), cache, **kwargs)
+        # another source reuses the reference histograms
+        stats = _match(str(tmpdir.join('b.tif')), cache,
+                       src='tests/data/source2.tif', **kwargs)
+        assert 'match' in stats
+        assert not any(name.startswith('reference_')
+                       for name in _stage_names(stats))
+
+        # and matches as without a cache
+        expected = str(tmpdir.join('expected.tif'))
+        _match(expected, None, src='tests/data/source2.tif', **kwargs)
+        assert np.array_equal(_read(str(tmpdir.join('b.tif'))),
+                              _read(expected))
+
+
+def _stage_names(stats):
+    return [stage['name'] for stage in stats.as_dict()['stages']]
+
+
+def test_eviction(tmpdir):
+    directory = str(tmpdir.join('cache'))
+    dst = str(tmpdir.join('out.tif'))
+    cache = ResultCache(directory, checksum=True)
+    _match(dst, cache, color_space='RGB')
+    sizes = [size for _, size, _ in cache.entries()]
+
+    # room for the output and the histograms of two jobs only
+    cache.max_bytes = 2 * sum(sizes) + 1
+    for proportion in (0.5, 0.8):
+        _match(dst, cache, color_space='RGB', proportion=proportion)
+    assert len(cache.entries()) == 3
+    assert sum(size for _, size, _ in cache.entries()) <= cache.max_bytes
+
+    # the job of 0.8, used least recently, is evicted
+    os.utime(cache.entries()[0][2], None)
+    _match(dst, cache, color_space='RGB', proportion=0.5)
+    _match(dst, cache, color_space='RGB')
+    assert 'match' not in _match(dst, cache, color_space='RGB',
+                                 proportion=0.5)
+    assert 'match' in _match(dst, cache, color_space='RGB', proportion=0.8)
+
+
+def test_link(tmpdir):
+    cache = ResultCache(str(tmpdir.join('cache')), link=True)
+    dst = str(tmpdir.join('out.tif'))
+    _match(dst, cache)
+    outputs = [path for _, _, path in cache.entries()
+               if os.sep + 'results' + os.sep in path]
+    assert os.path.samefile(outputs[0], dst)
+    other = str(tmpdir.join('other.tif'))
+    _match(other, cache)
+    assert os.path.samefile(outputs[0], other)
+
+    # rerunning the same job leaves no temporary files
+    listing = sorted(os.listdir(str(tmpdir)))
+    _match(dst, cache)
+    assert sorted(os.listdir(str(tmpdir))) == listing
+    assert os.path.samefile(outputs[0], dst)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'windowed': True}, {'cog': True}])
+def test_link_read_only(tmpdir, kwargs):
+    cache = ResultCache(str(tmpdir.join('cache')), link=True)
+    dst = str(tmpdir.join('out.tif'))
+    _match(dst, cache, **kwargs)
+    entry, = [path for _, _, path in cache.entries()
+              if os.sep + 'results' + os.sep in path]
+    assert not os.stat(entry).st_mode & 0o222
+    cached = _read(entry)
+
+    # another job writing the linked output leaves the entry unchanged
+    _match(dst, cache, proportion=0.5, **kwargs)
+    assert not os.path.samefile(entry, dst)
+    assert np.array_equal(_read(entry), cached)
+    assert not np.array_equal(_read(dst), cached)
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setenv('RIO_HIST_CACHE_DIR', '')
+    with pytest.raises(ValueError):
+        ResultCache()
+
+
+def test_cli(tmpdir, monkeypatch):
+    monkeypatch.setenv('RIO_HIST_CACHE_DIR', str(tmpdir.join('cache')))
+    runner = CliRunner()
+    for name in ('first.tif', 'second.tif'):
+        result = runner.invoke(hist, [
+            '-c', 'LCH', '--cache', '--cache-size', '64', '--co',
+            'compress=deflate', SRC, REF, str(tmpdir.join(name))])
+        assert result.exit_code == 0, result.output
+    assert np.array_equal(_read(str(tmpdir.join('first.tif'))),
+                          _read(str(tmpdir.join('second.tif'))))
+    assert os.listdir(str(tmpdir.join('cache', 'results')))
+
+    monkeypatch.setenv('RIO_HIST_CACHE_DIR', '')
+    result = runner.invoke(hist, ['--cache', SRC, REF,
+                                  str(tmpdir.join('third.tif'))])
+    assert result.exit_code == 2
+
+
+def test_batch(tmpdir):
+    cache = ResultCache(str(tmpdir.join('cache')))
+    sources = [SRC, 'tests/data/source2.tif']
+    for name in ('first', 'second'):
+        results = hist_match_batch(
+            sources, REF, str(tmpdir.mkdir(name)), 1.0, CO, '1,2,3', 'LCH',
+            cache=cache)
+        assert [err for _, _, err in results] == [None, None]
+    for src in sources:
+        name = os.path.basename(src)
+        assert np.array_equal(_read(str(tmpdir.join('first', name))),
+                              _read(str(tmpdir.join('second', name))))
+    # the reference histograms and the two outputs
+    assert len(cache.entries()) == 3
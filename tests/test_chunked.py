@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import rasterio
+
+from rio_hist.chunked import (
+    apply_mapping, build_mapping, compute_cdf, dask_histogram_match)
+from rio_hist.histogram import histogram_match, value_counts
+from rio_hist.utils import cs_forward
+
+
+def read_band(path, color_space, b=0):
+    with rasterio.open(path) as src:
+        return cs_forward(src.read(), color_space)[b]
+
+
+@pytest.fixture(scope='module', params=['RGB', 'LCH'])
+def bands(request):
+    return (read_band('tests/data/source1.tif', request.param),
+            read_band('tests/data/reference1.tif', request.param))
+
+
+def test_compute_cdf(bands):
+    source, _ = bands
+    chunks = np.array_split(source, 7)
+    values, counts = compute_cdf(chunks)
+    expected = value_counts(source)
+    assert np.array_equal(values, expected[0])
+    assert np.array_equal(counts, expected[1])
+
+
+def test_compute_cdf_empty():
+    with pytest.raises(ValueError):
+        compute_cdf([])
+
+
+@pytest.mark.parametrize('match_proportion', [1.0, 0.5])
+def test_chunked_matches_histogram_match(bands, match_proportion):
+    source, reference = bands
+    mapping = build_mapping(
+        compute_cdf(np.array_split(source, 5, axis=1)),
+        compute_cdf(np.array_split(reference, 3)), match_proportion)
+    target = np.hstack([apply_mapping(chunk, mapping)
+                        for chunk in np.array_split(source, 5, axis=1)])
+    expected = histogram_match(source, reference, match_proportion)
+    assert np.array_equal(target, expected)
+
+
+def test_apply_mapping_valid(bands):
+    source, reference = bands
+    valid = source > np.median(source)
+    mapping = build_mapping(
+        compute_cdf([source[valid]]), compute_cdf([reference]))
+    target = apply_mapping(source, mapping, valid)
+    expected = histogram_match(source, reference, valid=valid)
+    assert np.array_equal(target, expected)
+
+
+def test_apply_mapping_interpolates():
+    mapping = (np.array([0.0, 1.0]), np.array([10.0, 20.0]))
+    assert np.array_equal(
+        apply_mapping(np.array([0.0, 0.25, 1.0]), mapping), [10, 12.5, 20])
+
+
+def test_dask_histogram_match(bands):
+    da = pytest.importorskip('dask.array')
+    source, reference = bands
+    expected = histogram_match(source, reference, 0.8)
+    target = dask_histogram_match(
+        da.from_array(source, chunks=(100, 150)),
+        da.from_array(reference, chunks=200), 0.8)
+    assert target.chunks == da.from_array(source, chunks=(100, 150)).chunks
+    assert np.array_equal(target.compute(), expected)
+    target = dask_histogram_match(
+        da.from_array(source, chunks=100), value_counts(reference), 0.8)
+    assert np.array_equal(target.compute(), expected)
@@ -1,4 +1,7 @@
 import os
+import subprocess
+import sys
+import warnings
 
 import click
 from click.testing import CliRunner
@@ -6,7 +9,8 @@ import pytest
 import rasterio
 import numpy as np
 
-from rio_hist.scripts.cli import hist, validate_proportion
+from rio_hist.scripts.cli import (
+    hist, hist_batch, hist_profile, validate_proportion)
 
 
 def test_hist_cli(tmpdir):
@@ -111,3 +115,370 @@ def test_validate_proportion():
     assert validate_proportion(None, None, 1) == 1.0
     with pytest.raises(click.BadParameter):
         assert validate_proportion(None, None, 9000)
+
+
+@pytest.mark.parametrize('src_path,ref_path,color_space', [
+    ('tests/data/source1.tif', 'tests/data/reference1.tif', 'RGB'),
+    ('tests/data/source2.tif', 'tests/data/reference2.tif', 'RGB'),
+    ('tests/data/source2.tif', 'tests/data/reference2.tif', 'LCH')])
+def test_windowed_matches_in_memory(tmpdir, src_path, ref_path, color_space):
+    output = str(tmpdir.join('matched.tif'))
+    windowed = str(tmpdir.join('windowed.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, ['-c', color_space, src_path, ref_path, output])
+    assert result.exit_code == 0
+    result = runner.invoke(
+        hist, ['-c', color_space, '--windowed', src_path, ref_path, windowed])
+    assert result.exit_code == 0
+    with rasterio.open(output) as a, rasterio.open(windowed) as b:
+        assert a.count == b.count
+        assert np.array_equal(a.read(), b.read())
+
+
+def test_windowed_plot(tmpdir):
+    output = str(tmpdir.join('matched.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, ['--windowed', '--plot',
+               'tests/data/source1.tif',
+               'tests/data/reference1.tif',
+               output])
+    assert result.exit_code == 2
+    assert not os.path.exists(output)
+
+
+@pytest.mark.parametrize('color_space', ['RGB', 'LCH', 'LAB', 'XYZ', 'LUV'])
+@pytest.mark.parametrize('options', [
+    [], ['--windowed'], ['--cog'], ['--max-samples', '50000'],
+    ['--save-mapping', 'mapping.npz']])
+def test_masked_source(tmpdir, color_space, options):
+    # a source of nodata only has nothing to match
+    with rasterio.open('tests/data/source2.tif') as src:
+        profile = src.profile.copy()
+    profile.update(compress='deflate')
+    src_path = str(tmpdir.join('masked.tif'))
+    with rasterio.open(src_path, 'w', **profile) as dst:
+        dst.write(np.zeros((dst.count, dst.height, dst.width), dtype='uint8'))
+
+    options = [str(tmpdir.join(o)) if o.endswith('.npz') else o
+               for o in options]
+    output = str(tmpdir.join('matched.tif'))
+    runner = CliRunner()
+    with warnings.catch_warnings():
+        # no NaN is matched or cast
+        warnings.simplefilter('error')
+        result = runner.invoke(hist, ['-c', color_space] + options + [
+            src_path, 'tests/data/reference2.tif', output])
+    assert result.exit_code == 0, result.output
+    with rasterio.open(output) as dst:
+        assert not dst.dataset_mask().any()
+
+
+@pytest.mark.parametrize('options', [[], ['--windowed'], ['-c', 'LCH']])
+def test_float_source(tmpdir, options):
+    # files are checked as arrays are, in memory and block by block
+    with rasterio.open('tests/data/source1.tif') as src:
+        profile = src.profile.copy()
+        arr = src.read()
+    profile.update(dtype='float32', compress='deflate', photometric=None)
+    src_path = str(tmpdir.join('float.tif'))
+    with rasterio.open(src_path, 'w', **profile) as dst:
+        dst.write(arr.astype('float32') / 255)
+    output = str(tmpdir.join('matched.tif'))
+    runner = CliRunner()
+    result = runner.invoke(hist, options + [
+        src_path, 'tests/data/reference1.tif', output])
+    assert isinstance(result.exception, ValueError)
+    assert str(result.exception) == (
+        "expected unsigned integer RGB bands, got dtype float32")
+    assert not os.path.exists(output)
+
+
+@pytest.mark.parametrize('windowed', [[], ['--windowed']])
+def test_ref_profile(tmpdir, windowed):
+    profile = str(tmpdir.join('ref.npz'))
+    output = str(tmpdir.join('matched.tif'))
+    expected = str(tmpdir.join('expected.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist_profile, ['-c', 'RGB', '-c', 'LCH',
+                       'tests/data/reference2.tif', profile])
+    assert result.exit_code == 0
+    result = runner.invoke(
+        hist, ['-c', 'LCH', 'tests/data/source2.tif',
+               'tests/data/reference2.tif', expected])
+    assert result.exit_code == 0
+    result = runner.invoke(
+        hist, ['-c', 'LCH', '--ref-profile', profile] + windowed +
+              ['tests/data/source2.tif', output])
+    assert result.exit_code == 0
+    with rasterio.open(output) as a, rasterio.open(expected) as b:
+        assert np.array_equal(a.read(), b.read())
+
+
+def test_ref_profile_missing_color_space(tmpdir):
+    profile = str(tmpdir.join('ref.npz'))
+    output = str(tmpdir.join('matched.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist_profile, ['tests/data/reference1.tif', profile])
+    assert result.exit_code == 0
+    result = runner.invoke(
+        hist, ['-c', 'LAB', '--ref-profile', profile,
+               'tests/data/source1.tif', output])
+    assert result.exit_code != 0
+    assert isinstance(result.exception, ValueError)
+
+
+def test_ref_profile_paths(tmpdir):
+    output = str(tmpdir.join('matched.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, ['tests/data/source1.tif', output])
+    assert result.exit_code == 2
+    result = runner.invoke(
+        hist, ['tests/data/missing.tif', 'tests/data/reference1.tif', output])
+    assert result.exit_code == 2
+
+
+@pytest.mark.parametrize('options', [
+    ['-c', 'RAW', '-b', '5'],
+    ['-c', 'RAW', '-b', '0'],
+    ['-c', 'LCH', '-b', '1,4'],
+    ['-b', '0,1'],
+    ['-b', '1,x']])
+def test_band_range(tmpdir, options):
+    # a 4-band source, of which RAW matches any band
+    src_path = str(tmpdir.join('src.tif'))
+    with rasterio.open('tests/data/source1.tif') as src:
+        profile = src.profile
+        arr = src.read()
+    profile.update(count=4)
+    with rasterio.open(src_path, 'w', **profile) as dst:
+        dst.write(np.concatenate([arr, arr[:1]]))
+    output = str(tmpdir.join('matched.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, options + [src_path, 'tests/data/reference1.tif', output])
+    assert result.exit_code == 2
+    assert '--bands' in result.output
+    assert not os.path.exists(output)
+
+
+@pytest.mark.parametrize('command', [hist_profile, hist_batch])
+def test_band_range_commands(tmpdir, command):
+    if command is hist_profile:
+        args = ['tests/data/reference1.tif', str(tmpdir.join('profile.npz'))]
+    else:
+        args = ['--ref', 'tests/data/reference1.tif', 'tests/data/source1.tif',
+                str(tmpdir.join('out'))]
+    runner = CliRunner()
+    result = runner.invoke(command, ['-b', '0'] + args)
+    assert result.exit_code == 2
+    assert '--bands' in result.output
+    assert not tmpdir.listdir()
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_hist_batch(tmpdir, jobs):
+    outdir = tmpdir.join('out')
+    expected = str(tmpdir.join('expected.tif'))
+    bad = tmpdir.join('bad.tif')
+    bad.write('not a raster')
+    runner = CliRunner()
+    result = runner.invoke(
+        hist_batch, ['-j', jobs, '--ref', 'tests/data/reference1.tif',
+                     'tests/data/source*.tif', str(bad), str(outdir)])
+    assert result.exit_code == 1
+    assert 'bad.tif' in result.output
+    assert '1 of 3 sources failed' in result.output
+    assert sorted(os.listdir(str(outdir))) == ['source1.tif', 'source2.tif']
+
+    result = runner.invoke(
+        hist, ['tests/data/source2.tif', 'tests/data/reference1.tif',
+               expected])
+    assert result.exit_code == 0
+    with rasterio.open(str(outdir.join('source2.tif'))) as a, \
+            rasterio.open(expected) as b:
+        assert np.array_equal(a.read(), b.read())
+
+
+def test_hist_batch_reference_required(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(
+        hist_batch, ['tests/data/source1.tif', str(tmpdir)])
+    assert result.exit_code == 2
+
+
+@pytest.mark.parametrize('windowed', [[], ['--windowed']])
+def test_threads(tmpdir, windowed):
+    output = str(tmpdir.join('matched.tif'))
+    threaded = str(tmpdir.join('threaded.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, ['-c', 'LCH'] + windowed +
+              ['tests/data/source2.tif', 'tests/data/reference2.tif', output])
+    assert result.exit_code == 0
+    result = runner.invoke(
+        hist, ['-c', 'LCH', '--threads', '3'] + windowed +
+              ['tests/data/source2.tif', 'tests/data/reference2.tif',
+               threaded])
+    assert result.exit_code == 0
+    with rasterio.open(output) as a, rasterio.open(threaded) as b:
+        assert np.array_equal(a.read(), b.read())
+
+
+def test_conversion_lut(tmpdir, monkeypatch):
+    monkeypatch.setenv('RIO_HIST_CACHE_DIR', str(tmpdir.mkdir('cache')))
+    output = str(tmpdir.join('matched.tif'))
+    lut = str(tmpdir.join('lut.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, ['-c', 'LAB', '--co', 'compress=deflate',
+               'tests/data/source2.tif', 'tests/data/reference2.tif', output])
+    assert result.exit_code == 0
+    result = runner.invoke(
+        hist, ['-c', 'LAB', '--conversion', 'lut', '--co', 'compress=deflate',
+               'tests/data/source2.tif', 'tests/data/reference2.tif', lut])
+    assert result.exit_code == 0
+    with rasterio.open(output) as a, rasterio.open(lut) as b:
+        diff = np.abs(a.read().astype(int) - b.read())
+    assert diff.mean() < 0.5
+    assert (diff > 2).mean() < 0.01
+
+
+@pytest.mark.parametrize('options', [
+    ['-c', 'RAW', '--plot'],
+    ['--sample-resolution', '40', '--plot'],
+    ['--sample-resolution', '40', '--max-samples', '1000'],
+    ['--sample-resolution', '0'],
+    ['--resampling', 'bilinear'],
+    ['--overlap', '--plot']])
+def test_sample_options(tmpdir, options):
+    output = str(tmpdir.join('matched.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, options + ['tests/data/source1.tif', 'tests/data/reference1.tif',
+                         output])
+    assert result.exit_code == 2
+    assert not os.path.exists(output)
+
+
+def test_cog(tmpdir):
+    output = str(tmpdir.join('matched.tif'))
+    windowed = str(tmpdir.join('windowed.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, ['-c', 'LCH', '--cog', 'tests/data/source1.tif',
+               'tests/data/reference1.tif', output])
+    assert result.exit_code == 0
+    assert os.listdir(str(tmpdir)) == ['matched.tif']
+    result = runner.invoke(
+        hist, ['-c', 'LCH', '--windowed', '--co', 'compress=deflate',
+               'tests/data/source1.tif', 'tests/data/reference1.tif',
+               windowed])
+    assert result.exit_code == 0
+    with rasterio.open(output) as cog, rasterio.open(windowed) as b:
+        assert cog.block_shapes[0] == (512, 512)
+        assert cog.overviews(1) == [2]
+        assert cog.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+        assert cog.compression.value == 'DEFLATE'
+        assert np.array_equal(cog.read(), b.read())
+
+
+def test_hist_batch_mosaic(tmpdir):
+    outdir = tmpdir.join('out')
+    runner = CliRunner()
+    result = runner.invoke(
+        hist_batch, ['--mosaic', '--mosaic-weight', 'tests/data/source2.tif',
+                     '0.5', 'tests/data/source*.tif', str(outdir)])
+    assert result.exit_code == 0
+    assert sorted(os.listdir(str(outdir))) == ['source1.tif', 'source2.tif']
+
+
+@pytest.mark.parametrize('options', [
+    ['--mosaic', '--ref', 'tests/data/reference1.tif'],
+    ['--ref', 'tests/data/reference1.tif',
+     '--mosaic-weight', 'tests/data/source1.tif', '2'],
+    ['--mosaic', '--mosaic-weight', 'tests/data/reference1.tif', '2'],
+    ['--mosaic', '--mosaic-weight', 'tests/data/source1.tif', '-1']])
+def test_hist_batch_mosaic_options(tmpdir, options):
+    runner = CliRunner()
+    result = runner.invoke(
+        hist_batch, options + ['tests/data/source*.tif', str(tmpdir)])
+    assert result.exit_code == 2
+
+
+def test_hist_profile_accumulate(tmpdir):
+    profile = str(tmpdir.join('look.npz'))
+    runner = CliRunner()
+    for ref in ('tests/data/reference1.tif', 'tests/data/reference2.tif'):
+        result = runner.invoke(
+            hist_profile, ['--accumulate', '-c', 'RGB', '-c', 'LCH', ref,
+                           profile])
+        assert result.exit_code == 0
+    result = runner.invoke(
+        hist_profile, ['--accumulate', '--remove',
+                       'tests/data/reference2.tif', profile])
+    assert result.exit_code == 0
+    expected = str(tmpdir.join('expected.npz'))
+    result = runner.invoke(
+        hist_profile, ['--accumulate', '-c', 'RGB', '-c', 'LCH',
+                       'tests/data/reference1.tif', expected])
+    assert result.exit_code == 0
+    with np.load(profile) as a, np.load(expected) as b:
+        assert sorted(a.files) == sorted(b.files)
+        for key in a.files:
+            assert np.array_equal(a[key], b[key])
+    result = runner.invoke(
+        hist, ['-c', 'LCH', '--ref-profile', profile,
+               'tests/data/source1.tif', str(tmpdir.join('out.tif'))])
+    assert result.exit_code == 0
+
+
+def test_hist_profile_remove_options(tmpdir):
+    runner = CliRunner()
+    for options in (['--remove'], ['--accumulate', '--remove']):
+        result = runner.invoke(
+            hist_profile, options + ['tests/data/reference1.tif',
+                                     str(tmpdir.join('missing.npz'))])
+        assert result.exit_code == 2
+
+
+def test_overlap(tmpdir):
+    output = str(tmpdir.join('matched.tif'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, ['-c', 'LCH', '--overlap', '--resampling', 'bilinear',
+               'tests/data/source1.tif', 'tests/data/reference1.tif', output])
+    assert result.exit_code == 0
+    assert os.path.exists(output)
+
+
+# modules that rio, which loads the plugin on every invocation, does not
+# already import
+DEFERRED = ('rio_hist.match', 'rio_hist.histogram', 'rio_hist.windowed',
+            'rio_hist.lut', 'rio_hist.raw', 'rio_hist.utils', 'rio_hist.batch',
+            'rio_hist.accumulator', 'rio_hist.reader', 'rio_color',
+            'concurrent.futures', 'multiprocessing')
+
+# import time of the plugin, in microseconds, once rio's own modules are
+# imported; it is about a tenth of that when the modules are compiled
+IMPORT_BUDGET = 30000
+
+
+def test_startup_imports():
+    script = (
+        "import sys, rasterio.rio.options; import rio_hist.scripts.cli; "
+        "print(' '.join(sys.modules))")
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', script],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    modules = proc.stdout.split()
+    assert [m for m in DEFERRED if m in modules] == []
+
+    cumulative = [int(line.split('|')[1]) for line in proc.stderr.splitlines()
+                  if line.split('|')[-1].strip() == 'rio_hist.scripts.cli']
+    assert cumulative[0] < IMPORT_BUDGET
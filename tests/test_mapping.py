@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+import rasterio
+from click.testing import CliRunner
+from rasterio.windows import Window
+
+from rio_hist.mapping import load_mapping, save_mapping
+from rio_hist.match import hist_apply_worker, hist_match_worker
+from rio_hist.reference import reference_profile, save_profile
+from rio_hist.scripts.cli import hist, hist_apply
+
+CO = {'compress': 'deflate'}
+
+
+def _read(path):
+    with rasterio.open(path) as src:
+        return src.read()
+
+
+@pytest.mark.parametrize('src,bands,color_space,kind,kwargs', [
+    ('source1', '1,2,3', 'RGB', 'rgb_lut', {}),
+    ('reference1', '1,2', 'RGB', 'rgb_lut', {}),
+    ('source2', '1,2,3', 'LCH', 'values', {}),
+    ('source1', '1,3', 'LAB', 'values', {'work_dtype': 'float32'}),
+    ('source1', '1,2,3', 'LCH', 'values', {'conversion': 'lut'}),
+    ('source2', '1,2,3', 'LCH', 'values', {'max_samples': 50000}),
+    ('source2', '1,2,3', 'RAW', 'raw_lut', {}),
+    ('source1', '1,2', 'RAW', 'values', {'max_samples': 50000}),
+])
+def test_apply_matches_hist(tmpdir, src, bands, color_space, kind, kwargs):
+    src_path = 'tests/data/{}.tif'.format(src)
+    ref_path = 'tests/data/reference2.tif'
+    expected = str(tmpdir.join('expected.tif'))
+    mapping_path = str(tmpdir.join('mapping.npz'))
+    hist_match_worker(src_path, ref_path, expected, 0.8, CO, bands,
+                      color_space, False, mapping_path=mapping_path, **kwargs)
+
+    mapping = load_mapping(mapping_path)
+    assert mapping['kind'] == kind
+    assert mapping['color_space'] == color_space.lower()
+    assert mapping['match_proportion'] == 0.8
+
+    output = str(tmpdir.join('output.tif'))
+    stats = hist_apply_worker(src_path, mapping_path, output, CO)
+    assert 'histograms' not in stats
+    result, matched = _read(output), _read(expected)
+    assert np.array_equal(result[:matched.shape[0]], matched)
+    # hist writes an alpha band only if pixels are masked, hist-apply
+    # whenever the source has a mask
+    assert (result[matched.shape[0]:] == 255).all()
+
+
+def test_save_load(tmpdir):
+    path = str(tmpdir.join('mapping.npz'))
+    mapping = {
+        'color_space': 'lch', 'bands': (0, 2), 'match_proportion': None,
+        'dtype': 'uint8', 'work_dtype': 'float64', 'conversion': 'exact',
+        'kind': 'values',
+        'tables': {0: (np.array([0.1, 0.2]), np.array([0.15, 0.3])),
+                   2: (np.array([1.0]), np.array([2.0]))}}
+    save_mapping(path, mapping)
+    loaded = load_mapping(path)
+    tables = loaded.pop('tables')
+    assert loaded == dict((k, v) for k, v in mapping.items()
+                          if k != 'tables')
+    assert sorted(tables) == [0, 2]
+    for b, (values, mapped) in mapping['tables'].items():
+        assert np.array_equal(tables[b][0], values)
+        assert np.array_equal(tables[b][1], mapped)
+
+
+def test_not_a_mapping(tmpdir):
+    path = str(tmpdir.join('profile.npz'))
+    save_profile(path, reference_profile('tests/data/reference1.tif'))
+    with pytest.raises(ValueError):
+        load_mapping(path)
+
+
+@pytest.mark.parametrize('color_space', ['RGB', 'LCH'])
+def test_apply_to_other_raster(tmpdir, color_space):
+    # the mapping of a tile, applied to the whole scene, matches the
+    # tile as hist does and maps the rest of the scene too
+    with rasterio.open('tests/data/source2.tif') as src:
+        profile = src.profile.copy()
+        window = Window(0, 0, 400, src.height)
+        tile = src.read(window=window)
+        transform = src.transform
+    profile.update(CO, width=tile.shape[2], transform=transform)
+    tile_path = str(tmpdir.join('tile.tif'))
+    with rasterio.open(tile_path, 'w', **profile) as dst:
+        dst.write(tile)
+
+    expected = str(tmpdir.join('expected.tif'))
+    mapping_path = str(tmpdir.join('mapping.npz'))
+    hist_match_worker(tile_path, 'tests/data/reference2.tif', expected, 1.0,
+                      CO, '1,2,3', color_space, False,
+                      mapping_path=mapping_path)
+
+    output = str(tmpdir.join('output.tif'))
+    hist_apply_worker('tests/data/source2.tif', mapping_path, output, CO)
+    with rasterio.open(output) as dst:
+        assert dst.count == 4
+        assert np.array_equal(dst.read(window=window), _read(expected))
+        rest = dst.read(window=Window(400, 0, dst.width - 400, dst.height))
+    source = _read('tests/data/source2.tif')[:, :, 400:]
+    assert not np.array_equal(rest[:3], source)
+
+
+def test_dtype_mismatch(tmpdir):
+    mapping_path = str(tmpdir.join('mapping.npz'))
+    hist_match_worker('tests/data/reference1.tif', 'tests/data/reference2.tif',
+                      str(tmpdir.join('matched.tif')), 1.0, CO, '1,2,3',
+                      'RGB', False, mapping_path=mapping_path)
+    with pytest.raises(ValueError):
+        hist_apply_worker('tests/data/source1.tif', mapping_path,
+                          str(tmpdir.join('output.tif')), CO)
+
+
+@pytest.mark.parametrize('bands,color_space', [
+    ('1,2,3', 'LCH'), ('1,3', 'RAW'), ('1,2,3', 'RGB')])
+def test_band_count_mismatch(tmpdir, bands, color_space):
+    mapping_path = str(tmpdir.join('mapping.npz'))
+    hist_match_worker('tests/data/source1.tif', 'tests/data/reference2.tif',
+                      str(tmpdir.join('matched.tif')), 1.0, CO, bands,
+                      color_space, False, mapping_path=mapping_path)
+    with rasterio.open('tests/data/source1.tif') as src:
+        profile = src.profile.copy()
+        arr = src.read(1)
+    profile.update(CO, count=1)
+    single = str(tmpdir.join('single.tif'))
+    with rasterio.open(single, 'w', **profile) as dst:
+        dst.write(arr, 1)
+    with pytest.raises(ValueError, match='cannot be applied'):
+        hist_apply_worker(single, mapping_path,
+                          str(tmpdir.join('output.tif')), CO)
+
+
+def test_cli(tmpdir):
+    expected = str(tmpdir.join('expected.tif'))
+    output = str(tmpdir.join('output.tif'))
+    mapping_path = str(tmpdir.join('mapping.npz'))
+    runner = CliRunner()
+    result = runner.invoke(hist, [
+        '-c', 'LCH', '--save-mapping', mapping_path, '--co', 'compress=deflate',
+        'tests/data/source1.tif', 'tests/data/reference1.tif', expected])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(hist_apply, [
+        '--co', 'compress=deflate', 'tests/data/source1.tif', mapping_path,
+        output])
+    assert result.exit_code == 0, result.output
+    assert np.array_equal(_read(output), _read(expected))
+
+    result = runner.invoke(hist, [
+        '--plot', '--save-mapping', mapping_path, 'tests/data/source1.tif',
+        'tests/data/reference1.tif', expected])
+    assert result.exit_code == 2
+
+    profile_path = str(tmpdir.join('profile.npz'))
+    save_profile(profile_path, reference_profile('tests/data/reference1.tif'))
+    result = runner.invoke(hist_apply, [
+        'tests/data/source1.tif', profile_path, output])
+    assert result.exit_code == 2
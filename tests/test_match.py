@@ -0,0 +1,227 @@
+import numpy as np
+import pytest
+import rasterio
+
+from rio_hist.histogram import (
+    apply_mapping, build_mapping, cdf_match_values, value_counts)
+from rio_hist.lut import rgb_lookup_table
+from rio_hist.match import histogram_match
+from rio_hist.reference import (
+    load_profile, profile_histograms, reference_profile, save_profile)
+from rio_hist.utils import cs_backward, cs_forward
+
+
+@pytest.fixture
+def rgb_bands():
+    with rasterio.open('tests/data/source2.tif') as src:
+        src_arr = src.read(masked=True)
+    with rasterio.open('tests/data/reference2.tif') as ref:
+        ref_arr = ref.read(masked=True)
+    src_mask = np.ma.getmaskarray(src_arr)[0]
+    ref_mask = np.ma.getmaskarray(ref_arr)[0]
+    return src_arr.filled(), src_mask, ref_arr.filled(), ref_mask
+
+
+def _match(src, src_mask, ref, ref_mask, **kwargs):
+    return histogram_match(
+        np.ma.array(src, mask=src_mask, fill_value=0),
+        np.ma.array(ref, mask=ref_mask), **kwargs)
+
+
+@pytest.mark.parametrize('method', ['bincount', 'auto'])
+@pytest.mark.parametrize('color_space', ['RGB', 'LCH'])
+def test_exact_methods(rgb_bands, method, color_space):
+    src, src_mask, ref, ref_mask = rgb_bands
+    src = cs_forward(src, color_space)[1]
+    ref = cs_forward(ref, color_space)[1]
+    expected = _match(src, src_mask, ref, ref_mask, method='unique')
+    if method == 'bincount' and color_space != 'RGB':
+        return
+    result = _match(src, src_mask, ref, ref_mask, method=method)
+    assert np.array_equal(result.mask, expected.mask)
+    assert np.array_equal(result.compressed(), expected.compressed())
+
+
+def test_integer_bincount(rgb_bands):
+    src, _, ref, _ = rgb_bands
+    expected = histogram_match(src[0], ref[0], method='unique')
+    result = histogram_match(src[0], ref[0], method='bincount')
+    assert np.array_equal(result, expected)
+
+
+def test_quantized_bincount(rgb_bands):
+    src, src_mask, ref, ref_mask = rgb_bands
+    src = cs_forward(src, 'LCH')[0]
+    ref = cs_forward(ref, 'LCH')[0]
+    expected = _match(src, src_mask, ref, ref_mask, method='unique')
+    result = _match(src, src_mask, ref, ref_mask, method='bincount')
+    diff = np.abs(result.compressed() - expected.compressed())
+    diff /= np.ptp(ref[~ref_mask])
+    assert diff.mean() < 1e-4
+    assert np.percentile(diff, 99.9) < 1e-2
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        histogram_match(np.zeros(4), np.zeros(4), method='sort')
+
+
+def test_profile_roundtrip(tmpdir):
+    path = str(tmpdir.join('ref.npz'))
+    profile = reference_profile(
+        'tests/data/reference1.tif', ('RGB', 'Lab'), '1,3')
+    save_profile(path, profile)
+    loaded = load_profile(path)
+    assert sorted(loaded) == ['lab', 'rgb']
+    for cs in loaded:
+        assert sorted(loaded[cs]) == [0, 2]
+        for b, (values, counts) in loaded[cs].items():
+            assert np.array_equal(values, profile[cs][b][0])
+            assert np.array_equal(counts, profile[cs][b][1])
+    hists = profile_histograms(loaded, 'LAB', (0, 2))
+    assert sorted(hists) == [0, 2]
+    with pytest.raises(ValueError):
+        profile_histograms(loaded, 'LAB', (1,))
+
+
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16'])
+@pytest.mark.parametrize('match_proportion', [1.0, 0.6])
+def test_rgb_lookup_table(dtype, match_proportion):
+    rng = np.random.RandomState(0)
+    maxval = np.iinfo(dtype).max
+    src = (rng.beta(2, 5, (1, 200, 300)) * maxval).astype(dtype)
+    ref = (rng.beta(5, 2, (1, 100, 100)) * 255).astype('uint8')
+    src_norm = cs_forward(np.repeat(src, 3, axis=0), 'RGB')[0]
+    ref_norm = cs_forward(np.repeat(ref, 3, axis=0), 'RGB')[0]
+    expected = histogram_match(src_norm, ref_norm, match_proportion)
+    expected = cs_backward(expected[np.newaxis], 'RGB')[0]
+
+    lut = rgb_lookup_table(value_counts(src_norm), value_counts(ref_norm),
+                           maxval, match_proportion)
+    assert lut.dtype == np.uint8
+    assert lut.shape == (maxval + 1, )
+    assert np.array_equal(lut[src[0]], expected)
+
+
+def test_empty_source_identity():
+    empty = (np.zeros(0), np.zeros(0, dtype='int64'))
+    ref = value_counts(np.linspace(0, 1, 100))
+    assert cdf_match_values(np.zeros(0), np.zeros(0), *ref).size == 0
+    lut = rgb_lookup_table(empty, ref, 255)
+    assert np.array_equal(lut, np.arange(256))
+
+
+@pytest.fixture
+def lut_cache(tmpdir, monkeypatch):
+    from rio_hist import colorlut
+    monkeypatch.setenv('RIO_HIST_CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(colorlut, '_tables', {})
+    return tmpdir
+
+
+def test_lut_forward(rgb_bands, lut_cache):
+    from rio_hist import colorlut
+    src = rgb_bands[0]
+    exact = cs_forward(src, 'LAB')
+    assert np.abs(cs_forward(src, 'LAB', conversion='lut') - exact).max() < 1e-4
+    assert lut_cache.join('forward_lab.npy').check()
+
+    # cached on disk
+    colorlut._tables.clear()
+    table = colorlut.forward_table('LAB')
+    assert isinstance(table, np.memmap)
+
+
+def test_lut_forward_16bit(lut_cache):
+    arr = np.arange(3 * 64, dtype='uint16').reshape(3, 8, 8) * 300
+    assert np.array_equal(cs_forward(arr, 'LAB', conversion='lut'),
+                          cs_forward(arr, 'LAB'))
+    assert not lut_cache.listdir()
+
+
+@pytest.mark.parametrize('color_space', ['LCH', 'XYZ'])
+def test_lut_backward(rgb_bands, lut_cache, color_space):
+    from rio_hist.colorlut import lut_backward
+    src = rgb_bands[0]
+    arr = cs_forward(src, color_space)
+    exact = cs_backward(arr, color_space).astype(int)
+    diff = np.abs(lut_backward(arr, color_space, size=65) - exact)
+    assert diff.mean() < 2
+    assert (diff > 8).mean() < 0.05
+
+
+@pytest.mark.parametrize('method', ['unique', 'auto'])
+def test_valid_matches_masked(rgb_bands, method):
+    src, src_mask, ref, ref_mask = rgb_bands
+    src = cs_forward(src, 'LCH')[0]
+    ref = cs_forward(ref, 'LCH')[0]
+    expected = _match(src, src_mask, ref, ref_mask, method=method)
+    result = histogram_match(
+        src, value_counts(ref[~ref_mask], method), method=method,
+        valid=~src_mask)
+    assert not isinstance(result, np.ma.MaskedArray)
+    assert np.array_equal(result[~src_mask], expected[~src_mask])
+    assert np.array_equal(result[src_mask], src[src_mask])
+
+
+def test_valid_integer_source(rgb_bands):
+    src, src_mask, ref, ref_mask = rgb_bands
+    expected = _match(src[0], src_mask, ref[0], ref_mask)
+    result = histogram_match(src[0], ref[0][~ref_mask], valid=~src_mask)
+    assert result.dtype == np.float64
+    assert np.array_equal(result[~src_mask], expected[~src_mask])
+    assert np.array_equal(result[src_mask], src[0][src_mask])
+
+
+@pytest.mark.parametrize('match_proportion', [1.0, 0.5])
+def test_mapping_matches_histogram_match(rgb_bands, match_proportion):
+    src, _, ref, _ = rgb_bands
+    src = cs_forward(src, 'LCH')[1]
+    ref = cs_forward(ref, 'LCH')[1]
+    expected = histogram_match(src, ref, match_proportion, method='unique')
+    mapping = build_mapping(value_counts(src, 'unique'),
+                            value_counts(ref, 'unique'), match_proportion)
+
+    assert np.array_equal(apply_mapping(src, mapping), expected)
+    # in place, by blocks of rows
+    for rows in (slice(0, 100), slice(100, None)):
+        block = src[rows].copy()
+        assert apply_mapping(block, mapping, out=block) is block
+        assert np.array_equal(block, expected[rows])
+
+
+def test_apply_mapping_valid_and_interpolate():
+    mapping = (np.array([0.0, 1.0, 2.0]), np.array([10.0, 20.0, 40.0]))
+    arr = np.array([[0.0, 2.0], [1.0, 5.0]])
+    valid = np.array([[True, True], [True, False]])
+    assert np.array_equal(apply_mapping(arr, mapping, valid),
+                          [[10.0, 40.0], [20.0, 5.0]])
+    assert np.array_equal(apply_mapping(np.array([0.5, 1.5]), mapping),
+                          [15.0, 30.0])
+    assert np.array_equal(
+        apply_mapping(np.array([1.0]), mapping, interpolate=True), [20.0])
+    with pytest.raises(ValueError):
+        apply_mapping(arr, mapping, out=np.empty((4, 4)))
+
+
+def test_apply_mapping_integer_lut():
+    rng = np.random.RandomState(0)
+    arr = rng.randint(-100, 1000, size=(300, 400)).astype('int16')
+    values = np.unique(arr[::2])
+    mapping = values, np.sqrt(values - values[0] + 1.0)
+    expected = np.interp(arr, *mapping)
+    assert np.array_equal(apply_mapping(arr, mapping), expected)
+    assert np.array_equal(apply_mapping(arr.astype('float64'), mapping),
+                          expected)
+
+
+def test_unique_match_nan():
+    # NaNs are one value, sorted last, as by np.unique
+    src = np.array([3.0, np.nan, 1.0, np.nan, 2.0, 1.0])
+    ref = np.arange(10.0)
+    values, inverse, counts = np.unique(
+        src, return_inverse=True, return_counts=True)
+    expected = cdf_match_values(
+        values, counts, *value_counts(ref, 'unique'))[inverse]
+    result = histogram_match(src, ref, method='unique')
+    assert np.array_equal(result, expected)
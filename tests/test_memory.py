@@ -0,0 +1,121 @@
+import tracemalloc
+
+from affine import Affine
+import numpy as np
+import pytest
+import rasterio
+
+from rio_hist.match import hist_match_worker
+from rio_hist.utils import cs_backward, cs_forward
+
+
+def _make_raster(path, seed, size=512):
+    rng = np.random.RandomState(seed)
+    # smooth, image-like values rather than noise
+    ramp = np.linspace(0, 200, size)
+    arr = np.array([ramp[:, None] + ramp[None, :] * k / 4 for k in (1, 2, 3)])
+    arr += rng.randint(0, 30, arr.shape)
+    arr = np.clip(arr, 0, 255).astype('uint8')
+    profile = {
+        'driver': 'GTiff', 'dtype': 'uint8', 'count': 3,
+        'width': size, 'height': size, 'crs': 'EPSG:3857',
+        'transform': Affine(10.0, 0.0, 0.0, 0.0, -10.0, 0.0),
+        'tiled': True, 'blockxsize': 128, 'blockysize': 128}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr)
+    return arr.nbytes
+
+
+@pytest.fixture
+def rasters(tmpdir):
+    src_path = str(tmpdir.join('src.tif'))
+    ref_path = str(tmpdir.join('ref.tif'))
+    nbytes = _make_raster(src_path, 0)
+    _make_raster(ref_path, 1)
+    return src_path, ref_path, str(tmpdir.join('dst.tif')), nbytes
+
+
+def _peak(func, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_windowed_peak_memory(rasters):
+    src_path, ref_path, dst_path, nbytes = rasters
+    peak = _peak(hist_match_worker, src_path, ref_path, dst_path, 1.0, {},
+                 '1,2,3', 'RGB', False, windowed=True)
+    assert peak < 3 * nbytes
+
+
+def test_windowed_float_peak_memory(tmpdir):
+    # float histograms are binned, so peak memory does not grow with
+    # the size of the raster
+    peaks = []
+    for size in (640, 1280):
+        src_path = str(tmpdir.join('src{}.tif'.format(size)))
+        ref_path = str(tmpdir.join('ref{}.tif'.format(size)))
+        _make_raster(src_path, 0, size)
+        _make_raster(ref_path, 1, size)
+        peaks.append(_peak(
+            hist_match_worker, src_path, ref_path,
+            str(tmpdir.join('dst.tif')), 1.0, {}, '1,2,3', 'LAB', False,
+            windowed=True))
+    assert peaks[1] < 1.2 * peaks[0]
+
+
+def test_windowed_binned_close_to_exact(tmpdir):
+    src_path = str(tmpdir.join('src.tif'))
+    ref_path = str(tmpdir.join('ref.tif'))
+    _make_raster(src_path, 0, 640)
+    _make_raster(ref_path, 1, 640)
+    outputs = []
+    for windowed in (False, True):
+        dst_path = str(tmpdir.join('dst{}.tif'.format(windowed)))
+        hist_match_worker(src_path, ref_path, dst_path, 1.0, {}, '1,2,3',
+                          'LAB', False, windowed=windowed)
+        with rasterio.open(dst_path) as dst:
+            outputs.append(dst.read().astype(int))
+    assert np.abs(outputs[0] - outputs[1]).max() <= 1
+
+
+def test_lut_peak_memory(rasters):
+    src_path, ref_path, dst_path, nbytes = rasters
+    peak = _peak(hist_match_worker, src_path, ref_path, dst_path, 1.0, {},
+                 '1,2,3', 'RGB', False)
+    assert peak < 3 * nbytes
+
+
+def test_float32_peak_memory(tmpdir):
+    # RGB is matched by lookup tables, without float arrays, so the
+    # work dtype is measured in LAB, on a raster of more than one chunk
+    # of the color space conversions and more distinct values than an
+    # exact histogram holds
+    size = 1536
+    src_path = str(tmpdir.join('src.tif'))
+    ref_path = str(tmpdir.join('ref.tif'))
+    dst_path = str(tmpdir.join('dst.tif'))
+    _make_raster(src_path, 0, size)
+    _make_raster(ref_path, 1, size)
+    peak64 = _peak(hist_match_worker, src_path, ref_path, dst_path, 1.0, {},
+                   '1,2,3', 'LAB', False)
+    peak32 = _peak(hist_match_worker, src_path, ref_path, dst_path, 1.0, {},
+                   '1,2,3', 'LAB', False, work_dtype='float32')
+    assert peak32 < 0.75 * peak64
+    # the source in LAB, beside which only the 8-bit source and output
+    # and temporaries of bounded size are held
+    working_set = 3 * size * size * 4
+    assert peak32 < 2.5 * working_set
+
+
+@pytest.mark.parametrize('color_space', ['RGB', 'LCH'])
+def test_float32_roundtrip(color_space):
+    with rasterio.open('tests/data/source1.tif') as src:
+        arr = src.read()
+    rgb = cs_forward(arr, color_space, dtype='float32')
+    assert rgb.dtype == np.float32
+    diff = cs_backward(rgb, color_space).astype(int) - arr
+    assert np.abs(diff).max() <= 1
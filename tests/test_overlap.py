@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from rio_hist.match import hist_match_worker
+from rio_hist.overlap import clip_windows, overlap_window, reference_area
+
+CO = {'compress': 'deflate'}
+
+
+def _write(path, arr, transform, crs, nodata=None):
+    profile = {'driver': 'GTiff', 'count': arr.shape[0], 'dtype': arr.dtype,
+               'height': arr.shape[1], 'width': arr.shape[2],
+               'transform': transform, 'crs': crs, 'nodata': nodata,
+               'compress': 'deflate'}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr)
+
+
+def _crop(src, window):
+    """Transform of a window of src"""
+    t = src.transform
+    return Affine(t.a, t.b, t.c + window.col_off * t.a,
+                  t.d, t.e, t.f + window.row_off * t.e)
+
+
+@pytest.fixture
+def scene(tmpdir):
+    """A source scene within a larger reference, and the reference
+    cropped to the scene"""
+    window = Window(200, 150, 300, 250)
+    with rasterio.open('tests/data/reference2.tif') as ref:
+        data = ref.read()
+        crop = ref.read(window=window)
+        transform, crs = _crop(ref, window), ref.crs
+    with rasterio.open('tests/data/source2.tif') as src:
+        source = src.read(window=window)
+    paths = dict((name, str(tmpdir.join(name + '.tif')))
+                 for name in ('source', 'reference', 'cropped'))
+    _write(paths['source'], source, transform, crs, 0)
+    _write(paths['cropped'], crop, transform, crs, 0)
+    with rasterio.open('tests/data/reference2.tif') as ref:
+        _write(paths['reference'], data, ref.transform, crs, 0)
+    return paths, window
+
+
+def test_overlap_window(scene):
+    paths, window = scene
+    with rasterio.open(paths['source']) as src, \
+            rasterio.open(paths['reference']) as ref:
+        assert overlap_window(src, ref) == window
+        assert overlap_window(ref, src) == Window(0, 0, 300, 250)
+
+
+def test_overlap_window_reprojected():
+    with rasterio.open('tests/data/source1.tif') as src, \
+            rasterio.open('tests/data/reference1.tif') as ref:
+        window = overlap_window(src, ref)
+        assert window.width <= ref.width and window.height <= ref.height
+        assert window.width > 0 and window.height > 0
+
+
+def test_no_overlap(tmpdir, scene):
+    paths, _ = scene
+    far = str(tmpdir.join('far.tif'))
+    with rasterio.open(paths['source']) as src:
+        t = src.transform
+        _write(far, src.read(), Affine(t.a, 0, t.c + 1e7, 0, t.e, t.f),
+               src.crs)
+    with rasterio.open(far) as src, \
+            rasterio.open(paths['reference']) as ref:
+        with pytest.raises(ValueError):
+            overlap_window(src, ref)
+
+
+def test_clip_windows():
+    windows = [Window(0, 0, 10, 10), Window(10, 0, 10, 10),
+               Window(0, 10, 10, 10)]
+    assert clip_windows(windows, Window(5, 5, 5, 3)) == [Window(5, 5, 5, 3)]
+    assert clip_windows(windows, Window(5, 8, 10, 4)) == [
+        Window(5, 8, 5, 2), Window(10, 8, 5, 2), Window(5, 10, 5, 2)]
+
+
+@pytest.mark.parametrize('color_space', ['RGB', 'LCH'])
+@pytest.mark.parametrize('kwargs', [{}, {'windowed': True},
+                                    {'read_threads': 3}])
+def test_overlap_matches_cropped_reference(tmpdir, scene, color_space,
+                                           kwargs):
+    paths, _ = scene
+    expected = str(tmpdir.join('expected.tif'))
+    output = str(tmpdir.join('output.tif'))
+    hist_match_worker(paths['source'], paths['cropped'], expected, 1.0, CO,
+                      '1,2,3', color_space, False, **kwargs)
+    stats = hist_match_worker(
+        paths['source'], paths['reference'], output, 1.0, CO, '1,2,3',
+        color_space, False, overlap=True, **kwargs)
+    with rasterio.open(expected) as a, rasterio.open(output) as b:
+        assert np.array_equal(a.read(), b.read())
+    # only the overlap of the reference is read
+    with rasterio.open(paths['cropped']) as crop:
+        assert stats['reference_histograms'].bytes_read == \
+            crop.count * crop.width * crop.height
+
+
+def test_overlap_resampled(tmpdir, scene):
+    paths, _ = scene
+    expected = str(tmpdir.join('expected.tif'))
+    output = str(tmpdir.join('output.tif'))
+    # on the same grid, nearest resampling reads the same pixels
+    hist_match_worker(paths['source'], paths['cropped'], expected, 1.0, CO,
+                      '1,2,3', 'LCH', False)
+    hist_match_worker(paths['source'], paths['reference'], output, 1.0, CO,
+                      '1,2,3', 'LCH', False, overlap=True,
+                      resampling='nearest')
+    with rasterio.open(expected) as a, rasterio.open(output) as b:
+        assert np.array_equal(a.read(), b.read())
+
+
+def test_resampled_masks_outside(tmpdir):
+    # the source extends beyond the reference: its pixels outside the
+    # reference are masked in the resampled reference
+    with rasterio.open('tests/data/reference2.tif') as ref:
+        t, crs = ref.transform, ref.crs
+        source = ref.read()
+    src_path = str(tmpdir.join('shifted.tif'))
+    shift = Affine(t.a, 0, t.c - 100 * t.a, 0, t.e, t.f)
+    _write(src_path, source, shift, crs)
+    with reference_area(src_path, 'tests/data/reference2.tif',
+                        'bilinear') as (vrt, window):
+        assert window == Window(100, 0, source.shape[2] - 100,
+                                source.shape[1])
+        valid = vrt.dataset_mask() > 0
+        assert not valid[:, :100].any()
+
+
+def test_overlap_options():
+    args = ('tests/data/source1.tif', 'tests/data/reference1.tif',
+            '/tmp/unused.tif', 1.0, CO, '1,2,3', 'RGB')
+    with pytest.raises(ValueError):
+        hist_match_worker(*args, plot=False, resampling='bilinear')
+    with pytest.raises(ValueError):
+        hist_match_worker(*args, plot=True, overlap=True)
+    with pytest.raises(ValueError):
+        hist_match_worker(*args, plot=False, overlap=True,
+                          resampling='unknown')
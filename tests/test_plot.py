@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+
+from rio_hist.match import hist_match_worker
+from rio_hist.plot import _rgb_histogram, read_preview
+
+
+def test_plot_imports():
+    code = ("import sys, rio_hist.match, rio_hist.plot; "
+            "print('matplotlib' in sys.modules)")
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.strip() == b'False'
+
+
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16'])
+def test_rgb_histogram(dtype):
+    maxval = np.iinfo(dtype).max
+    band = np.random.RandomState(0).randint(0, maxval + 1, 10000).astype(dtype)
+    valid = band > 10
+    expected, _ = np.histogram(band[valid] / maxval, 32, [0, 1])
+    assert np.allclose(_rgb_histogram(band, valid, 32),
+                       expected / valid.sum())
+
+
+def test_read_preview():
+    arr, valid = read_preview('tests/data/source2.tif', max_size=100)
+    assert arr.shape[0] == 3 and max(arr.shape[1:]) <= 100
+    assert valid.shape == arr.shape[1:]
+    assert not valid.all()
+
+
+def test_plot(tmpdir):
+    output = str(tmpdir.join('matched.tif'))
+    hist_match_worker('tests/data/source2.tif', 'tests/data/reference2.tif',
+                      output, 1.0, {}, '1,2,3', 'LCH', True)
+    assert tmpdir.join('matched_plot.png').size() > 0
@@ -0,0 +1,97 @@
+import os
+
+from affine import Affine
+import numpy as np
+import pytest
+import rasterio
+
+from rio_hist.histogram import histogram_match
+from rio_hist.match import hist_match_worker
+from rio_hist.raw import raw_lookup_table
+
+
+def write(path, arr, **kwargs):
+    profile = {
+        'driver': 'GTiff', 'dtype': arr.dtype.name, 'count': arr.shape[0],
+        'height': arr.shape[1], 'width': arr.shape[2], 'crs': 'EPSG:3857',
+        'transform': Affine(10.0, 0.0, 0.0, 0.0, -10.0, 0.0),
+        'tiled': True, 'blockxsize': 128, 'blockysize': 128}
+    profile.update(kwargs)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr)
+    return path
+
+
+@pytest.fixture(params=['uint16', 'int16', 'float32'])
+def rasters(tmpdir, request):
+    rng = np.random.RandomState(0)
+    dtype = request.param
+    offset = -3000 if dtype == 'int16' else 0
+    src = (rng.gamma(2, 800, (4, 200, 300)) + 1 + offset).astype(dtype)
+    ref = (rng.normal(12000, 3000, (4, 150, 250)) + offset).astype(dtype)
+    src[src == 0] = 1
+    src[:, :20] = 0
+    return (write(str(tmpdir.join('src.tif')), src, nodata=0),
+            write(str(tmpdir.join('ref.tif')), ref), src, ref)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'cog': True}])
+def test_raw(tmpdir, rasters, kwargs):
+    src_path, ref_path, src, ref = rasters
+    output = str(tmpdir.join('matched.tif'))
+    hist_match_worker(src_path, ref_path, output, 1.0, {}, '1,2,4', 'RAW',
+                      False, **kwargs)
+    with rasterio.open(output) as dst:
+        assert dst.count == 4
+        assert dst.dtypes[0] == src.dtype.name
+        assert dst.nodata == 0
+        out = dst.read()
+    valid = src[0] != 0
+    assert (out[:, ~valid] == 0).all()
+    assert np.array_equal(out[2], src[2])
+    for b in (0, 1, 3):
+        expected = histogram_match(
+            src[b][valid].astype('float64'), ref[b].astype('float64'))
+        if src.dtype.kind != 'f':
+            expected = np.rint(expected)
+        assert np.array_equal(out[b][valid], expected.astype(src.dtype))
+
+
+def test_raw_mask(tmpdir):
+    rng = np.random.RandomState(0)
+    src = rng.randint(0, 4096, (5, 200, 300)).astype('uint16')
+    src_path = write(str(tmpdir.join('src.tif')), src)
+    with rasterio.open(src_path, 'r+') as dst:
+        mask = np.full((200, 300), 255, dtype='uint8')
+        mask[:, :30] = 0
+        dst.write_mask(mask)
+    output = str(tmpdir.join('matched.tif'))
+    hist_match_worker(src_path, 'tests/data/reference1.tif', output, 0.5, {},
+                      '1,2,3', 'RAW', False)
+    with rasterio.open(output) as dst:
+        assert dst.count == 5 and dst.nodata is None
+        assert np.array_equal(dst.dataset_mask(), mask)
+        valid = mask > 0
+        assert np.array_equal(dst.read(5)[valid], src[4][valid])
+
+
+@pytest.mark.parametrize('bands', ['1,5', '0,1', '1,x'])
+def test_raw_band_range(tmpdir, rasters, bands):
+    src_path, ref_path, _, _ = rasters
+    output = str(tmpdir.join('matched.tif'))
+    with pytest.raises(ValueError, match='band'):
+        hist_match_worker(src_path, ref_path, output, 1.0, {}, bands, 'RAW',
+                          False)
+    assert not os.path.exists(output)
+
+
+def test_raw_lookup_table():
+    rng = np.random.RandomState(0)
+    source = rng.randint(-500, 500, 10000).astype('int16')
+    reference = rng.normal(0, 100, 5000)
+    s_values, s_counts = np.unique(source, return_counts=True)
+    r_hist = np.unique(reference, return_counts=True)
+    lut = raw_lookup_table((s_values, s_counts), r_hist, 'int16', 0.7)
+    assert lut.dtype == np.int16 and lut.size == 65536
+    expected = np.rint(histogram_match(source, reference, 0.7))
+    assert np.array_equal(lut[source.astype(int) + 32768], expected)
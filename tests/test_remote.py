@@ -0,0 +1,171 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+import rasterio
+from click.testing import CliRunner
+
+from rio_hist.match import hist_match_worker
+from rio_hist.reader import (
+    REMOTE_OPTIONS, basename, gdal_options, is_remote, read_raster,
+    read_windows)
+from rio_hist.scripts.cli import hist
+
+DATA = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
+CO = {'compress': 'deflate'}
+
+# an HTTP server of tests/data answering range requests, run in its own
+# process: GDAL holds the GIL while it waits for responses
+SERVER = textwrap.dedent('''
+    import functools, http.server, os, re, sys
+
+    class RangeHandler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send_head(self):
+            rng = self.headers.get('Range')
+            path = self.translate_path(self.path)
+            if not rng or not os.path.isfile(path):
+                self.remaining = None
+                return super().send_head()
+            size = os.path.getsize(path)
+            start, end = re.match(r'bytes=(\\d+)-(\\d*)', rng).groups()
+            start, end = int(start), min(int(end or size - 1), size - 1)
+            f = open(path, 'rb')
+            f.seek(start)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            self.remaining = end - start + 1
+            return f
+
+        def copyfile(self, source, outputfile):
+            if self.remaining is None:
+                return super().copyfile(source, outputfile)
+            outputfile.write(source.read(self.remaining))
+
+    srv = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        functools.partial(RangeHandler, directory=sys.argv[1]))
+    print(srv.server_address[1], flush=True)
+    srv.serve_forever()
+''')
+
+
+@pytest.fixture(scope='module')
+def server():
+    proc = subprocess.Popen([sys.executable, '-c', SERVER, DATA],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        port = int(proc.stdout.readline())
+        yield 'http://127.0.0.1:{}/'.format(port)
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_is_remote():
+    assert is_remote('https://example.com/a.tif')
+    assert is_remote('s3://bucket/a.tif')
+    assert is_remote('/vsis3/bucket/a.tif')
+    assert not is_remote('tests/data/source1.tif')
+    assert not is_remote(None)
+
+
+def test_basename():
+    assert basename('https://example.com/x/a.tif?sig=1/2') == 'a.tif'
+    assert basename('/vsicurl/http://example.com/a.tif') == 'a.tif'
+    assert basename('tests/data/source1.tif') == 'source1.tif'
+
+
+def test_gdal_options(monkeypatch):
+    assert gdal_options(['tests/data/source1.tif', None]) == {}
+    assert gdal_options(['a.tif'], 256) == {'GDAL_CACHEMAX': 256}
+    options = gdal_options(['a.tif', 's3://bucket/b.tif'])
+    assert options == REMOTE_OPTIONS
+
+    # the environment wins
+    monkeypatch.setenv('VSI_CACHE', 'FALSE')
+    assert 'VSI_CACHE' not in gdal_options(['s3://bucket/b.tif'])
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_read_windows_in_order(threads):
+    path = os.path.join(DATA, 'source1.tif')
+    with rasterio.open(path) as src:
+        windows = [w for _, w in src.block_windows(1)]
+        expected = [(src.read(window=w), src.dataset_mask(window=w) > 0)
+                    for w in windows]
+    reads = list(read_windows(path, windows, threads=threads))
+    assert len(reads) == len(expected)
+    for (arr, valid), (exp_arr, exp_valid) in zip(reads, expected):
+        assert np.array_equal(arr, exp_arr)
+        assert np.array_equal(valid, exp_valid)
+
+
+def test_read_raster(tmpdir):
+    path = os.path.join(DATA, 'source1.tif')
+    arr, valid = read_raster(path, (1, 2, 3), threads=4)
+    with rasterio.open(path) as src:
+        assert np.array_equal(arr, src.read((1, 2, 3)))
+        if valid is not None:
+            assert np.array_equal(valid, src.dataset_mask() > 0)
+
+    # a mask is returned only if some pixels are masked
+    masked = str(tmpdir.join('masked.tif'))
+    with rasterio.open(path) as src:
+        profile = src.profile.copy()
+        data = src.read()
+    profile.update(compress='deflate', nodata=0)
+    data[:, :10, :10] = 0
+    with rasterio.open(masked, 'w', **profile) as dst:
+        dst.write(data)
+    arr, valid = read_raster(masked, threads=3)
+    assert np.array_equal(arr, data)
+    assert not valid[:10, :10].any()
+    assert valid[10:, 10:].all()
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'color_space': 'LCH'},
+    {'windowed': True},
+    {'color_space': 'LAB', 'windowed': True},
+])
+def test_remote_matches_local(tmpdir, server, kwargs):
+    kwargs = dict({'color_space': 'RGB'}, **kwargs)
+    color_space = kwargs.pop('color_space')
+    local = str(tmpdir.join('local.tif'))
+    hist_match_worker(
+        os.path.join(DATA, 'source1.tif'),
+        os.path.join(DATA, 'reference1.tif'),
+        local, 1.0, CO, '1,2,3', color_space, False, **kwargs)
+    with rasterio.open(local) as src:
+        expected = src.read()
+
+    for prefix in ('', '/vsicurl/'):
+        remote = str(tmpdir.join('remote.tif'))
+        hist_match_worker(
+            prefix + server + 'source1.tif',
+            prefix + server + 'reference1.tif',
+            remote, 1.0, CO, '1,2,3', color_space, False, read_threads=4,
+            **kwargs)
+        with rasterio.open(remote) as src:
+            assert np.array_equal(src.read(), expected)
+
+
+def test_cli_remote(tmpdir, server):
+    output = str(tmpdir.join('remote.tif'))
+    runner = CliRunner()
+    result = runner.invoke(hist, [
+        server + 'source1.tif', server + 'reference1.tif', output,
+        '--read-threads', '3', '--gdal-cache', '64'])
+    assert result.exit_code == 0, result.output
+    assert os.path.exists(output)
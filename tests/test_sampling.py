@@ -0,0 +1,118 @@
+from affine import Affine
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import Resampling
+
+from rio_hist.match import hist_match_worker
+from rio_hist.windowed import sampled_histograms, windowed_histograms
+
+
+@pytest.fixture
+def overviews_raster(tmpdir):
+    path = str(tmpdir.join('overviews.tif'))
+    rng = np.random.RandomState(0)
+    arr = rng.randint(0, 256, (3, 512, 512)).astype('uint8')
+    profile = {
+        'driver': 'GTiff', 'dtype': 'uint8', 'count': 3,
+        'width': 512, 'height': 512, 'crs': 'EPSG:3857',
+        'transform': Affine(10.0, 0.0, 0.0, 0.0, -10.0, 0.0),
+        'tiled': True, 'blockxsize': 128, 'blockysize': 128}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr)
+        dst.build_overviews([2, 4], Resampling.nearest)
+    return path
+
+
+@pytest.mark.parametrize('color_space', ['RGB', 'LCH'])
+def test_sample_resolution(overviews_raster, color_space):
+    with rasterio.open(overviews_raster) as src:
+        hists, masked = sampled_histograms(
+            src, color_space, (0, 1, 2), sample_resolution=40.0)
+        overview = src.read(1, out_shape=(128, 128))
+    assert not masked
+    for values, counts in hists.values():
+        assert counts.sum() == 128 * 128
+    if color_space == 'RGB':
+        values, counts = hists[0]
+        expected = np.bincount(overview.ravel(), minlength=256)
+        assert np.array_equal(counts, expected[expected > 0])
+
+
+def test_max_samples(overviews_raster):
+    with rasterio.open(overviews_raster) as src:
+        hists, _ = sampled_histograms(
+            src, 'LAB', (0, ), max_samples=3 * 128 * 128)
+    assert hists[0][1].sum() == 3 * 128 * 128
+
+
+@pytest.mark.parametrize('color_space', ['RGB', 'LCH', 'LUV'])
+@pytest.mark.parametrize('kwargs', [
+    {'sample_resolution': 1.0}, {'max_samples': 10 ** 9}])
+def test_full_sample_matches_windowed(tmpdir, color_space, kwargs):
+    windowed = str(tmpdir.join('windowed.tif'))
+    sampled = str(tmpdir.join('sampled.tif'))
+    args = ('tests/data/source2.tif', 'tests/data/reference2.tif')
+    hist_match_worker(args[0], args[1], windowed, 1.0, {}, '1,2,3',
+                      color_space, False, windowed=True)
+    hist_match_worker(args[0], args[1], sampled, 1.0, {}, '1,2,3',
+                      color_space, False, **kwargs)
+    with rasterio.open(windowed) as a, rasterio.open(sampled) as b:
+        assert a.count == b.count == 4
+        assert np.array_equal(a.read(), b.read())
+
+
+def test_sampled_close_to_full(tmpdir):
+    full = str(tmpdir.join('full.tif'))
+    sampled = str(tmpdir.join('sampled.tif'))
+    args = ('tests/data/source1.tif', 'tests/data/reference1.tif')
+    co = {'compress': 'deflate'}
+    hist_match_worker(args[0], args[1], full, 1.0, co, '1,2,3', 'LCH', False)
+    hist_match_worker(args[0], args[1], sampled, 1.0, co, '1,2,3', 'LCH',
+                      False, sample_resolution=40.0)
+    with rasterio.open(full) as a, rasterio.open(sampled) as b:
+        diff = np.abs(a.read().astype(int) - b.read())
+    assert diff.mean() < 0.5
+
+
+def test_sample_options_exclusive(tmpdir):
+    with pytest.raises(ValueError):
+        hist_match_worker('tests/data/source1.tif', 'tests/data/reference1.tif',
+                          str(tmpdir.join('out.tif')), 1.0, {}, '1,2,3',
+                          'RGB', False, sample_resolution=40.0,
+                          max_samples=1000)
+
+
+@pytest.mark.parametrize('color_space', ['LCH', 'RAW'])
+def test_bincount_fixed_grid(tmpdir, color_space):
+    # float RAW bands and color space bands of many blocks are binned on
+    # one grid per band, not on a grid per block
+    path = str(tmpdir.join('float.tif'))
+    rng = np.random.RandomState(0)
+    profile = {
+        'driver': 'GTiff', 'dtype': 'uint8', 'count': 3,
+        'width': 512, 'height': 512, 'crs': 'EPSG:3857',
+        'transform': Affine(10.0, 0.0, 0.0, 0.0, -10.0, 0.0),
+        'tiled': True, 'blockxsize': 128, 'blockysize': 128}
+    arr = rng.randint(0, 256, (3, 512, 512)).astype('uint8')
+    if color_space == 'RAW':
+        profile['dtype'] = 'float32'
+        arr = rng.normal(size=arr.shape).astype('float32')
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr)
+
+    with rasterio.open(path) as src:
+        for hists, _ in (
+                windowed_histograms(src, color_space, (0, 1), 'bincount'),
+                sampled_histograms(src, color_space, (0, 1), 'bincount',
+                                   max_samples=10 ** 9)):
+            for values, counts in hists.values():
+                assert len(values) <= 65536
+                assert counts.sum() == 512 * 512
+
+    output = str(tmpdir.join('output.tif'))
+    hist_match_worker(path, 'tests/data/reference2.tif', output, 1.0, {},
+                      '1,2', color_space, False, windowed=True,
+                      method='bincount')
+    with rasterio.open(output) as dst:
+        assert dst.read().any()
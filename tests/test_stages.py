@@ -0,0 +1,70 @@
+import json
+
+from click.testing import CliRunner
+import pytest
+
+from rio_hist.match import hist_match_worker
+from rio_hist.scripts.cli import hist
+from rio_hist.stages import NullStats, StageStats
+
+
+def test_stage_stats():
+    stats = StageStats()
+    for _ in range(2):
+        with stats.stage('read') as stage:
+            stage.bytes_read += 10
+    with stats.stage('write') as stage:
+        stage.bytes_written += 5
+    stats.finish()
+    assert stats['read'].calls == 2
+    assert stats['read'].bytes_read == 20
+    assert 'match' not in stats
+    summary = stats.as_dict()
+    assert [s['name'] for s in summary['stages']] == ['read', 'write']
+    assert summary['bytes_read'] == 20
+    assert summary['bytes_written'] == 5
+    assert summary['seconds'] >= 0
+
+
+def test_null_stats():
+    stats = NullStats()
+    with stats.stage('read') as stage:
+        stage.bytes_read += 10
+    stats.finish()
+
+
+@pytest.mark.parametrize('color_space,kwargs', [
+    ('RGB', {}),
+    ('LCH', {}),
+    ('LCH', {'windowed': True}),
+    ('LCH', {'sample_resolution': 40.0})])
+def test_worker_stages(tmpdir, color_space, kwargs):
+    output = str(tmpdir.join('matched.tif'))
+    stats = hist_match_worker(
+        'tests/data/source2.tif', 'tests/data/reference2.tif', output, 1.0,
+        {}, '1,2,3', color_space, False, **kwargs)
+    for name in ('reference_histograms', 'read', 'match', 'write'):
+        assert name in stats
+    assert stats['read'].bytes_read > 0
+    assert sum(stats[name].bytes_read for name in
+               ('reference_read', 'reference_histograms')
+               if name in stats) > 0
+    assert stats['write'].bytes_written > 0
+    assert stats.seconds > 0
+    if color_space != 'RGB':
+        assert 'cs_forward' in stats and 'cs_backward' in stats
+
+
+def test_profile_json(tmpdir):
+    output = str(tmpdir.join('matched.tif'))
+    report = str(tmpdir.join('profile.json'))
+    runner = CliRunner()
+    result = runner.invoke(
+        hist, ['-c', 'LAB', '--profile-json', report, 'tests/data/source1.tif',
+               'tests/data/reference1.tif', output])
+    assert result.exit_code == 0
+    with open(report) as f:
+        summary = json.load(f)
+    names = [s['name'] for s in summary['stages']]
+    assert 'reference_read' in names and 'write' in names
+    assert summary['bytes_written'] > 0